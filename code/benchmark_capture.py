@@ -0,0 +1,73 @@
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+from lib.audiolib import audioread
+from lib.audio_capture import SimulatedAudioSource, CallbackRecorder, EnergyRatioMonitor
+
+
+def get_source(args, chunk):
+    if args.wav_path is not None:
+        return SimulatedAudioSource.from_wav(args.wav_path, chunk=chunk, speed=args.speed, jitter=args.jitter,
+                                             overrun_prob=args.overrun_prob, seed=0)
+    ref_audio, fs = audioread(args.ref_path)
+    return SimulatedAudioSource.from_doa(ref_audio, args.doa, sample_rate=fs, chunk=chunk, speed=args.speed,
+                                         jitter=args.jitter, overrun_prob=args.overrun_prob, seed=0)
+
+
+def benchmark_recorder(args):
+    '''
+    record from the simulated device through CallbackRecorder and check that nothing is lost between the callback and
+    the files
+    '''
+    print('-' * 20, 'CallbackRecorder: simulated device', '-' * 20, )
+    recorder = CallbackRecorder(get_source(args, chunk=args.chunk), buffer_seconds=args.buffer_seconds)
+    with tempfile.TemporaryDirectory() as save_dir:
+        start = time.perf_counter()
+        stats = recorder.record(os.path.join(save_dir, 'record.wav'), record_seconds=args.record_seconds)
+        wall_time = time.perf_counter() - start
+    print('speed: {}x | jitter: {} s | overrun_prob: {} | buffer: {} s'.format(
+        args.speed, args.jitter, args.overrun_prob, args.buffer_seconds))
+    print('recorded {:d} / {:d} frames in {:.2f} s ({:.1f}x real time)'.format(
+        stats['num_frame'], recorder.target_num_frame, wall_time, args.record_seconds / wall_time))
+    print('input overflows (injected): {:d} | ring buffer overruns: {:d}'.format(
+        stats['num_input_overflow'], stats['num_overrun']))
+
+
+def benchmark_monitor(args):
+    '''
+    how often EnergyRatioMonitor delivers a new ratio from the simulated device
+    '''
+    print('-' * 20, 'EnergyRatioMonitor: simulated device', '-' * 20, )
+    num_ratio = 0
+    with EnergyRatioMonitor(get_source(args, chunk=512)) as monitor:
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.monitor_seconds:
+            ratio = monitor.get_ratio(timeout=1.)
+            num_ratio += 1
+    print('{:d} ratios in {:.1f} s | last ratio: {}'.format(num_ratio, args.monitor_seconds, np.round(ratio, 3)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='headless load test of the capture path with a simulated 4-mic device')
+    parser.add_argument('--wav_path', type=str, nargs='+', default=None,
+                        help='a multi-channel wav, or one wav per mic; by default reference_wav.wav is synthesized')
+    parser.add_argument('--ref_path', type=str, default='../reference_wav.wav')
+    parser.add_argument('--doa', type=float, default=45.)
+    parser.add_argument('--speed', type=float, default=10.)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--overrun_prob', type=float, default=0.)
+    parser.add_argument('--chunk', type=int, default=1024)
+    parser.add_argument('--buffer_seconds', type=float, default=10.)
+    parser.add_argument('--record_seconds', type=float, default=60.)
+    parser.add_argument('--monitor_seconds', type=float, default=2.)
+    parser.add_argument('--bench', nargs='+', default=['recorder', 'monitor'])
+    args = parser.parse_args()
+    if (args.wav_path is not None) and (len(args.wav_path) == 1):
+        args.wav_path = args.wav_path[0]
+    
+    if 'recorder' in args.bench:
+        benchmark_recorder(args)
+    if 'monitor' in args.bench:
+        benchmark_monitor(args)
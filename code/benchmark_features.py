@@ -0,0 +1,123 @@
+import time
+import argparse
+import numpy as np
+from ssl_feature_extractor import audioFeatureExtractor, audioStreamFeatureExtractor
+
+
+def time_it(func, repeat=5):
+    '''
+    return the best wall time (in s) of several runs of func
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_gcc_phat_batch(batch_size=64, num_sample=16000, num_gcc_bin=128, repeat=5):
+    '''
+    compare the per-pair loop of get_gcc_phat with the batched get_gcc_phat_batch
+    '''
+    print('-' * 20, 'gcc_phat: per-pair loop vs batched', '-' * 20, )
+    audio = np.random.randn(batch_size, 4, num_sample).astype(np.float32)
+    fe = audioFeatureExtractor(num_channel=4, fs=16000, num_gcc_bin=num_gcc_bin, )
+    out = np.empty((batch_size, fe.num_pair, num_gcc_bin), dtype=np.float32)
+    
+    loop_time = time_it(lambda: [fe.get_gcc_phat(i) for i in audio], repeat=repeat)
+    batch_time = time_it(lambda: fe.get_gcc_phat_batch(audio, out=out), repeat=repeat)
+    
+    ref = np.asarray([fe.get_gcc_phat(i) for i in audio])
+    max_err = np.abs(fe.get_gcc_phat_batch(audio) - ref).max()
+    print('batch_size:', batch_size, '\t', 'num_sample:', num_sample, '\t', 'num_gcc_bin:', num_gcc_bin, )
+    print('per-pair loop: {:.2f} ms/segment'.format(loop_time / batch_size * 1000))
+    print('batched      : {:.2f} ms/segment'.format(batch_time / batch_size * 1000))
+    print('speedup      : {:.1f}x'.format(loop_time / batch_time), '\t', 'max abs error:', max_err)
+
+
+def check_gcc_phat_batch(batch_size=8, num_gcc_bin_ls=(128, 127, 32, 31), num_sample_ls=(512, 1000, 16000)):
+    '''
+    equivalence of get_gcc_phat_batch (float64, full irfft and lag-limited) with the per-pair get_gcc_phat, also for
+    an odd num_gcc_bin (ceil(num_gcc_bin / 2) negative lags) and an odd number of samples
+    '''
+    print('-' * 20, 'gcc_phat: batched == per-pair loop', '-' * 20, )
+    for num_gcc_bin in num_gcc_bin_ls:
+        fe = audioFeatureExtractor(num_channel=4, fs=16000, num_gcc_bin=num_gcc_bin, )
+        for num_sample in num_sample_ls:
+            audio = np.random.randn(batch_size, 4, num_sample)
+            ref = np.asarray([fe.get_gcc_phat(i) for i in audio])
+            for lag_limited in [False, True]:
+                max_err = np.abs(fe.get_gcc_phat_batch(audio, dtype=np.float64, lag_limited=lag_limited) - ref).max()
+                print('num_gcc_bin: {:>4d} | num_sample: {:>6d} | lag-limited: {:d} | max abs error: {:.1e}'.format(
+                    num_gcc_bin, num_sample, lag_limited, max_err))
+                assert max_err < 1e-10, f'get_gcc_phat_batch differs from get_gcc_phat ({num_gcc_bin} bins)'
+
+
+def benchmark_gcc_phat_lag_limited(batch_size=64, fs=16000, num_gcc_bin_ls=(16, 32, 64, 128), repeat=5):
+    '''
+    compare the full irfft with the lag-limited partial inverse DFT of get_gcc_phat_batch (float32, whole call), over
+    the clip lengths of segment_para_set and several numbers of bins, to set MAX_LAG_LIMITED_BIN of
+    ssl_feature_extractor. Speedups of the lag-limited path measured on the dev box (64 segments, best of 7; the
+    rfft and the PHAT weighting are the same in both paths):
+        samples |  16 bins |  32 bins |  64 bins | 128 bins
+            512 |     1.3x |     1.3x |     1.2x |     0.9x
+            800 |     1.4x |     1.3x |     1.2x |     0.9x
+           1024 |     1.4x |     1.4x |     1.3x |     1.2x
+           2048 |     1.4x |     1.4x |     1.2x |     0.6x
+           4096 |     1.3x |     1.4x |     0.9x |     0.6x
+          16000 |     1.2x |     1.0x |     1.0x |     0.7x
+    '''
+    print('-' * 20, 'gcc_phat: full irfft vs lag-limited', '-' * 20, )
+    print('samples | ' + ' | '.join('{:>4d} bins'.format(i) for i in num_gcc_bin_ls))
+    for time_len in [32 / 1000, 50 / 1000, 64 / 1000, 128 / 1000, 256 / 1000, 1]:
+        num_sample = int(time_len * fs)
+        audio = np.random.randn(batch_size, 4, num_sample).astype(np.float32)
+        speedups = []
+        for num_gcc_bin in num_gcc_bin_ls:
+            fe = audioFeatureExtractor(num_channel=4, fs=fs, num_gcc_bin=num_gcc_bin, )
+            out = np.empty((batch_size, fe.num_pair, num_gcc_bin), dtype=np.float32)
+            fe.get_lag_basis(num_sample)  # the basis is built once per clip length and shared afterwards
+            full_time = time_it(lambda: fe.get_gcc_phat_batch(audio, out=out, lag_limited=False), repeat=repeat)
+            lag_time = time_it(lambda: fe.get_gcc_phat_batch(audio, out=out, lag_limited=True), repeat=repeat)
+            speedups.append(full_time / lag_time)
+        print('{:>7d} | '.format(num_sample) + ' | '.join('{:>8.1f}x'.format(i) for i in speedups))
+
+
+def benchmark_stream_features(fs=16000, window_len=1., hop=0.1, repeat=5):
+    '''
+    per-hop cost of the stream extractor (new frames only) vs get_stft + get_gcc_phat_batch on the whole window
+    '''
+    print('-' * 20, 'streaming: full window vs incremental update', '-' * 20, )
+    fe = audioFeatureExtractor(num_channel=4, fs=fs, fft_seg_len=0.064, fft_stepsize_ratio=0.5, )
+    stream_fe = audioStreamFeatureExtractor(num_channel=4, fs=fs, fft_seg_len=0.064, fft_stepsize_ratio=0.5,
+                                            window_len=window_len, )
+    audio = np.random.randn(4, int(window_len * fs)).astype(np.float32)
+    chunk = np.random.randn(4, int(hop * fs)).astype(np.float32)
+    stream_fe.update(audio)
+    
+    full_time = time_it(lambda: (fe.get_stft(audio), fe.get_gcc_phat_batch(audio[np.newaxis])), repeat=repeat)
+    stream_time = time_it(lambda: (stream_fe.update(chunk), stream_fe.get_stft(), stream_fe.get_gcc_phat()),
+                          repeat=repeat)
+    print('window: {} s | hop: {} s | full window: {:.2f} ms/hop | incremental: {:.2f} ms/hop | speedup: {:.1f}x'.format(
+        window_len, hop, full_time * 1000, stream_time * 1000, full_time / stream_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro-benchmarks of the feature extraction')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_sample', type=int, default=16000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--bench', nargs='+', default=['gcc_phat_equivalence', 'gcc_phat_batch', 'gcc_phat_lag_limited',
+                                                     'stream_features'])
+    args = parser.parse_args()
+    
+    np.random.seed(0)
+    if 'gcc_phat_equivalence' in args.bench:
+        check_gcc_phat_batch()
+    if 'gcc_phat_batch' in args.bench:
+        benchmark_gcc_phat_batch(batch_size=args.batch_size, num_sample=args.num_sample, repeat=args.repeat)
+    if 'gcc_phat_lag_limited' in args.bench:
+        benchmark_gcc_phat_lag_limited(batch_size=args.batch_size, repeat=args.repeat)
+    if 'stream_features' in args.bench:
+        benchmark_stream_features(repeat=args.repeat)
@@ -0,0 +1,149 @@
+import time
+import argparse
+import numpy as np
+import ns_featurelib
+from benchmark_features import time_it
+
+NS_CFG = {
+    'winlen'  : 0.02,
+    'hopfrac' : 0.5,
+    'fs'      : 16000,
+    'mingain' : -80,
+    'feattype': 'LogPow'
+}
+
+
+def stft_frame_loop(x, N_fft, win, N_hop):
+    '''
+    reference: the former frame-by-frame ns_featurelib.stft (nodelay=False)
+    '''
+    if x.ndim == 1:
+        x = x[:, np.newaxis]
+    Nx = x.shape[0]
+    M = x.shape[1]
+    specsize = int(N_fft / 2 + 1)
+    N_win = len(win)
+    N_frames = int(np.ceil((Nx - N_win + N_hop) / N_hop))
+    Nx = N_frames * N_hop + N_win - N_hop  # padded length
+    x = np.vstack([x, np.zeros((Nx - len(x), M))])
+    
+    X_spec = np.zeros((specsize, N_frames, M), dtype=complex)
+    win_M = np.outer(win, np.ones((1, M)))
+    x_frame = np.zeros((N_win, M))
+    for nn in range(0, N_frames):
+        idx = int(nn * N_hop)
+        x_frame = np.vstack((x_frame[N_hop:, :], x[idx:idx + N_hop, :]))
+        x_win = win_M * x_frame
+        X = np.fft.rfft(x_win, N_fft, axis=0)
+        X_spec[:, nn, :] = X
+    if M == 1:
+        X_spec = np.squeeze(X_spec)
+    return X_spec
+
+
+def istft_frame_loop(X, N_fft, win, N_hop):
+    '''
+    reference: the former frame-by-frame ns_featurelib.istft
+    '''
+    N_frames = X.shape[1]
+    if X.ndim < 3:
+        X = X[:, :, np.newaxis]
+    M = X.shape[2]
+    N_win = len(win)
+    Nx = N_hop * (N_frames - 1) + N_win
+    win_M = np.outer(win, np.ones((1, M)))
+    x = np.zeros((Nx, M))
+    for nn in range(0, N_frames):
+        X_frame = np.squeeze(X[:, nn, :])
+        x_win = np.fft.irfft(X_frame, N_fft, axis=0)
+        x_win = x_win.reshape(N_fft, M)
+        x_win = win_M * x_win[0:N_win, :]
+        idx1 = int(nn * N_hop)
+        idx2 = int(idx1 + N_win)
+        x[idx1:idx2, :] = x_win + x[idx1:idx2, :]
+    if M == 1:
+        x = np.squeeze(x)
+    return x
+
+
+def benchmark_stft(num_sample=16000, repeat=5):
+    '''
+    compare the frame loops with the vectorized ns_featurelib.stft / istft on the NSNet2 configuration
+    '''
+    print('-' * 20, 'ns_featurelib: frame loop vs vectorized', '-' * 20, )
+    fs = NS_CFG['fs']
+    N_win = int(NS_CFG['winlen'] * fs)
+    N_hop = int(N_win * NS_CFG['hopfrac'])
+    win = np.sqrt(np.hanning(N_win))
+    x = np.random.randn(num_sample)
+    X = ns_featurelib.stft(x, N_win, win, N_hop)
+    
+    for name, loop_func, vec_func, arg in [('stft', stft_frame_loop, ns_featurelib.stft, x),
+                                           ('istft', istft_frame_loop, ns_featurelib.istft, X), ]:
+        loop_time = time_it(lambda: loop_func(arg, N_win, win, N_hop), repeat=repeat)
+        vec_time = time_it(lambda: vec_func(arg, N_win, win, N_hop), repeat=repeat)
+        max_err = np.abs(loop_func(arg, N_win, win, N_hop) - vec_func(arg, N_win, win, N_hop)).max()
+        print('{:<5s} | frame loop: {:.2f} ms | vectorized: {:.2f} ms | speedup: {:.1f}x | max abs error: {:.1e}'.format(
+            name, loop_time * 1000, vec_time * 1000, loop_time / vec_time, max_err))
+
+
+def benchmark_batch_inference(model_path, num_sample=16000, batch_sizes=(1, 4, 16, 64), repeat=3):
+    '''
+    throughput of NSnet2Enhancer.batch_call (segments per second) for several batch sizes
+    '''
+    from ns_enhance_onnx import load_onnx_model
+    print('-' * 20, 'NSNet2: throughput per batch size', '-' * 20, )
+    model, _ = load_onnx_model(model_path=model_path)
+    fs = NS_CFG['fs']
+    base_throughput = None
+    for batch_size in batch_sizes:
+        audio = np.random.randn(batch_size, num_sample) * 0.05
+        batch_time = time_it(lambda: model.batch_call(audio, fs), repeat=repeat)
+        throughput = batch_size / batch_time
+        base_throughput = throughput if base_throughput is None else base_throughput
+        print('batch_size: {:>4d} | {:.1f} segments/s | {:.2f} ms/segment | {:.1f}x of batch_size {:d}'.format(
+            batch_size, throughput, batch_time / batch_size * 1000, throughput / base_throughput, batch_sizes[0]))
+
+
+def benchmark_streaming(model_path, chunk=1024, num_second=10, context_frames=100):
+    '''
+    latency and real-time factor of NSnet2StreamEnhancer fed with chunks of the capture size
+    '''
+    from ns_enhance_onnx import load_onnx_model, NSnet2StreamEnhancer
+    print('-' * 20, 'NSNet2: streaming latency and real-time factor', '-' * 20, )
+    model, _ = load_onnx_model(model_path=model_path)
+    fs = NS_CFG['fs']
+    stream = NSnet2StreamEnhancer(model, context_frames=context_frames)
+    audio = np.random.randn(int(num_second * fs)) * 0.05
+    chunk_time = []
+    for i in range(0, len(audio), chunk):
+        start = time.perf_counter()
+        stream(audio[i:i + chunk])
+        chunk_time.append(time.perf_counter() - start)
+    chunk_time = np.asarray(chunk_time) * 1000
+    print('chunk: {:d} samples ({:.1f} ms) | algorithmic latency: {:d} samples ({:.1f} ms) | context: {} frames'.format(
+        chunk, chunk / fs * 1000, stream.latency, stream.latency / fs * 1000, context_frames))
+    print('processing time per chunk: p50 {:.2f} ms | p95 {:.2f} ms | p99 {:.2f} ms | max {:.2f} ms'.format(
+        *np.percentile(chunk_time, [50, 95, 99, 100])))
+    print('real-time factor: {:.3f}'.format(chunk_time.sum() / 1000 / num_second))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro-benchmarks of the NSNet2 denoising')
+    parser.add_argument('--num_sample', type=int, default=16000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--model_path', type=str, default='./ns_nsnet2-20ms-baseline.onnx')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--chunk', type=int, default=1024)
+    parser.add_argument('--context_frames', type=int, default=100)
+    parser.add_argument('--bench', nargs='+', default=['stft', 'batch_inference', 'streaming'])
+    args = parser.parse_args()
+    
+    np.random.seed(0)
+    if 'stft' in args.bench:
+        benchmark_stft(num_sample=args.num_sample, repeat=args.repeat)
+    if 'batch_inference' in args.bench:
+        benchmark_batch_inference(model_path=args.model_path, num_sample=args.num_sample,
+                                  batch_sizes=args.batch_sizes, repeat=args.repeat)
+    if 'streaming' in args.bench:
+        benchmark_streaming(model_path=args.model_path, chunk=args.chunk, context_frames=args.context_frames)
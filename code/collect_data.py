@@ -1,11 +1,17 @@
 import os
 import sys
+import time
 import wave
+import queue
+import argparse
+import threading
 import numpy as np
 import soundfile as sf
+from scipy.signal import get_window
 from pyaudio import PyAudio, paInt16
-from lib.audiolib import audiowrite, audioread
+from lib.audiolib import audiowrite, audioread, audio_segmenter_4_numpy, audio_segmenter_4_file
 from lib.utils import standard_normalizaion, add_prefix_and_suffix_4_basename
+from lib.audio_capture import CallbackRecorder, EnergyRatioMonitor, PyAudioSource
 
 RECORD_DEVICE_NAME = "USB Camera-B4.09.24.1"
 RECORD_SECONDS = 60  # 180
@@ -16,6 +22,7 @@ CHUNK = 1024
 Voice_String = []
 MICRO_MAPPING = np.array(range(CHANNELS))
 DEVICE_INDEX = -1
+LAYOUT = 'per_mic'  # or 'interleaved': one record_mics.wav per take (and per segment) instead of record_mic{i}.wav
 LOCATION_NUM = 2
 DIRECTION = 8
 DIRECTION_MAPPING = [0, 45, 90, 135, 180, 225, 270, 315, ]
@@ -71,28 +78,32 @@ def get_device_index():
 
 def init_micro_mapping():
     print('Please tap each microphone clockwise from the upper left corner ~ ')
-    mapping = [None, ] * 4
-    while True:
-        for i in range(CHANNELS):
-            while True:
-                ratio = monitor_audio_and_return_amplitude_ratio(mapping_flag=False)
-                idx = np.where(ratio > 0.5)[0]
-                if len(idx) == 1 and (idx[0] not in mapping):
-                    mapping[i] = idx[0]
-                    print(' '.join(['Logical channel', str(i), 'has been set as physical channel', str(mapping[i]),
-                                    'Amplitude**2 ratio: ', str(ratio)]))
-                    break
-        print('Final mapping: ')
-        print('Logical channel: ', list(range(CHANNELS)))
-        print('Physical channel: ', mapping)
-        # break
-        
-        confirm_info = input('Confirm or Reset the mapping? Press [y]/n :')
-        if confirm_info in ['y', '', 'yes', 'Yes']:
-            break
-        else:
-            print('The system will reset the mapping')
-            continue
+    # one monitoring stream for the whole procedure, the energy ratio is updated with every chunk
+    source = PyAudioSource(device_index=DEVICE_INDEX, num_channel=CHANNELS, sample_rate=SAMPLE_RATE,
+                           sample_width=RECORD_WIDTH, chunk=512, )
+    with EnergyRatioMonitor(source) as monitor:
+        while True:
+            mapping = [None, ] * 4
+            for i in range(CHANNELS):
+                while True:
+                    ratio = monitor.get_ratio()
+                    idx = np.where(ratio > 0.5)[0]
+                    if len(idx) == 1 and (idx[0] not in mapping):
+                        mapping[i] = idx[0]
+                        print(' '.join(['Logical channel', str(i), 'has been set as physical channel', str(mapping[i]),
+                                        'Amplitude**2 ratio: ', str(ratio)]))
+                        break
+            print('Final mapping: ')
+            print('Logical channel: ', list(range(CHANNELS)))
+            print('Physical channel: ', mapping)
+            # break
+            
+            confirm_info = input('Confirm or Reset the mapping? Press [y]/n :')
+            if confirm_info in ['y', '', 'yes', 'Yes']:
+                break
+            else:
+                print('The system will reset the mapping')
+                continue
     return np.array(mapping)
 
 
@@ -127,6 +138,21 @@ def monitor_from_4mics(record_seconds=RECORD_SECONDS):
     return frames
 
 
+def record_to_files(save_path, record_seconds=RECORD_SECONDS):
+    '''
+    record from the 4 mics, streaming the interleaved recording to save_path and every mapped channel to
+    save_path + '_mic{i}' (or all of them to save_path + '_mics' if LAYOUT is 'interleaved') while recording (see
+    lib.audio_capture.CallbackRecorder)
+    '''
+    print('-' * 20 + "Start recording ...")
+    source = PyAudioSource(device_index=DEVICE_INDEX, num_channel=CHANNELS, sample_rate=SAMPLE_RATE,
+                           sample_width=RECORD_WIDTH, chunk=CHUNK, )
+    recorder = CallbackRecorder(source)
+    stats = recorder.record(save_path, record_seconds=record_seconds, mapping=MICRO_MAPPING, layout=LAYOUT)
+    print('-' * 20 + "End recording ...", stats, '\n')
+    return stats
+
+
 def save_wav_from_frames(filename, frames):
     wf = wave.open(filename, 'wb')
     wf.setnchannels(CHANNELS)
@@ -162,10 +188,106 @@ def encode_dir(dataset_dir, walker, source, direction):
     return save_dir, save_path
 
 
+def load_schedule(schedule_path):
+    '''
+    load a collection schedule: one take per line, 'walker source direction' (separated by spaces or commas), where
+    walker and source are numbers of coordinate_mapping (starting from 1) and direction is one of DIRECTION_MAPPING.
+    Empty lines and lines starting with '#' are ignored
+    :return: list of (walker, source, direction)
+    '''
+    schedule = []
+    with open(schedule_path, 'r') as f:
+        for line_idx, line in enumerate(f):
+            line = line.strip()
+            if (len(line) == 0) or line.startswith('#'):
+                continue
+            walker, source, direction = list(map(int, line.replace(',', ' ').split()))
+            if not (1 <= walker <= len(coordinate_mapping)) or not (1 <= source <= len(coordinate_mapping)) \
+                    or (direction not in DIRECTION_MAPPING):
+                raise ValueError(f'line {line_idx + 1} of {schedule_path} is invalid: {line}')
+            schedule.append((walker, source, direction))
+    return schedule
+
+
+def segment_take(save_path, initial_dir, seg_dspath, seg_len=1, stepsize=0.5, window='hann'):
+    '''
+    segment every mic file of a take with audio_segmenter_4_numpy, and save the clips in the layout of clip_audio in
+    dataset_prepro_1 (seg_dspath/src_*/walker_*/doa/seg_{i}/record_mic{j}.wav, or seg_{i}/record_mics.wav if the take
+    was recorded in the interleaved layout)
+    '''
+    dst_dir = os.path.join(seg_dspath, os.path.relpath(os.path.dirname(save_path), start=initial_dir))
+    mics_path = add_prefix_and_suffix_4_basename(save_path, suffix='_mics')
+    if os.path.exists(mics_path):
+        audio_segmenter_4_file(mics_path, dst_dir, segment_len=seg_len, stepsize=stepsize, fs=SAMPLE_RATE,
+                               window=window, padding=False, pow_2=False, save2segFolders=True, multi_channel=True)
+        return
+    for i in range(CHANNELS):
+        mic_path = add_prefix_and_suffix_4_basename(save_path, suffix='_mic%d' % i)
+        audio, fs = audioread(mic_path)
+        audio_segments = audio_segmenter_4_numpy(audio, segment_len=seg_len, stepsize=stepsize, fs=fs, window=None,
+                                                 padding=False, pow_2=False, return_view=True)
+        win = get_window(window, audio_segments.shape[-1]) if (window is not None) else 1.
+        for j, audio_seg in enumerate(audio_segments):
+            audiowrite(os.path.join(dst_dir, 'seg_' + str(j), os.path.basename(mic_path)), audio_seg * win, fs,
+                       norm=False, )
+
+
+def collect_by_schedule(schedule, dataset_dir, seg_dspath=None, interval=10, **seg_kwargs):
+    '''
+    unattended collection: record every take of the schedule, while a background worker segments the previous take,
+    so that the throughput is only limited by the recording time
+    :param interval: pause before each take (in s), to move the walker / sound source
+    :param seg_dspath: where the segments are saved (None: do not segment)
+    '''
+    take_queue = queue.Queue()
+    
+    def post_process_worker():
+        while True:
+            save_path = take_queue.get()
+            if save_path is None:
+                break
+            try:
+                segment_take(save_path, os.path.join(dataset_dir, 'initial'), seg_dspath, **seg_kwargs)
+                print('-' * 20 + 'Segmented', save_path)
+            except Exception as e:  # keep the session running, the take can be segmented again by clip_audio
+                print('-' * 20 + 'Failed to segment', save_path, 'e:', e)
+    
+    worker = threading.Thread(target=post_process_worker, )
+    worker.start()
+    try:
+        for take_idx, (walker, source, direction) in enumerate(schedule):
+            print('\n' + '-' * 20 + f'Take {take_idx + 1}/{len(schedule)}: ',
+                  'walker:', walker, '\tsource:', source, '\tdirection:', direction, )
+            time.sleep(interval)
+            save_dir, save_path = encode_dir(dataset_dir, walker, source, direction)
+            record_to_files(save_path)
+            if seg_dspath is not None:
+                take_queue.put(save_path)
+    finally:
+        take_queue.put(None)
+        worker.join()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='collect the 4-channel dataset')
+    parser.add_argument('--schedule', type=str, default=None,
+                        help='schedule file of an unattended session (see load_schedule); interactive if not given')
+    parser.add_argument('--interval', type=float, default=10, help='pause before each scheduled take (in s)')
+    parser.add_argument('--seg_dspath', type=str, default=None,
+                        help='segment every scheduled take into this dataset, e.g. ./dataset/1s_0.5_800_16000/ini_hann')
+    parser.add_argument('--seg_len', type=float, default=1)
+    parser.add_argument('--stepsize', type=float, default=0.5)
+    parser.add_argument('--layout', type=str, default=LAYOUT, choices=['per_mic', 'interleaved'])
+    args = parser.parse_args()
+    LAYOUT = args.layout
+    
     DEVICE_INDEX = get_device_index()
     MICRO_MAPPING = init_micro_mapping()
     dataset_dir = './dataset'
+    if args.schedule is not None:
+        collect_by_schedule(load_schedule(args.schedule), dataset_dir, seg_dspath=args.seg_dspath,
+                            interval=args.interval, seg_len=args.seg_len, stepsize=args.stepsize, )
+        sys.exit()
     ### collect data
     while True:
         walker = -1
@@ -188,8 +310,4 @@ if __name__ == '__main__':
         else:
             print('\n' + '-' * 20 + 'Collecting data...')
         save_dir, save_path = encode_dir(dataset_dir, walker, source, direction)
-        frames = monitor_from_4mics()
-        save_wav_from_frames(save_path, frames)
-        
-        audio = split_channels_from_frames(frames, mapping_flag=True)
-        save_multi_channel_audio(save_path, audio, fs=SAMPLE_RATE, norm=False, )
+        record_to_files(save_path)
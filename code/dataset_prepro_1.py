@@ -8,19 +8,30 @@ from pathlib import Path
 import librosa
 import random
 import tempfile
+import time
+import traceback
 
 import pickle
 import shutil
 from tqdm import tqdm
+from scipy.signal import get_window
 from threading import Thread
-from multiprocessing import Process
+from queue import Empty
+from multiprocessing import Process, Queue
 
 from lib.audiolib import audioread, audiowrite, normalize_single_channel_audio, audio_segmenter_4_file, \
-    audio_segmenter_4_numpy, audio_energy_ratio_over_threshold, audio_energy_over_threshold, next_greater_power_of_2
+    audio_segmenter_4_numpy, audio_energy_ratio_over_threshold, audio_energy_over_threshold, next_greater_power_of_2, \
+    audioread_channels, audiowrite_channels, audiowrite_atomically, read_mic_dir, is_mic_file, split_mics_file, \
+    MICS_FILE_NAME
 from lib.utils import get_files_by_suffix, get_dirs_by_prefix, get_subdirs_by_suffix, get_subdirs_by_suffix, \
-    get_subfiles_by_suffix, plot_curve, add_prefix_and_suffix_4_basename
-from ns_enhance_onnx import load_onnx_model, denoise_nsnet2
+    get_subfiles_by_suffix, plot_curve, add_prefix_and_suffix_4_basename, savez_atomically
+from ns_enhance_onnx import load_onnx_model, denoise_nsnet2, denoise_nsnet2_batch
 from ssl_feature_extractor import audioFeatureExtractor
+from lib.segment_index import SegmentIndex
+from lib.catalog import DatasetCatalog
+from lib.label_table import LabelTable
+from lib.feature_store import FeatureStore, FeatureStoreWriter
+from lib.stage_cache import StageCache
 
 ref_audio, _ = audioread('../reference_wav.wav')
 REF_AUDIO = normalize_single_channel_audio(ref_audio)
@@ -29,6 +40,59 @@ EPS = np.finfo(float).eps
 REF_POWER = 1e-12
 np.random.seed(0)
 
+segment_para_set = {
+    '32ms' : {
+        'name'          : '32ms',
+        'time_len'      : 32 / 1000,
+        'threshold'     : 100,
+        'stepsize_ratio': 0.5
+    },
+    '50ms' : {
+        'name'          : '50ms',
+        'time_len'      : 50 / 1000,
+        'threshold'     : 100,
+        'stepsize_ratio': 0.5
+    },
+    '64ms' : {
+        'name'          : '64ms',
+        'time_len'      : 64 / 1000,
+        'threshold'     : 100,
+        'stepsize_ratio': 0.5
+    },
+    '128ms': {
+        'name'          : '128ms',
+        'time_len'      : 128 / 1000,
+        'threshold'     : 200,  # 100?
+        'stepsize_ratio': 0.5
+    },
+    '256ms': {
+        'name'          : '256ms',
+        'time_len'      : 256 / 1000,
+        'threshold'     : 400,
+        'stepsize_ratio': 256 / 1000 / 2
+    },
+    '1s'   : {
+        'name'          : '1s',
+        'time_len'      : 1,
+        'threshold'     : 800,
+        'stepsize_ratio': 0.5,
+    },
+}
+
+
+def get_segment_para(clip_len, fs=16000, threshold=None):
+    '''
+    :param clip_len: a key of segment_para_set
+    :param threshold: optional, replaces the drop threshold of the parameter set
+    :return: the parameters of the clips (with the stepsize in s), and the name of their dataset directory
+    '''
+    seg_para = dict(segment_para_set[clip_len])
+    if threshold is not None:
+        seg_para['threshold'] = threshold
+    seg_para['stepsize'] = seg_para['stepsize_ratio'] * seg_para['time_len']
+    seg_ds_name = '_'.join([seg_para['name'], str(round(seg_para['stepsize'], 2)), str(seg_para['threshold']), str(fs)])
+    return seg_para, seg_ds_name
+
 
 def decode_dir(d_path):
     '''
@@ -60,9 +124,24 @@ def decode_walker_name(walker_name, doa=True):
         return walker_name.split('_')[1:4]
 
 
-def print_info_of_walker_and_sound_source(dataset_path):
+def list_wav_files(ds_path, catalog=None):
+    '''
+    the .wav files of ds_path, by os.walk, or from a DatasetCatalog (refreshed first: only the directories that changed
+    since the last refresh are listed again)
+    '''
+    if catalog is not None:
+        catalog.refresh(ds_path)
+    return get_files_by_suffix(ds_path, '.wav', catalog=catalog)
+
+
+def print_info_of_walker_and_sound_source(dataset_path, catalog=None):
+    '''
+    :param catalog: optional DatasetCatalog of dataset_path, the 3 listings below are then queries of the catalog
+    '''
+    if catalog is not None:
+        catalog.refresh(dataset_path)
     print('-' * 20, 'info of smart walker', '-' * 20, )
-    wk_dirs = get_dirs_by_prefix(dataset_path, 'walker_')
+    wk_dirs = get_dirs_by_prefix(dataset_path, 'walker_', catalog=catalog)
     wk_x, wk_y, wk_z, = set(), set(), set(),
     for i in wk_dirs:
         _, temp_x, temp_y, temp_z = decode_dir(i)
@@ -73,7 +152,7 @@ def print_info_of_walker_and_sound_source(dataset_path):
     print('x:', sorted(wk_x), '\n', 'y:', sorted(wk_y), '\n', 'z:', sorted(wk_z), )
     
     print('-' * 20 + 'info of sound source' + '-' * 20, )
-    ss_dirs = get_dirs_by_prefix(dataset_path, 'src_')
+    ss_dirs = get_dirs_by_prefix(dataset_path, 'src_', catalog=catalog)
     s_x, s_y, = set(), set(),
     for i in ss_dirs:
         _, temp_x, temp_y, = decode_dir(i)
@@ -83,10 +162,9 @@ def print_info_of_walker_and_sound_source(dataset_path):
     print('x:', sorted(s_x), '\n', 'y:', sorted(s_y), )
     
     print('-' * 20 + 'info of direction of arrival (doa)' + '-' * 20, )
-    wk_dirs = get_dirs_by_prefix(dataset_path, 'walker_')
     doa = set()
     for i in wk_dirs:
-        subdirs = get_subdirs_by_suffix(i, )
+        subdirs = get_subdirs_by_suffix(i, catalog=catalog)
         for j in subdirs:
             temp_doa = os.path.basename(j)
             doa.add(temp_doa)
@@ -127,7 +205,8 @@ def plot_map(dataset_path):
             print(list(room_map[i]))
 
 
-def clip_audio(src_dspath, des_dspath, seg_len, stepsize, fs=16000, window='hann', pow_2=False):
+def clip_audio(src_dspath, des_dspath, seg_len, stepsize, fs=16000, window='hann', pow_2=False, layout='per_mic',
+               catalog=None, cache=None, ):
     '''
     Clip the audio into segments to segment_len in secs and save them into dir_name
     :param src_dspath: 长片段语音所在的数据集根目录
@@ -136,10 +215,20 @@ def clip_audio(src_dspath, des_dspath, seg_len, stepsize, fs=16000, window='hann
     :param stepsize: 相邻clip间的步长大小(单位 s)
     :param fs: 采样率
     :param window: 为 clip 加窗
+    :param layout: 'per_mic' (record_mic{i}.wav -> seg_{i}/record_mic{i}.wav) or 'interleaved' (record_mics.wav ->
+            seg_{i}/record_mics.wav, all the channels of a clip in one file)
+    :param catalog: optional DatasetCatalog to list the files of src_dspath (see list_wav_files)
+    :param cache: optional StageCache, a recording is segmented again only if its content or the parameters changed
     :return: 无返回值
     '''
     'dataset -> ds  ;  data -> dt  ;    file -> f  ;   dir -> d  '
-    files = get_files_by_suffix(src_dspath, '.wav')
+    assert layout in ['per_mic', 'interleaved']
+    params = {'seg_len': seg_len, 'stepsize': stepsize, 'fs': fs, 'window': window, 'pow_2': pow_2, 'layout': layout, }
+    files = list_wav_files(src_dspath, catalog=catalog)
+    if layout == 'interleaved':
+        files = [i for i in files if os.path.basename(i) == MICS_FILE_NAME]
+    else:
+        files = [i for i in files if is_mic_file(i)]
     
     def single_Process(files, ):
         for file in tqdm(files):
@@ -149,9 +238,17 @@ def clip_audio(src_dspath, des_dspath, seg_len, stepsize, fs=16000, window='hann
             dst_doa_dir = os.path.join(des_dspath, rel_path, )
             # print('src_doa_dir:', src_doa_dir)
             # print('dst_doa_dir:', dst_doa_dir)
+            if cache is not None:  # the unit is the recording file, its clips are in the seg_{i} folders
+                unit = os.path.join(dst_doa_dir, os.path.basename(file))
+                key = cache.get_key('clip_audio', [file], params)
+                if cache.is_fresh(unit, key):  # and all its clips still exist
+                    continue
             # segment the audio
-            audio_segmenter_4_file(file, dst_doa_dir, segment_len=seg_len, stepsize=stepsize, fs=fs, window=window,
-                                   padding=False, pow_2=pow_2, save2segFolders=True)
+            clip_paths = audio_segmenter_4_file(file, dst_doa_dir, segment_len=seg_len, stepsize=stepsize, fs=fs,
+                                                window=window, padding=False, pow_2=pow_2, save2segFolders=True,
+                                                multi_channel=(layout == 'interleaved'))
+            if cache is not None:
+                cache.record(unit, key, outputs=clip_paths)
             
             # # 验证每一个seg folder中均有4通道信号
             # for sub_dpath in get_subdirs_by_suffix(dst_doa_dir):
@@ -170,58 +267,390 @@ def clip_audio(src_dspath, des_dspath, seg_len, stepsize, fs=16000, window='hann
         process.join()
 
 
-def preprocessing_audio_with_norm_denoise_drop(src_dspath, fs=16000, threshold=None):
+def run_denoise_service(tasks, single_task, num_process=8, num_thread=4, model_path='./ns_nsnet2-20ms-baseline.onnx',
+                        return_outputs=False, **session_kwargs):
+    '''
+    denoise service: a small pool of worker processes, each owning one explicitly sized NSNet2 session, fed by a queue
+    of tasks
+    :param tasks: list of work units
+    :param single_task: function (denoise_model, task) -> number of segments processed
+    :param num_process: number of worker processes (i.e. sessions / model copies)
+    :param num_thread: intra-op threads of each session
+    :param return_outputs: if True, single_task returns (number of segments processed, output), and the outputs of all
+            the tasks are gathered into metrics['outputs']
+    :param session_kwargs: other keyword arguments of ns_enhance_onnx.get_session_options
+    :return: metrics of the stage
+    a failed task does not stop its worker (the other tasks are still processed), and the stage raises a
+    RuntimeError with the tracebacks once all the workers are done, or as soon as a worker process dies
+    '''
+    session_kwargs.setdefault('inter_op_num_threads', 1)
+    task_queue, result_queue = Queue(), Queue()
+    for task in tasks:
+        task_queue.put(task)
+    for _ in range(num_process):
+        task_queue.put(None)
+    
+    def worker(worker_id):
+        num_segment, outputs, errors = 0, [], []
+        start_time = time.time()
+        try:
+            denoise_model, _ = load_onnx_model(model_path=model_path, intra_op_num_threads=num_thread,
+                                               **session_kwargs)
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    break
+                try:
+                    if return_outputs:
+                        task_num_segment, output = single_task(denoise_model, task)
+                        outputs.append(output)
+                    else:
+                        task_num_segment = single_task(denoise_model, task)
+                    num_segment += task_num_segment
+                except Exception:  # e.g. an unreadable wav, the next tasks are still processed
+                    errors.append(traceback.format_exc())
+        except Exception:  # e.g. the model can not be loaded, the other workers take the tasks
+            errors.append(traceback.format_exc())
+        finally:  # always put a result, the main process waits for one per worker
+            result_queue.put((worker_id, num_segment, time.time() - start_time, outputs, errors))
+    
+    start_time = time.time()
+    processes = []
+    for i in range(num_process):
+        processes.append(Process(target=worker, args=(i,)))
+        processes[-1].start()
+    results = {}
+    while len(results) < num_process:
+        try:
+            result = result_queue.get(timeout=1)
+            results[result[0]] = result
+        except Empty:
+            # a worker killed without putting its result (e.g. by a signal or out of memory)
+            dead = [i for i, process in enumerate(processes) if (i not in results) and (process.exitcode or 0) != 0]
+            if len(dead):
+                for process in processes:
+                    process.terminate()
+                raise RuntimeError(f'denoise workers {dead} died (exit codes '
+                                   f'{[processes[i].exitcode for i in dead]})')
+    for process in processes:
+        process.join()
+    results = [results[i] for i in range(num_process)]
+    errors = [error for i in results for error in i[4]]
+    if len(errors):
+        for error in errors:
+            print(error)
+        raise RuntimeError(f'{len(errors)} denoise task(s) failed, see the tracebacks above')
+    
+    elapsed = time.time() - start_time
+    num_segment = sum([i[1] for i in results])
+    metrics = {
+        'num_process'   : num_process,
+        'num_thread'    : num_thread,
+        'num_task'      : len(tasks),
+        'num_segment'   : num_segment,
+        'elapsed'       : elapsed,
+        'segment_per_s' : num_segment / max(elapsed, EPS),
+        'worker_elapsed': [i[2] for i in results],
+    }
+    if return_outputs:
+        metrics['outputs'] = [output for i in results for output in i[3]]
+    print('-' * 20, 'denoise service', '-' * 20, '\n',
+          'pool size:', num_process, '\t', 'threads per session:', num_thread, '\n',
+          'segments:', num_segment, '\t', 'elapsed: {:.1f} s'.format(elapsed), '\t',
+          'throughput: {:.1f} segments/s'.format(metrics['segment_per_s']), )
+    return metrics
+
+
+def preprocessing_audio_with_norm_denoise_drop(src_dspath, fs=16000, threshold=None, batch_size=64, num_process=8,
+                                               num_thread=4, multi_channel=False, gain_ref='mean', catalog=None,
+                                               cache=None, model_path='./ns_nsnet2-20ms-baseline.onnx', ):
+    '''
+    normalize, denoise (NSNet2) and drop the audio clips of src_dspath
+    :param batch_size: number of clips denoised by one run of the model (number of segments per task if multi_channel)
+    :param num_process: number of denoise worker processes (see run_denoise_service)
+    :param num_thread: intra-op threads of the onnxruntime session of each worker
+    :param multi_channel: if True, the 4 channels of a segment are normalized together and denoised with one shared
+            gain mask (see NSnet2Enhancer.multi_channel_call), and the segment is dropped as a whole if any channel
+            fails the drop checks. The drop decisions are not the same as the per-clip mode followed by
+            clean_audio_clips: the norm scalar and the gain are shared by the channels instead of per channel
+    :param gain_ref: how the shared gain is estimated in multi_channel mode
+    :param catalog: optional DatasetCatalog to list the files of src_dspath (see list_wav_files)
+    :param cache: optional StageCache, a clip (a segment if multi_channel) is processed again only if its content, the
+            parameters or the model changed; a clip dropped by the new parameters has its old output removed
+    :return: metrics of the stage
+    '''
     'dataset -> ds  ;  data -> dt  ;    file -> f  ;   dir -> d  '
-    files = get_files_by_suffix(src_dspath, '.wav')
+    files = list_wav_files(src_dspath, catalog=catalog)
+    params = {'fs': fs, 'threshold': threshold, 'multi_channel': multi_channel, 'gain_ref': gain_ref,
+              'model': cache.file_hash(model_path) if cache is not None else None, }
     
-    def single_Process(files, ):
-        denoise_model, _ = load_onnx_model(model_path='./ns_nsnet2-20ms-baseline.onnx')
-        for fpath in tqdm(files):
-            ini_audio, ini_fs = audioread(fpath)
+    def get_todo(units, get_inputs, ):
+        '''
+        :return: [(unit, key)] of the units to process (the key is None without cache)
+        '''
+        todo = []
+        for unit in units:
+            dst_unit = unit.replace('ini_hann', 'ini_hann_norm_denoise_drop')
+            key = None if cache is None else cache.get_key('norm_denoise_drop', get_inputs(unit), params)
+            if (cache is None) or not cache.is_fresh(dst_unit, key):  # a kept unit also needs its output
+                todo.append((unit, key))
+        return todo
+    
+    def record(unit, key, dropped, ):
+        if cache is None:
+            return
+        dst_unit = unit.replace('ini_hann', 'ini_hann_norm_denoise_drop')
+        if dropped and os.path.isdir(dst_unit):  # kept by the previous parameters
+            shutil.rmtree(dst_unit, ignore_errors=True)
+        elif dropped and os.path.exists(dst_unit):
+            os.remove(dst_unit)
+        cache.record(dst_unit, key, outputs=[] if dropped else [dst_unit])
+    
+    def doDrop(de_norm_audio):
+        if audio_energy_over_threshold(de_norm_audio, threshold=REF_AUDIO_THRESHOLD) and \
+                audio_energy_ratio_over_threshold(de_norm_audio, fs=fs, threshold=threshold, ):
+            return False
+        else:
+            return True
+    
+    def single_task(denoise_model, files, ):
+        keys = dict(get_todo(files, lambda fpath: [fpath]))
+        # every channel is a clip: 1 per record_mic{i}.wav, all of them for record_mics.wav
+        norm_audio_ls, norm_scalar_ls = {}, {}  # audio length -> clips of that length in the batch
+        for fpath in keys.keys():
+            ini_audio, ini_fs = audioread_channels(fpath, dtype='float64')
             assert ini_fs == fs
             
-            audio = np.array(ini_audio)
-            # norm
+            for channel, audio in enumerate(ini_audio):
+                # norm
+                norm_audio, norm_scalar = normalize_single_channel_audio(audio, returnScalar=True)
+                norm_audio_ls.setdefault(len(audio), []).append(((fpath, channel), norm_audio))
+                norm_scalar_ls[(fpath, channel)] = norm_scalar
+        
+        de_audio_ls = {}  # fpath -> denoised channels, None once a channel is dropped
+        for clips in norm_audio_ls.values():
+            # denoise
+            de_norm_audio_ls = denoise_nsnet2_batch(audio_ls=[i[1] for i in clips], fs=fs, model=denoise_model, )
+            for ((fpath, channel), _), de_norm_audio in zip(clips, de_norm_audio_ls):
+                de_audio = de_audio_ls.setdefault(fpath, {})
+                # drop (a multi-channel file is dropped as a whole, as clean_audio_clips does for the seg_{i} folders)
+                if (de_audio is None) or doDrop(de_norm_audio):
+                    de_audio_ls[fpath] = None
+                else:
+                    de_audio[channel] = de_norm_audio / norm_scalar_ls[(fpath, channel)]
+        for fpath, de_audio in de_audio_ls.items():
+            if de_audio is None:
+                record(fpath, keys[fpath], dropped=True)
+                continue
+            dst_fpath = fpath.replace('ini_hann', 'ini_hann_norm_denoise_drop')
+            assert dst_fpath != fpath
+            if len(de_audio) == 1:
+                audiowrite(destpath=dst_fpath, audio=de_audio[0], sample_rate=fs, norm=False, clipping_threshold=None, )
+            else:
+                audiowrite_channels(dst_fpath, [de_audio[i] for i in range(len(de_audio))], sample_rate=fs)
+            record(fpath, keys[fpath], dropped=False)
+        return len(keys)
+    
+    def single_multi_channel_task(denoise_model, seg_dirs, ):
+        todo = get_todo(seg_dirs, lambda seg_dir: seg_files[seg_dir])
+        for seg_dir, key in todo:
+            audio, seg_fs = read_mic_dir(seg_dir, dtype='float64')
+            assert len(audio) == 4 and seg_fs == fs
+            
+            # norm (one scalar for all the channels, to keep their relative levels)
             norm_audio, norm_scalar = normalize_single_channel_audio(audio, returnScalar=True)
             # denoise
-            de_norm_audio = denoise_nsnet2(audio=norm_audio, fs=fs, model=denoise_model, )
+            de_norm_audio = denoise_nsnet2(audio=norm_audio.T, fs=fs, model=denoise_model, multi_channel=True,
+                                           gain_ref=gain_ref, )
             # drop
+            if any([doDrop(i) for i in de_norm_audio]):
+                record(seg_dir, key, dropped=True)
+                continue
+            dst_seg_dir = seg_dir.replace('ini_hann', 'ini_hann_norm_denoise_drop')
+            assert dst_seg_dir != seg_dir
+            if os.path.exists(os.path.join(seg_dir, MICS_FILE_NAME)):
+                audiowrite_channels(os.path.join(dst_seg_dir, MICS_FILE_NAME), de_norm_audio / norm_scalar,
+                                    sample_rate=fs)
+                record(seg_dir, key, dropped=False)
+                continue
+            mic_path_ls = sorted([i for i in get_subfiles_by_suffix(root=seg_dir, suffix='.wav') if is_mic_file(i)])
+            for fpath, de_channel_audio in zip(mic_path_ls, de_norm_audio / norm_scalar):
+                dst_fpath = fpath.replace('ini_hann', 'ini_hann_norm_denoise_drop')
+                assert dst_fpath != fpath
+                audiowrite(destpath=dst_fpath, audio=de_channel_audio, sample_rate=fs, norm=False,
+                           clipping_threshold=None, )
+            record(seg_dir, key, dropped=False)
+        return len(todo)
+    
+    if multi_channel:
+        seg_files = {}
+        for fpath in sorted(files):
+            seg_files.setdefault(os.path.dirname(fpath), []).append(fpath)
+        seg_dirs = sorted(seg_files.keys())
+        tasks = [seg_dirs[i:i + batch_size] for i in range(0, len(seg_dirs), batch_size)]
+        return run_denoise_service(tasks, single_multi_channel_task, num_process=num_process, num_thread=num_thread,
+                                   model_path=model_path, )
+    else:
+        tasks = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+        return run_denoise_service(tasks, single_task, num_process=num_process, num_thread=num_thread,
+                                   model_path=model_path, )
+
+
+def get_denoise_recording_key(cache, fpath, fs, model_path):
+    '''
+    key of the normalized and denoised whole recording of fpath (the '_norm_denoise' cache of the recordings): the
+    content of the recording, fs and the model
+    :return: None without cache
+    '''
+    if cache is None:
+        return None
+    return cache.get_key('norm_denoise_recording', [fpath], {'fs': fs, 'model': cache.file_hash(model_path), })
+
+
+def preprocessing_recording_with_norm_denoise_drop(src_dspath, ini_seg_dspath, seg_len, stepsize, fs=16000,
+                                                   window='hann', pow_2=False, threshold=None, num_process=8,
+                                                   num_thread=4, catalog=None, cache=None,
+                                                   model_path='./ns_nsnet2-20ms-baseline.onnx', ):
+    '''
+    Another order of clip_audio + preprocessing_audio_with_norm_denoise_drop: every recording is normalized and
+    denoised as a whole only once (and cached in src_dspath + '_norm_denoise', shared by all the segment_para_set),
+    then segmented. The drop decisions are made on each segment as before, and the kept segments are saved in the
+    same layout as preprocessing_audio_with_norm_denoise_drop.
+    Note that the window is applied after denoising here, and the whole recording (not each clip) is normalized
+    before denoising.
+    :param src_dspath: 长片段语音所在的数据集根目录 (e.g. 'initial')
+    :param ini_seg_dspath: 数据集根目录 of the clips (e.g. '1s_0.5_800_16000/ini_hann'), the kept clips are saved into
+            ini_seg_dspath + '_norm_denoise_drop'
+    :param seg_len: clip 的长度 (单位为 s)
+    :param stepsize: 相邻clip间的步长大小(单位 s)
+    :param cache: optional StageCache, a cached denoised recording is reused only if the recording, fs and the model
+            did not change (see get_denoise_recording_key); without it, whenever it exists
+    :return: metrics of the stage
+    '''
+    'dataset -> ds  ;  data -> dt  ;    file -> f  ;   dir -> d  '
+    files = [i for i in list_wav_files(src_dspath, catalog=catalog) if is_mic_file(i)]
+    cache_dspath = add_prefix_and_suffix_4_basename(src_dspath, suffix='_norm_denoise')
+    dst_dspath = add_prefix_and_suffix_4_basename(ini_seg_dspath, suffix='_norm_denoise_drop')
+    
+    def single_task(denoise_model, fpath, ):
+        rel_path = os.path.relpath(fpath, start=src_dspath, )
+        audio, ini_fs = audioread(fpath)
+        assert ini_fs == fs
+        
+        # norm and denoise the whole recording once
+        cache_fpath = os.path.join(cache_dspath, rel_path)
+        key = get_denoise_recording_key(cache, fpath, fs, model_path)
+        if os.path.exists(cache_fpath) and ((cache is None) or cache.is_fresh(cache_fpath, key)):
+            de_audio, _ = audioread(cache_fpath)
+        else:
+            norm_audio, norm_scalar = normalize_single_channel_audio(audio, returnScalar=True)
+            de_audio = denoise_nsnet2(audio=norm_audio, fs=fs, model=denoise_model, ) / norm_scalar
+            # temp file + rename: the cache is reused as soon as it exists
+            audiowrite_atomically(cache_fpath, de_audio, sample_rate=fs)
+            if cache is not None:
+                cache.record(cache_fpath, key, outputs=[cache_fpath])
+        
+        # segment (views of the recordings, every clip is windowed when it is used)
+        audio_segments = audio_segmenter_4_numpy(audio, segment_len=seg_len, stepsize=stepsize, fs=fs,
+                                                 window=None, padding=False, pow_2=pow_2, return_view=True)
+        de_audio_segments = audio_segmenter_4_numpy(de_audio[:len(audio)], segment_len=seg_len, stepsize=stepsize,
+                                                    fs=fs, window=None, padding=False, pow_2=pow_2, return_view=True)
+        win = get_window(window, audio_segments.shape[-1])
+        for i, (audio_seg, de_audio_seg) in enumerate(zip(audio_segments, de_audio_segments)):
+            audio_seg, de_audio_seg = audio_seg * win, de_audio_seg * win
+            # drop, judged on the denoised clip at the level of the normalized clip (as if it was denoised alone)
+            _, norm_scalar = normalize_single_channel_audio(audio_seg, returnScalar=True)
+            de_norm_audio = de_audio_seg * norm_scalar
             if audio_energy_over_threshold(de_norm_audio, threshold=REF_AUDIO_THRESHOLD) and \
                     audio_energy_ratio_over_threshold(de_norm_audio, fs=fs, threshold=threshold, ):
-                doDrop = False
+                dst_fpath = os.path.join(dst_dspath, os.path.dirname(rel_path), 'seg_' + str(i),
+                                         os.path.basename(fpath))
+                audiowrite(destpath=dst_fpath, audio=de_audio_seg, sample_rate=fs, norm=False,
+                           clipping_threshold=None, )
+        return len(audio_segments)
+    
+    return run_denoise_service(files, single_task, num_process=num_process, num_thread=num_thread,
+                               model_path=model_path, )
+
+
+def preprocessing_index_with_norm_denoise_drop(index, threshold=None, num_process=8, num_thread=4, cache=None,
+                                               model_path='./ns_nsnet2-20ms-baseline.onnx', ):
+    '''
+    preprocessing_recording_with_norm_denoise_drop on a SegmentIndex: every recording of index is normalized and
+    denoised as a whole once (cached in index.root + '_norm_denoise'), and the drop decisions are made on the segments
+    materialized from the memory-mapped recordings, without writing any wav per segment. A segment is kept only if all
+    its channels pass (as the drop + clean_audio_clips of the kept mic files)
+    :param index: SegmentIndex over the initial recordings (e.g. 'initial')
+    :param cache: optional StageCache, a cached denoised recording is reused only if the recording, fs and the model
+            did not change (see get_denoise_recording_key); without it, whenever it exists
+    :return: SegmentIndex of the kept segments over the denoised recordings, and the metrics of the stage
+    '''
+    fs = index.fs
+    cache_dspath = add_prefix_and_suffix_4_basename(index.root, suffix='_norm_denoise')
+    groups = index.groups()
+    
+    def single_task(denoise_model, rec_id, ):
+        # norm and denoise the whole recording once
+        for mic_name in index.mic_names:
+            rel_path = os.path.join(index.recordings[rec_id], mic_name)
+            cache_fpath = os.path.join(cache_dspath, rel_path)
+            key = get_denoise_recording_key(cache, os.path.join(index.root, rel_path), fs, model_path)
+            if (not os.path.exists(cache_fpath)) or ((cache is not None) and not cache.is_fresh(cache_fpath, key)):
+                audio, ini_fs = audioread_channels(os.path.join(index.root, rel_path), dtype='float64')
+                assert ini_fs == fs
+                de_audio = []
+                for channel_audio in audio:
+                    norm_audio, norm_scalar = normalize_single_channel_audio(channel_audio, returnScalar=True)
+                    de_audio.append(denoise_nsnet2(audio=norm_audio, fs=fs, model=denoise_model, ) / norm_scalar)
+                # temp file + rename: the cache is reused as soon as it exists
+                audiowrite_atomically(cache_fpath, de_audio[0] if len(de_audio) == 1 else de_audio, sample_rate=fs)
+                if cache is not None:
+                    cache.record(cache_fpath, key, outputs=[cache_fpath])
+        
+        kept = []
+        for i in groups[rec_id]:
+            audio_seg = index.get_segment(i)
+            de_audio_seg = index.get_segment(i, root=cache_dspath)
+            for audio_channel, de_channel in zip(audio_seg, de_audio_seg):
+                # drop, judged on the denoised clip at the level of the normalized clip (as if it was denoised alone)
+                _, norm_scalar = normalize_single_channel_audio(audio_channel, returnScalar=True)
+                de_norm_audio = de_channel * norm_scalar
+                if not (audio_energy_over_threshold(de_norm_audio, threshold=REF_AUDIO_THRESHOLD) and
+                        audio_energy_ratio_over_threshold(de_norm_audio, fs=fs, threshold=threshold, )):
+                    break
             else:
-                doDrop = True
-            
-            if not doDrop:
-                dst_fpath = fpath.replace('ini_hann', 'ini_hann_norm_denoise_drop')
-                assert dst_fpath != fpath
-                os.makedirs(os.path.dirname(dst_fpath), exist_ok=True)
-                de_audio = de_norm_audio / norm_scalar
-                audiowrite(destpath=dst_fpath, audio=de_audio, sample_rate=fs, norm=False, clipping_threshold=None, )
+                kept.append(i)
+        return len(groups[rec_id]), kept
     
-    processes = []
-    num_process = 128
-    for i in range(num_process):
-        processes.append(Process(target=single_Process, args=(files[i::num_process],)))
-        processes[-1].start()
-        # print(f'Process_{i} started', )
-    for process in processes:
-        process.join()
+    metrics = run_denoise_service(list(groups.keys()), single_task, num_process=num_process, num_thread=num_thread,
+                                  model_path=model_path, return_outputs=True, )
+    kept = np.sort(np.concatenate([np.zeros(0, dtype=int)] + [np.asarray(i, dtype=int) for i in metrics.pop('outputs')]))
+    print('kept segments:', len(kept), '/', len(index))
+    return index.copy(kept, root=cache_dspath), metrics
 
 
-def clean_audio_clips(ds_path):
-    files = get_files_by_suffix(ds_path, '.wav')
+def clean_audio_clips(ds_path, catalog=None, cache=None):
+    '''
+    remove the seg_{i} folders that lost a mic file in the drop
+    :param cache: optional StageCache of the drop, the removed clips stay fresh (they are not denoised again)
+    '''
+    files = list_wav_files(ds_path, catalog=catalog)
+    # the files of every seg_dir, from the listing above instead of walking every seg_dir again
+    seg_files = {}
+    for fpath in files:
+        seg_files.setdefault(os.path.dirname(fpath), []).append(os.path.basename(fpath))
     
     def single_Process(files, ):
         for fpath in tqdm(files):
             seg_dir = os.path.dirname(fpath)
-            seg_files = get_files_by_suffix(seg_dir, '.wav')
-            if len(seg_files) < 4:
+            if (len(seg_files[seg_dir]) < 4) and (MICS_FILE_NAME not in seg_files[seg_dir]):
                 try:
                     shutil.rmtree(seg_dir, ignore_errors=True, )
                     print('seg_dir:', seg_dir)
                 except:
                     pass
+                if cache is not None:
+                    cache.remove_outputs(fpath)
     
     processes = []
     num_process = 64
@@ -233,18 +662,32 @@ def clean_audio_clips(ds_path):
         process.join()
 
 
-def preprocessing_audio_with_norm_denoise_drop_norm(src_dspath):
+def preprocessing_audio_with_norm_denoise_drop_norm(src_dspath, fs=16000, catalog=None, cache=None):
+    '''
+    :param cache: optional StageCache, a clip is normalized again only if its content changed
+    '''
     'dataset -> ds  ;  data -> dt  ;    file -> f  ;   dir -> d  '
-    files = get_files_by_suffix(src_dspath, '.wav')
+    files = list_wav_files(src_dspath, catalog=catalog)
     
     def single_Process(files, ):
         for fpath in tqdm(files):
-            ini_audio, ini_fs = audioread(fpath)
-            assert ini_fs == fs
             dst_fpath = fpath.replace('ini_hann_norm_denoise_drop', 'ini_hann_norm_denoise_drop_norm')
             assert dst_fpath != fpath
+            if cache is not None:
+                key = cache.get_key('norm', [fpath], {'fs': fs, })
+                if cache.is_fresh(dst_fpath, key, outputs=[dst_fpath]):
+                    continue
+            ini_audio, ini_fs = audioread_channels(fpath, dtype='float64')
+            assert ini_fs == fs
             
-            audiowrite(destpath=dst_fpath, audio=ini_audio, sample_rate=ini_fs, norm=True, clipping_threshold=None, )
+            if len(ini_audio) == 1:
+                audiowrite(destpath=dst_fpath, audio=ini_audio[0], sample_rate=ini_fs, norm=True,
+                           clipping_threshold=None, )
+            else:  # every channel is normalized on its own, as the per-mic files
+                audiowrite_channels(dst_fpath, [normalize_single_channel_audio(i) for i in ini_audio],
+                                    sample_rate=ini_fs)
+            if cache is not None:
+                cache.record(dst_fpath, key, outputs=[dst_fpath])
     
     processes = []
     num_process = 64
@@ -256,108 +699,169 @@ def preprocessing_audio_with_norm_denoise_drop_norm(src_dspath):
         process.join()
 
 
+def export_per_mic_layout(src_dspath, catalog=None):
+    '''
+    compatibility export: write the channels of every record_mics.wav of src_dspath next to it, as record_mic{i}.wav
+    '''
+    files = [i for i in list_wav_files(src_dspath, catalog=catalog) if os.path.basename(i) == MICS_FILE_NAME]
+    
+    def single_Process(files, ):
+        for fpath in tqdm(files):
+            split_mics_file(fpath)
+    
+    processes = []
+    num_process = 64
+    for i in range(num_process):
+        processes.append(Process(target=single_Process, args=(files[i::num_process],)))
+        processes[-1].start()
+    for process in processes:
+        process.join()
+
+
 def extract_features(src_dspath, dst_dspath, feature_type, num_gcc_bin=128,
-                     fft_seg_len=None, fft_stepsize_ratio=None, fs=16000, ):
+                     fft_seg_len=None, fft_stepsize_ratio=None, fs=16000, catalog=None, store=False, shard_size=4096,
+                     cache=None, ):
+    '''
+    extract features of every 4-channel segment in src_dspath. Each segment is a single work unit and is read only
+    once, no matter how many features are requested
+    :param src_dspath: 数据集根目录, or a SegmentIndex (the segments are then materialized from the recordings, and
+            one work unit is one recording)
+    :param dst_dspath: 保存特征的数据集根目录; a list of them if feature_type is a list (one per feature type)
+    :param feature_type: a feature type or a list of them, e.g. ['gcc_phat', 'stft']
+    :param catalog: optional DatasetCatalog to list the segments of src_dspath (see list_wav_files)
+    :param store: if True, every dst_dspath is a FeatureStore (shards of shard_size features, one writer per process)
+            instead of a tree of record_mics.npz, one per segment
+    :param cache: optional StageCache, a feature is extracted again only if the content of its segment or the
+            parameters changed, instead of only checking that it exists
+    :return: 无返回值, the labels of the segments are saved next to every dst_dspath (dst_dspath + '_labels.npz', see
+            LabelTable)
+    '''
     feature_ls = ['gcc_phat', 'stft']
-    assert feature_type in feature_ls, f'{feature_type} is not supported yet (only support {feature_ls} now).'
-    files = get_files_by_suffix(src_dspath, '.wav')
+    feature_types = [feature_type] if isinstance(feature_type, str) else list(feature_type)
+    dst_dspaths = [dst_dspath] if isinstance(dst_dspath, str) else list(dst_dspath)
+    assert len(feature_types) == len(dst_dspaths), 'each feature type needs its own dst_dspath'
+    for i in feature_types:
+        assert i in feature_ls, f'{i} is not supported yet (only support {feature_ls} now).'
+    index = src_dspath if isinstance(src_dspath, SegmentIndex) else None
+    if index is not None:
+        # one work unit per recording, its segments are read from the same memmaps
+        groups = index.groups()
+        units = [groups[i] for i in sorted(groups.keys())]
+    else:
+        # one work unit per 4-channel segment (seg_i directory), not per mic file
+        seg_files = {}
+        for fpath in sorted(list_wav_files(src_dspath, catalog=catalog)):
+            seg_files.setdefault(os.path.dirname(fpath), []).append(fpath)
+        units = sorted(seg_files.keys())
+    # the segments already in the stores are skipped, as the existing record_mics.npz files
+    stored_keys = [set(FeatureStore(i).keys.tolist()) if store else set() for i in dst_dspaths]
+    run_stamp = time.strftime('%Y%m%d%H%M%S') + '_' + str(os.getpid())
     
-    def single_Process(files, ):
+    params = {'num_gcc_bin': num_gcc_bin, 'fft_seg_len': fft_seg_len, 'fft_stepsize_ratio': fft_stepsize_ratio,
+              'fs': fs, }
+    
+    def load_segment(unit, ):
+        '''
+        :return: (rel_path, read, inputs, segment parameters) of the segments of unit
+        '''
+        if index is not None:
+            inputs = [os.path.join(index.root, index.recordings[index.rec_id[unit[0]]], i) for i in index.mic_names]
+            for i in unit:
+                yield index.rel_path(i), (lambda i=i: index.get_segment(i)), inputs, \
+                      {'start': index.start[i], 'length': index.length[i], 'window': index.window, 'norm': index.norm}
+            return
+        seg_dir = unit
+        
+        def read():
+            audio, seg_fs = read_mic_dir(seg_dir, dtype='float64')  # one read in the interleaved layout
+            assert len(audio) == 4 and seg_fs == fs
+            return audio
+        
+        yield os.path.relpath(seg_dir, start=src_dspath, ), read, seg_files[seg_dir], {}
+    
+    def single_Process(units, process_id=0, ):
         fe = audioFeatureExtractor(num_channel=4, fs=fs, num_gcc_bin=num_gcc_bin, fft_seg_len=fft_seg_len,
                                    fft_stepsize_ratio=fft_stepsize_ratio, datatype='mic', )
-        for fpath in tqdm(files):
-            # get dst_fpath to save feature
-            rel_path = os.path.relpath(fpath, start=src_dspath, )
-            dst_fpath = os.path.join(dst_dspath, rel_path, )
-            assert dst_fpath != fpath
-            dst_fpath = dst_fpath[:-5] + 's.npz'
-            if os.path.exists(dst_fpath):  # prevent processing the same audio repeatedly
+        # float64, as the per-pair get_gcc_phat of the saved features
+        gcc_buffer = np.empty((1, fe.num_pair, num_gcc_bin), dtype=np.float64)
+        # every process appends to its own shards and index part
+        writers = [FeatureStoreWriter(i, name=run_stamp + '_' + str(process_id), shard_size=shard_size)
+                   for i in dst_dspaths] if store else [None] * len(dst_dspaths)
+        for rel_path, read, inputs, seg_params in (segment for unit in tqdm(units) for segment in load_segment(unit)):
+            # get dst_fpath to save each feature
+            todo_ls = []
+            for feature_type, dst_dspath, writer, keys in zip(feature_types, dst_dspaths, writers, stored_keys):
+                dst_fpath = os.path.join(dst_dspath, rel_path, 'record_mics.npz')
+                assert (index is not None) or (os.path.dirname(dst_fpath) != os.path.join(src_dspath, rel_path))
+                exists = (rel_path in keys) if store else os.path.exists(dst_fpath)
+                key = None
+                if cache is not None:  # the key of the feature, instead of only its existence
+                    key = cache.get_key('extract_features', inputs,
+                                        dict(params, feature_type=feature_type, **seg_params))
+                    exists = exists and cache.is_fresh(dst_fpath, key)
+                if not exists:  # prevent processing the same audio repeatedly
+                    # in a store, dst_fpath is only the id of the feature in the cache
+                    todo_ls.append((feature_type, dst_fpath, writer, key))
+            if len(todo_ls) == 0:
                 continue
             
-            audio = []
-            mic_path_ls = sorted(get_subfiles_by_suffix(root=os.path.dirname(fpath), suffix='.wav'))
-            assert len(mic_path_ls) == 4
-            for channel_path in mic_path_ls:
-                channel_audio, channel_fs = audioread(channel_path)
-                assert channel_fs == fs
-                audio.append(channel_audio)
-            audio = np.asarray(audio)
-            
-            # get gcc_feature
-            if feature_type == 'gcc_phat':
-                feature = fe.get_gcc_phat(audio=audio)
-            elif feature_type == 'stft':
-                feature = fe.get_stft(audio=audio, )
-            else:
-                raise ValueError(f'{feature_type} is not supported yet')
-            
-            # save feature
-            os.makedirs(os.path.dirname(dst_fpath), exist_ok=True)
-            np.savez(file=dst_fpath, data=feature)
+            audio = read()
+            for feature_type, dst_fpath, writer, key in todo_ls:
+                if feature_type == 'gcc_phat':
+                    feature = fe.get_gcc_phat_batch(audio=audio[np.newaxis], out=gcc_buffer, dtype=np.float64)[0]
+                elif feature_type == 'stft':
+                    feature = fe.get_stft(audio=audio, )
+                else:
+                    raise ValueError(f'{feature_type} is not supported yet')
+                
+                if store:  # a newer row of a key replaces the older ones (see FeatureStore)
+                    writer.append(rel_path, feature)
+                else:  # save feature (temp file + rename, so that a crashed run never leaves a half-written file)
+                    savez_atomically(dst_fpath, data=feature)
+                if cache is not None:
+                    cache.record(dst_fpath, key, outputs=[] if store else [dst_fpath])
+        for writer in writers:
+            if writer is not None:
+                writer.close()
     
     processes = []
     num_process = 128
     for i in range(num_process):
-        processes.append(Process(target=single_Process, args=(files[i::num_process],)))
+        processes.append(Process(target=single_Process, args=(units[i::num_process], i,)))
         processes[-1].start()
         # print(f'Process_{i} started', )
     for process in processes:
         process.join()
+    
+    for dst_dspath in dst_dspaths:
+        if store:
+            labels = FeatureStore(dst_dspath).get_labels()
+        elif index is not None:
+            labels = LabelTable.from_index(index, stage=os.path.basename(os.path.normpath(dst_dspath)))
+        else:
+            labels = LabelTable.build(dst_dspath, suffix='.npz', catalog=catalog)
+        labels.save(os.path.normpath(dst_dspath) + '_labels.npz')  # not splitext: e.g. '..._stepsize_ratio_0.5'
 
 
 if __name__ == '__main__':
+    # the steps below can also be run by run_pipeline.py: the stages are selected on the command line, run
+    # concurrently when independent, and a restarted run resumes where it stopped
     print('-' * 20 + 'Preprocessing the dateset' + '-' * 20)
     dataset_root = '../dataset/4F_CYC'
     dataset_ini = os.path.join(dataset_root, 'initial')
+    # catalog of all the stages of the dataset, every stage only re-lists the directories that changed
+    catalog = DatasetCatalog(dataset_root)
+    # cache keys of the outputs of the stages, a re-run only recomputes what changed
+    cache = StageCache(os.path.normpath(dataset_root) + '.stage_cache.sqlite')
+    
+    print_info_of_walker_and_sound_source(dataset_ini, catalog=catalog)
     
-    print_info_of_walker_and_sound_source(dataset_ini)
-    
-    segment_para_set = {
-        '32ms' : {
-            'name'          : '32ms',
-            'time_len'      : 32 / 1000,
-            'threshold'     : 100,
-            'stepsize_ratio': 0.5
-        },
-        '50ms' : {
-            'name'          : '50ms',
-            'time_len'      : 50 / 1000,
-            'threshold'     : 100,
-            'stepsize_ratio': 0.5
-        },
-        '64ms' : {
-            'name'          : '64ms',
-            'time_len'      : 64 / 1000,
-            'threshold'     : 100,
-            'stepsize_ratio': 0.5
-        },
-        '128ms': {
-            'name'          : '128ms',
-            'time_len'      : 128 / 1000,
-            'threshold'     : 200,  # 100?
-            'stepsize_ratio': 0.5
-        },
-        '256ms': {
-            'name'          : '256ms',
-            'time_len'      : 256 / 1000,
-            'threshold'     : 400,
-            'stepsize_ratio': 256 / 1000 / 2
-        },
-        '1s'   : {
-            'name'          : '1s',
-            'time_len'      : 1,
-            'threshold'     : 800,
-            'stepsize_ratio': 0.5,
-        },
-    }
     fs = 16000
     window = 'hann'
     assert window == 'hann'  # required by the following code
     clip_len = '1s'
-    seg_para = segment_para_set[clip_len]
-    seg_para['stepsize'] = seg_para['stepsize_ratio'] * seg_para['time_len']
+    seg_para, seg_ds_name = get_segment_para(clip_len, fs=fs)
     pow_2 = False
-    seg_ds_name = '_'.join([seg_para['name'], str(round(seg_para['stepsize'], 2)), str(seg_para['threshold']), str(fs)])
     seg_len = int(seg_para['time_len'] * fs)
     if pow_2:
         seg_len = next_greater_power_of_2(seg_len)
@@ -372,21 +876,42 @@ if __name__ == '__main__':
     ini_seg_dspath = os.path.join(dataset_root, seg_ds_name, 'ini_' + window)
     # print('Start seg...')
     # clip_audio(initial_dspath, ini_seg_dspath, seg_para['time_len'], seg_para['stepsize'], fs, window=window,
-    #            pow_2=pow_2, )
+    #            pow_2=pow_2, catalog=catalog, cache=cache, )
     # print('Finish seg...')
     
     norm_denoise_drop_dspath = add_prefix_and_suffix_4_basename(ini_seg_dspath, suffix='_norm_denoise_drop')
     # print('Start norm_denoise_drop...')
-    # preprocessing_audio_with_norm_denoise_drop(src_dspath=ini_seg_dspath, fs=fs, threshold=float(seg_para['threshold']))
+    # preprocessing_audio_with_norm_denoise_drop(src_dspath=ini_seg_dspath, fs=fs, threshold=float(seg_para['threshold']),
+    #                                            catalog=catalog, cache=cache, )
     # print('Finish norm_denoise_drop...')
     
+    # or: denoise every recording only once, then segment it (instead of clip_audio + norm_denoise_drop above)
+    # print('Start norm_denoise_drop of whole recordings...')
+    # preprocessing_recording_with_norm_denoise_drop(initial_dspath, ini_seg_dspath, seg_para['time_len'],
+    #                                                seg_para['stepsize'], fs=fs, window=window, pow_2=pow_2,
+    #                                                threshold=float(seg_para['threshold']), catalog=catalog,
+    #                                                cache=cache, )
+    # print('Finish norm_denoise_drop of whole recordings...')
+    
+    # or: virtual segmentation, an index of segment offsets in the recordings instead of seg_{i} directories of wav
+    # copies (the features are saved in the same layout, e.g. pass norm_denoise_drop_index to extract_features below)
+    # index_path = os.path.join(dataset_root, seg_ds_name, 'ini_' + window + '_index.npz')
+    # SegmentIndex.build(initial_dspath, seg_para['time_len'], seg_para['stepsize'], fs=fs, window=window,
+    #                    pow_2=pow_2, ).save(index_path)
+    # norm_denoise_drop_index, _ = preprocessing_index_with_norm_denoise_drop(SegmentIndex.load(index_path),
+    #                                                                         threshold=float(seg_para['threshold']),
+    #                                                                         cache=cache, )
+    # norm_denoise_drop_index.save(add_prefix_and_suffix_4_basename(index_path, suffix='_norm_denoise_drop'))
+    # norm_denoise_drop_norm_index = norm_denoise_drop_index.copy(norm=True)
+    
     # print('Start cleaning...')
-    # clean_audio_clips(ds_path=norm_denoise_drop_dspath)
+    # clean_audio_clips(ds_path=norm_denoise_drop_dspath, catalog=catalog, cache=cache, )
     # print('Finish cleaning...')
     
     norm_denoise_drop_norm_dspath = add_prefix_and_suffix_4_basename(ini_seg_dspath, suffix='_norm_denoise_drop_norm')
     # print('Start norm_denoise_drop_norm...')
-    # preprocessing_audio_with_norm_denoise_drop_norm(src_dspath=norm_denoise_drop_dspath, )
+    # preprocessing_audio_with_norm_denoise_drop_norm(src_dspath=norm_denoise_drop_dspath, fs=fs, catalog=catalog,
+    #                                                 cache=cache, )
     # print('Finish norm_denoise_drop_norm...')
     
     ######################### extract features #########################
@@ -400,34 +925,28 @@ if __name__ == '__main__':
     
     ################ without normalization ################
     print('-' * 20, 'without normalization', '-' * 20, )
-    print('Start gcc ...')
+    print('Start gcc and STFT...')
     norm_denoise_drop_gcc_phat_dspath = add_prefix_and_suffix_4_basename(norm_denoise_drop_dspath, suffix=gcc_suffix)
     assert norm_denoise_drop_gcc_phat_dspath != norm_denoise_drop_dspath
-    extract_features(src_dspath=norm_denoise_drop_dspath, dst_dspath=norm_denoise_drop_gcc_phat_dspath, fs=fs,
-                     feature_type='gcc_phat', num_gcc_bin=num_gcc_bin, )
-    print('Finish gcc...')
-    
-    print('Start STFT...')
     norm_denoise_drop_stft_dspath = add_prefix_and_suffix_4_basename(norm_denoise_drop_dspath, suffix=fft_suffix)
     assert norm_denoise_drop_stft_dspath != norm_denoise_drop_dspath
-    extract_features(src_dspath=norm_denoise_drop_dspath, dst_dspath=norm_denoise_drop_stft_dspath, fs=fs,
-                     feature_type='stft', fft_seg_len=fft_seg_len, fft_stepsize_ratio=fft_stepsize_ratio)
-    print('Finish STFT...')
+    extract_features(src_dspath=norm_denoise_drop_dspath, fs=fs, feature_type=['gcc_phat', 'stft'],
+                     dst_dspath=[norm_denoise_drop_gcc_phat_dspath, norm_denoise_drop_stft_dspath],
+                     num_gcc_bin=num_gcc_bin, fft_seg_len=fft_seg_len, fft_stepsize_ratio=fft_stepsize_ratio,
+                     catalog=catalog, cache=cache, )
+    print('Finish gcc and STFT...')
     
     ################ with normalization ################
     print('-' * 20, 'with normalization', '-' * 20, )
-    print('Start gcc...')
+    print('Start gcc and STFT...')
     norm_denoise_drop_norm_gcc_phat_dspath = \
         add_prefix_and_suffix_4_basename(norm_denoise_drop_norm_dspath, suffix=gcc_suffix)
     assert norm_denoise_drop_norm_gcc_phat_dspath != norm_denoise_drop_norm_dspath
-    extract_features(src_dspath=norm_denoise_drop_norm_dspath, dst_dspath=norm_denoise_drop_norm_gcc_phat_dspath, fs=fs,
-                     feature_type='gcc_phat', num_gcc_bin=num_gcc_bin, )
-    print('Finish gcc...')
-    
-    print('Start STFT...')
     norm_denoise_drop_norm_stft_dspath = \
         add_prefix_and_suffix_4_basename(norm_denoise_drop_norm_dspath, suffix=fft_suffix)
     assert norm_denoise_drop_norm_stft_dspath != norm_denoise_drop_norm_dspath
-    extract_features(src_dspath=norm_denoise_drop_norm_dspath, dst_dspath=norm_denoise_drop_norm_stft_dspath, fs=fs,
-                     feature_type='stft', fft_seg_len=fft_seg_len, fft_stepsize_ratio=fft_stepsize_ratio)
-    print('Finish STFT...')
+    extract_features(src_dspath=norm_denoise_drop_norm_dspath, fs=fs, feature_type=['gcc_phat', 'stft'],
+                     dst_dspath=[norm_denoise_drop_norm_gcc_phat_dspath, norm_denoise_drop_norm_stft_dspath],
+                     num_gcc_bin=num_gcc_bin, fft_seg_len=fft_seg_len, fft_stepsize_ratio=fft_stepsize_ratio,
+                     catalog=catalog, cache=cache, )
+    print('Finish gcc and STFT...')
@@ -0,0 +1,390 @@
+import os
+import time
+import wave
+import threading
+import numpy as np
+import soundfile as sf
+from .utils import add_prefix_and_suffix_4_basename
+
+try:
+    from pyaudio import paContinue, paComplete, paInputOverflow
+except ImportError:  # pyaudio is only needed by PyAudioSource, the simulated source works without it
+    paContinue, paComplete, paInputOverflow = 0, 1, 2
+
+# assumed geometry of the 4 mics (in m), clockwise from the upper left corner (as tapped in init_micro_mapping)
+MIC_POSITIONS = np.array([[-0.03, 0.03], [0.03, 0.03], [0.03, -0.03], [-0.03, -0.03], ])
+SOUND_SPEED = 343.
+
+
+class AudioSource(object):
+    def __init__(self, num_channel=4, sample_rate=16000, sample_width=2, chunk=1024):
+        '''
+        interface of a multi-channel 16-bit audio input. start(callback) delivers chunks of interleaved bytes to
+        callback(in_data, frame_count, time_info, status_flags) (the signature of the PyAudio callback), until the
+        callback returns paComplete or stop() is called
+        '''
+        super(AudioSource, self).__init__()
+        self.num_channel = num_channel
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.chunk = chunk
+    
+    def start(self, callback):
+        raise NotImplementedError
+    
+    def is_active(self):
+        raise NotImplementedError
+    
+    def stop(self):
+        raise NotImplementedError
+
+
+class PyAudioSource(AudioSource):
+    def __init__(self, device_index, num_channel=4, sample_rate=16000, sample_width=2, chunk=1024):
+        '''
+        a physical input device, opened with the callback mode of PyAudio
+        :param device_index: input_device_index of PyAudio
+        '''
+        super(PyAudioSource, self).__init__(num_channel=num_channel, sample_rate=sample_rate,
+                                            sample_width=sample_width, chunk=chunk)
+        self.device_index = device_index
+        self.p, self.stream = None, None
+    
+    def start(self, callback):
+        from pyaudio import PyAudio
+        self.p = PyAudio()
+        self.stream = self.p.open(format=self.p.get_format_from_width(self.sample_width),
+                                  channels=self.num_channel,
+                                  rate=self.sample_rate,
+                                  input=True,
+                                  input_device_index=self.device_index,
+                                  frames_per_buffer=self.chunk,
+                                  stream_callback=callback)
+        self.stream.start_stream()
+    
+    def is_active(self):
+        return (self.stream is not None) and self.stream.is_active()
+    
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.p.terminate()
+        self.p, self.stream = None, None
+
+
+class SimulatedAudioSource(AudioSource):
+    def __init__(self, audio, sample_rate=16000, chunk=1024, speed=1., jitter=0., overrun_prob=0., loop=True,
+                 seed=None):
+        '''
+        replay multi-channel audio as if it came from the device, from a thread that calls the callback every chunk
+        :param audio: [channel * sample_point], int16 or float in [-1, 1]
+        :param speed: 1 for real time, > 1 to replay faster (e.g. 10 for 10x real time), np.inf for no pause at all
+        :param jitter: standard deviation of the random delay added to every callback (in s)
+        :param overrun_prob: probability that a chunk is lost before the callback (delivered with paInputOverflow)
+        :param loop: replay from the beginning when the audio is exhausted; otherwise stop
+        '''
+        super(SimulatedAudioSource, self).__init__(num_channel=len(audio), sample_rate=sample_rate, sample_width=2,
+                                                   chunk=chunk)
+        audio = np.asarray(audio)
+        if audio.dtype != np.int16:
+            audio = np.clip(np.round(audio * 32768.), -32768, 32767).astype(np.int16)
+        self.audio = np.ascontiguousarray(audio.T)  # [sample_point * channel], interleaved
+        self.speed = speed
+        self.jitter = jitter
+        self.overrun_prob = overrun_prob
+        self.loop = loop
+        self.rng = np.random.default_rng(seed)
+        self.thread = None
+        self.running = threading.Event()
+    
+    @classmethod
+    def from_wav(cls, path, **kwargs):
+        '''
+        :param path: a multi-channel wav file, or a list of single-channel wav files (e.g. record_mic0..3.wav)
+        '''
+        if isinstance(path, str):
+            audio, sample_rate = sf.read(path, dtype='int16', always_2d=True)
+            audio = audio.T
+        else:
+            audio = []
+            for i in path:
+                channel_audio, sample_rate = sf.read(i, dtype='int16')
+                audio.append(channel_audio)
+            audio = np.asarray(audio)
+        return cls(audio, sample_rate=sample_rate, **kwargs)
+    
+    @classmethod
+    def from_doa(cls, ref_audio, doa, sample_rate=16000, mic_positions=MIC_POSITIONS, **kwargs):
+        '''
+        synthesize delayed copies of ref_audio (e.g. reference_wav.wav) for a far-field source at doa (see
+        synthesize_doa_audio)
+        '''
+        audio = synthesize_doa_audio(ref_audio, doa, fs=sample_rate, mic_positions=mic_positions)
+        return cls(audio / (np.abs(audio).max() + np.finfo(float).eps) * 0.5, sample_rate=sample_rate, **kwargs)
+    
+    def _run(self, callback):
+        chunk_duration = self.chunk / self.sample_rate / self.speed
+        next_time = time.perf_counter()
+        idx = 0
+        while self.running.is_set():
+            if idx + self.chunk > len(self.audio):
+                if not self.loop:
+                    break
+                idx = 0
+            frames = self.audio[idx:idx + self.chunk]
+            idx += self.chunk
+            status_flags = 0
+            if self.rng.random() < self.overrun_prob:  # the chunk is lost, the next one is flagged
+                frames = self.audio[idx:idx + self.chunk] if idx + self.chunk <= len(self.audio) else frames
+                idx += self.chunk
+                status_flags = paInputOverflow
+            
+            next_time += chunk_duration
+            delay = next_time - time.perf_counter() + (abs(self.rng.normal(0., self.jitter)) if self.jitter else 0.)
+            if np.isfinite(delay) and delay > 0:
+                time.sleep(delay)
+            time_info = {'input_buffer_adc_time': idx / self.sample_rate, 'current_time': time.perf_counter()}
+            _, flag = callback(frames.tobytes(), len(frames), time_info, status_flags)
+            if flag == paComplete:
+                break
+        self.running.clear()
+    
+    def start(self, callback):
+        self.running.set()
+        self.thread = threading.Thread(target=self._run, args=(callback,), daemon=True)
+        self.thread.start()
+    
+    def is_active(self):
+        return self.running.is_set()
+    
+    def stop(self):
+        self.running.clear()
+        if (self.thread is not None) and (self.thread is not threading.current_thread()):
+            self.thread.join()
+        self.thread = None
+
+
+def synthesize_doa_audio(ref_audio, doa, fs=16000, mic_positions=MIC_POSITIONS, sound_speed=SOUND_SPEED):
+    '''
+    delayed copies of a single-channel audio, as received by every mic from a far-field source
+    :param ref_audio: [sample_point]
+    :param doa: direction of arrival (in degrees), counterclockwise from the x axis of mic_positions
+    :param mic_positions: [channel * 2] (in m)
+    :return: [channel * sample_point]
+    '''
+    ref_audio = np.asarray(ref_audio, dtype=float)
+    direction = np.array([np.cos(np.deg2rad(doa)), np.sin(np.deg2rad(doa))])
+    delays = -np.asarray(mic_positions) @ direction / sound_speed  # the mics closer to the source hear it earlier
+    delays -= delays.min()
+    spectra = np.fft.rfft(ref_audio)
+    freqs = np.fft.rfftfreq(len(ref_audio), d=1. / fs)
+    return np.fft.irfft(spectra * np.exp(-2j * np.pi * freqs * delays[:, np.newaxis]), n=len(ref_audio))
+
+
+class RingBuffer(object):
+    def __init__(self, capacity, num_channel, dtype=np.int16):
+        '''
+        preallocated ring buffer of interleaved frames, filled by one writer (the audio callback) and drained by one
+        reader. The writer never blocks: if the reader falls behind, the new chunk is dropped and counted as overrun.
+        :param capacity: number of frames (samples per channel) the buffer can hold
+        :param num_channel:
+        :param dtype:
+        '''
+        super(RingBuffer, self).__init__()
+        self.capacity = int(capacity)
+        self.num_channel = num_channel
+        self.buffer = np.zeros((self.capacity, num_channel), dtype=dtype)
+        self.write_count = 0  # total frames written so far
+        self.read_count = 0  # total frames read so far
+        self.num_overrun = 0  # chunks dropped because the buffer was full
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+    
+    def __len__(self):
+        return self.write_count - self.read_count
+    
+    def write(self, frames):
+        '''
+        :param frames: [frame * channel]
+        :return: False if the frames were dropped
+        '''
+        num_frame = len(frames)
+        with self.lock:
+            if self.write_count + num_frame - self.read_count > self.capacity:
+                self.num_overrun += 1
+                return False
+            idx = self.write_count % self.capacity
+            first = min(num_frame, self.capacity - idx)
+            self.buffer[idx:idx + first] = frames[:first]
+            self.buffer[:num_frame - first] = frames[first:]
+            self.write_count += num_frame
+            self.not_empty.notify_all()
+        return True
+    
+    def read(self, max_frame=None, timeout=None):
+        '''
+        read (and copy out) the available frames, waiting at most timeout seconds if there are none
+        :return: [frame * channel], may be empty
+        '''
+        with self.not_empty:
+            if self.write_count == self.read_count:
+                self.not_empty.wait(timeout)
+            num_frame = self.write_count - self.read_count
+            if max_frame is not None:
+                num_frame = min(num_frame, max_frame)
+            idx = self.read_count % self.capacity
+            first = min(num_frame, self.capacity - idx)
+            frames = np.concatenate((self.buffer[idx:idx + first], self.buffer[:num_frame - first]))
+            self.read_count += num_frame
+        return frames
+
+
+class CallbackRecorder(object):
+    def __init__(self, source, buffer_seconds=10):
+        '''
+        record from a multi-channel AudioSource (a PyAudioSource for the device, or a SimulatedAudioSource): the
+        callback only copies every chunk into a preallocated RingBuffer, and a writer thread streams the buffer to
+        disk, so memory use does not depend on the recording length
+        :param buffer_seconds: capacity of the ring buffer (in s)
+        '''
+        super(CallbackRecorder, self).__init__()
+        assert source.sample_width == 2, 'only 16-bit recording is supported'
+        self.source = source
+        self.num_channel = source.num_channel
+        self.sample_rate = source.sample_rate
+        self.sample_width = source.sample_width
+        self.chunk = source.chunk
+        self.ring = RingBuffer(capacity=int(buffer_seconds * self.sample_rate), num_channel=self.num_channel,
+                               dtype=np.int16)
+        self.num_input_overflow = 0  # chunks flagged as input overflow by the source
+    
+    def _callback(self, in_data, frame_count, time_info, status_flags):
+        if status_flags & paInputOverflow:
+            self.num_input_overflow += 1
+        self.ring.write(np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.num_channel))
+        self.num_frame += frame_count
+        return None, (paComplete if self.num_frame >= self.target_num_frame else paContinue)
+    
+    def _write_files(self, save_path, mapping, layout):
+        wf = wave.open(save_path, 'wb')
+        wf.setnchannels(self.num_channel)
+        wf.setsampwidth(self.sample_width)
+        wf.setframerate(self.sample_rate)
+        mic_files = None
+        if (mapping is not None) and (layout == 'interleaved'):
+            mics_file = sf.SoundFile(add_prefix_and_suffix_4_basename(save_path, suffix='_mics'), mode='w',
+                                     samplerate=self.sample_rate, channels=len(mapping), subtype='PCM_16')
+            mic_files = [(mics_file, list(mapping))]
+        elif mapping is not None:
+            mic_files = [(sf.SoundFile(add_prefix_and_suffix_4_basename(save_path, suffix='_mic%d' % i), mode='w',
+                                       samplerate=self.sample_rate, channels=1, subtype='PCM_16'), channel)
+                         for i, channel in enumerate(mapping)]
+        num_written = 0
+        while num_written < self.target_num_frame:
+            frames = self.ring.read(timeout=0.5)
+            if len(frames) == 0:
+                if self.recording_done.is_set() and len(self.ring) == 0:
+                    break
+                continue
+            frames = frames[:self.target_num_frame - num_written]
+            wf.writeframes(frames.tobytes())
+            if mic_files is not None:
+                for mic_file, channel in mic_files:
+                    mic_file.write(frames[:, channel])
+            num_written += len(frames)
+        wf.close()
+        if mic_files is not None:
+            for mic_file, _ in mic_files:
+                mic_file.close()
+        self.num_written = num_written
+    
+    def record(self, save_path, record_seconds, mapping=None, layout='per_mic'):
+        '''
+        record record_seconds of audio. The interleaved recording (physical channel order, as save_wav_from_frames)
+        is saved to save_path, and if mapping is given, every logical channel i (physical channel mapping[i]) is saved
+        to save_path with suffix '_mic{i}' (as save_multi_channel_audio with norm=False), both while recording
+        :param layout: 'per_mic' as above, or 'interleaved' to save the logical channels into one file instead, with
+                suffix '_mics' (record_mics.wav, see lib.audiolib.read_mic_dir)
+        :return: statistics of the recording
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+        self.target_num_frame = int(self.sample_rate / self.chunk * record_seconds) * self.chunk
+        self.num_frame = 0
+        self.num_input_overflow = 0
+        self.ring.num_overrun = 0
+        self.recording_done = threading.Event()
+        assert layout in ['per_mic', 'interleaved']
+        writer = threading.Thread(target=self._write_files, args=(save_path, mapping, layout,))
+        writer.start()
+        
+        self.source.start(self._callback)
+        while self.source.is_active():
+            time.sleep(0.1)
+        self.source.stop()
+        self.recording_done.set()
+        writer.join()
+        
+        stats = {
+            'num_frame'         : self.num_written,
+            'num_input_overflow': self.num_input_overflow,
+            'num_overrun'       : self.ring.num_overrun,
+        }
+        if stats['num_input_overflow'] or stats['num_overrun']:
+            print('Warning: overruns detected while recording', save_path, stats)
+        return stats
+
+
+class EnergyRatioMonitor(object):
+    def __init__(self, source, window_seconds=0.25):
+        '''
+        long-lived monitoring session: keep one AudioSource running and update the energy ratio of every channel over
+        a sliding window as each chunk arrives (chunk=512 at 16 kHz -> a new ratio every 32 ms)
+        usage:
+            with EnergyRatioMonitor(PyAudioSource(device_index, chunk=512)) as monitor:
+                ratio = monitor.get_ratio()
+        :param window_seconds: length of the sliding window (in s)
+        '''
+        super(EnergyRatioMonitor, self).__init__()
+        self.source = source
+        self.num_channel = source.num_channel
+        self.num_window_chunk = max(1, int(round(window_seconds * source.sample_rate / source.chunk)))
+        self.chunk_energy = np.zeros((self.num_window_chunk, self.num_channel))  # energy of the chunks in the window
+        self.num_chunk = 0
+        self.num_input_overflow = 0
+        self.new_chunk = threading.Condition()
+    
+    def _callback(self, in_data, frame_count, time_info, status_flags):
+        if status_flags & paInputOverflow:
+            self.num_input_overflow += 1
+        audio = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.num_channel) / 32768.
+        energy = np.sum((audio - audio.mean(axis=0)) ** 2, axis=0)
+        with self.new_chunk:
+            self.chunk_energy[self.num_chunk % self.num_window_chunk] = energy
+            self.num_chunk += 1
+            self.new_chunk.notify_all()
+        return None, paContinue
+    
+    def start(self):
+        self.source.start(self._callback)
+        return self
+    
+    def stop(self):
+        self.source.stop()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+    
+    def get_ratio(self, timeout=1.):
+        '''
+        wait for the next chunk, and return the energy ratio of every channel over the sliding window
+        :return: [channel], sums to 1
+        '''
+        with self.new_chunk:
+            num_chunk = self.num_chunk
+            self.new_chunk.wait_for(lambda: self.num_chunk > num_chunk, timeout=timeout)
+            energy = self.chunk_energy.sum(axis=0)
+        return energy / (energy.sum() + np.finfo(float).eps)
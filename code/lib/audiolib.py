@@ -3,9 +3,11 @@
 @author: chkarada
 """
 import os
+import re
 import glob
 import math
 import wave
+import struct
 import logging
 import librosa
 import numpy as np
@@ -19,6 +21,7 @@ from .utils import plot_curve
 EPS = np.finfo(float).eps
 REF_POWER = 1e-12
 np.random.seed(0)
+MICS_FILE_NAME = 'record_mics.wav'  # the interleaved layout: one multi-channel file per recording / segment
 
 
 def write_frames(frames, filename, channels, sample_rate, record_width):
@@ -126,6 +129,137 @@ def audioread(path, norm=False, start=0, stop=None, target_level=-25):
     return audio, sample_rate
 
 
+def audioread_channels(path, start=0, stop=None, dtype='float32', memmap=False):
+    '''
+    read all the channels of a file at once, kept separate (audioread averages them)
+    only the frames [start, stop) are read: the file is seeked to start, nothing before or after is decoded
+    :param dtype: dtype of the samples, 'float32' / 'float64' in [-1, 1] as audioread
+    :param memmap: if True, no decoding at all (uncompressed wav only): a zero-copy view of the raw samples of
+            audio_memmap, int16 for PCM_16 (see pcm_to_float)
+    :return: [channel * frame], sample_rate
+    '''
+    if memmap:
+        audio, sample_rate = audio_memmap(path)
+        return audio[start:stop].T, sample_rate
+    with sf.SoundFile(path) as f:
+        sample_rate = f.samplerate
+        stop = f.frames if stop is None else min(stop, f.frames)
+        if start > 0:
+            f.seek(start)
+        audio = f.read(frames=max(stop - start, 0), dtype=dtype, always_2d=True)
+    return audio.T, sample_rate
+
+
+def pcm_to_float(samples, dtype=np.float64):
+    '''
+    raw samples of audio_memmap -> float in [-1, 1], as soundfile.read
+    '''
+    if samples.dtype == np.int16:
+        return np.multiply(samples, 1. / 32768., dtype=dtype)
+    if samples.dtype == np.int32:
+        return np.multiply(samples, 1. / 2147483648., dtype=dtype)
+    return samples.astype(dtype)
+
+
+def audiowrite_channels(destpath, audio, sample_rate=16000):
+    '''
+    write [channel * sample_point] as one interleaved file (PCM_16, as audiowrite)
+    '''
+    destpath = os.path.abspath(destpath)
+    os.makedirs(os.path.dirname(destpath), exist_ok=True)
+    sf.write(destpath, np.asarray(audio).T, sample_rate)
+
+
+def audiowrite_atomically(destpath, audio, sample_rate=16000):
+    '''
+    write [sample_point] (as audiowrite) or [channel * sample_point] (as audiowrite_channels) into a temp file in the
+    same folder, then rename it to destpath, so that a crashed run never leaves a truncated wav that is reused later
+    '''
+    destpath = os.path.abspath(destpath)
+    os.makedirs(os.path.dirname(destpath), exist_ok=True)
+    tmp_path = destpath + '.%d.tmp' % os.getpid()
+    audio = np.asarray(audio)
+    try:
+        sf.write(tmp_path, audio.T if audio.ndim == 2 else audio, sample_rate, format='WAV')
+        os.replace(tmp_path, destpath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_mic_file(path):
+    '''
+    whether path is the file of a single mic (record_mic{i}.wav) of the per-mic layout
+    '''
+    return re.fullmatch(r'record_mic\d+\.wav', os.path.basename(path)) is not None
+
+
+def read_mic_dir(dir_path, start=0, stop=None, dtype='float32'):
+    '''
+    read the audio of a recording / segment directory in either layout: record_mics.wav in one read, or the sorted
+    record_mic{i}.wav files (see audioread_channels for start, stop and dtype)
+    :return: [channel * sample_point], sample_rate
+    '''
+    mics_path = os.path.join(dir_path, MICS_FILE_NAME)
+    if os.path.exists(mics_path):
+        return audioread_channels(mics_path, start=start, stop=stop, dtype=dtype)
+    audio = []
+    for mic_path in sorted([i for i in os.listdir(dir_path) if is_mic_file(i)], key=lambda x: int(x[10:-4])):
+        channel_audio, sample_rate = audioread_channels(os.path.join(dir_path, mic_path), start=start, stop=stop,
+                                                        dtype=dtype)
+        audio.append(channel_audio[0])
+    return np.asarray(audio), sample_rate
+
+
+def split_mics_file(path, dst_dir=None):
+    '''
+    compatibility export of the interleaved layout: write every channel of record_mics.wav to record_mic{i}.wav
+    :param dst_dir: the directory of path by default
+    '''
+    audio, sample_rate = audioread_channels(path)
+    dst_dir = os.path.dirname(os.path.abspath(path)) if dst_dir is None else dst_dir
+    for i, channel_audio in enumerate(audio):
+        audiowrite(os.path.join(dst_dir, 'record_mic%d.wav' % i), channel_audio, sample_rate=sample_rate, norm=False, )
+
+
+def audio_memmap(path):
+    '''
+    memory-map the samples of an uncompressed wav file (PCM 16/32-bit or float 32/64-bit), without reading them
+    :return: [sample_point * channel] read-only np.memmap of the raw samples (int16 in [-32768, 32767] for PCM_16,
+            divide by 32768. for the values of audioread), sample_rate
+    '''
+    path = os.path.abspath(path)
+    with open(path, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        assert riff == b'RIFF' and wave_id == b'WAVE', f'{path} is not a wav file'
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'no data chunk in {path}')
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                chunk = f.read(chunk_size)
+                format_tag, num_channel, sample_rate, _, _, bits = struct.unpack('<HHIIHH', chunk[:16])
+                if format_tag == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE, the format is in the sub-format GUID
+                    format_tag = struct.unpack('<H', chunk[24:26])[0]
+                fmt = (format_tag, num_channel, sample_rate, bits)
+                f.seek(chunk_size % 2, 1)
+            elif chunk_id == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+    assert fmt is not None, f'no fmt chunk in {path}'
+    format_tag, num_channel, sample_rate, bits = fmt
+    dtype = {(1, 16): '<i2', (1, 32): '<i4', (3, 32): '<f4', (3, 64): '<f8', }.get((format_tag, bits))
+    if dtype is None:
+        raise ValueError(f'{path}: format {format_tag} with {bits} bits can not be memory-mapped')
+    num_frame = min(chunk_size, os.path.getsize(path) - offset) // (num_channel * bits // 8)
+    audio = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(num_frame, num_channel))
+    return audio, sample_rate
+
+
 def audiowrite(destpath, audio, sample_rate=16000, norm=False, target_level=-25, clipping_threshold=None,
                clip_test=False):
     '''Function to write audio'''
@@ -425,7 +559,7 @@ def next_lower_power_of_2(x):
 
 
 def audio_segmenter_4_file(input_path, dest_dir, segment_len, stepsize, fs=None, window='hann', padding=False,
-                           pow_2=False, save2segFolders=False):
+                           pow_2=False, save2segFolders=False, multi_channel=False):
     '''
     Segment single-channel audio into clips, and save them in seg_{i} folder.
     :param input_path: 待clip的声音文件路径
@@ -437,34 +571,47 @@ def audio_segmenter_4_file(input_path, dest_dir, segment_len, stepsize, fs=None,
     :param padding: 当最后一个clip不够长时，是否补足
     :param pow_2: 是否将clip采样点数向上取整至2的整数次幂
     :param save2segFolders: 若为True，则将片段保存至单独的文件夹；否则，添加后缀 _seg_{i}，并保存
-    :return:
+    :param multi_channel: if True, keep all the channels of the file (e.g. record_mics.wav), and save every clip as one
+            interleaved file; otherwise the channels are averaged (audioread)
+    :return: the paths of the clips
     '''
-    audio, ini_fs = audioread(input_path)
+    audio, ini_fs = audioread_channels(input_path, dtype='float64') if multi_channel else audioread(input_path)
     fs, ini_fs = int(fs), int(ini_fs)
     if (fs is not None) and (fs != ini_fs):
         audio = librosa.core.resample(audio, ini_fs, fs)
     else:
         fs = ini_fs
     
+    # a view of the recording, every clip is windowed only when it is saved
     audio_segments = audio_segmenter_4_numpy(audio, segment_len=segment_len, stepsize=stepsize, fs=fs,
-                                             window=window, padding=padding, pow_2=pow_2)
+                                             window=None, padding=padding, pow_2=pow_2, return_view=True)
+    win = get_window(window, audio_segments.shape[-1]) if (window is not None) else 1.
+    write = (lambda path, clip: audiowrite_channels(path, clip, fs)) if multi_channel else \
+        (lambda path, clip: audiowrite(path, clip, fs, norm=False, ))
+    if multi_channel:
+        audio_segments = audio_segments.transpose((1, 0, 2))  # [num_segments * channel * seg_len]
     file_basename = os.path.basename(input_path)
     basename, ext = os.path.splitext(file_basename)
     os.makedirs(dest_dir, exist_ok=True)
+    save_paths = []
     if save2segFolders:
         for i, audio_seg in enumerate(audio_segments):
             save_path = os.path.join(dest_dir, 'seg_' + str(i), file_basename)
             os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            audiowrite(save_path, audio_seg, fs, norm=False, )
+            write(save_path, audio_seg * win)
+            save_paths.append(save_path)
     else:
         for i, audio_seg in enumerate(audio_segments):
             save_path = os.path.join(dest_dir, basename + '_seg_' + str(i) + ext)
-            audiowrite(save_path, audio_seg, fs, norm=False, )
+            write(save_path, audio_seg * win)
+            save_paths.append(save_path)
+    return save_paths
 
 
-def audio_segmenter_4_numpy(audio, segment_len, stepsize, fs=16000, window='hann', padding=False, pow_2=False):
+def audio_segmenter_4_numpy(audio, segment_len, stepsize, fs=16000, window='hann', padding=False, pow_2=False,
+                            return_view=False, out=None):
     '''
-    将numpy格式的单通道语音划分为 clips
+    将numpy格式的单通道语音划分为 clips (多通道语音 [channel * sample_point] 则沿最后一维划分每个通道)
     :param audio: numpy格式声音
     :param fs: 声音的采样率
     :param segment_len: 声音片段的长度(单位 s)
@@ -472,42 +619,53 @@ def audio_segmenter_4_numpy(audio, segment_len, stepsize, fs=16000, window='hann
     :param window:
     :param padding: 是否补全最后一个声音片段，若为True，则从开头截取一段声音进行补全
     :param pow_2:
-    :return:
+    :param return_view: if True, return a read-only strided view over audio (no copy) and leave the window to the
+            consumer (e.g. get_gcc_phat_batch(window=...), or seg * get_window(window, seg_len) when saving a clip),
+            window must be None then
+    :param out: optional buffer of shape [... * num_segments * seg_len] to write the windowed clips into
+    :return: [... * num_segments * seg_len]
     '''
     
     seg_len = next_greater_power_of_2(segment_len * fs) if pow_2 else int(segment_len * fs)
     step_size = int(stepsize * fs)
+    audio = np.asarray(audio)
+    length = audio.shape[-1]
     
     # complement the audio
     if padding:
-        if len(audio) > seg_len and (len(audio) - seg_len) % step_size != 0:
-            audio = np.append(audio, audio[0: step_size - (len(audio) - seg_len) % step_size])
-        elif len(audio) < seg_len:
-            while len(audio) < seg_len:
-                audio = np.append(audio, audio)
-            audio = audio[:seg_len]
+        if length > seg_len and (length - seg_len) % step_size != 0:
+            audio = np.concatenate((audio, audio[..., 0: step_size - (length - seg_len) % step_size]), axis=-1)
+        elif length < seg_len:
+            audio = np.concatenate([audio] * int(np.ceil(seg_len / length)), axis=-1)[..., :seg_len]
     else:
-        if len(audio) > seg_len and (len(audio) - seg_len) % step_size != 0:
-            audio = audio[: - ((len(audio) - seg_len) % step_size)]
-        elif len(audio) < seg_len:
+        if length > seg_len and (length - seg_len) % step_size != 0:
+            audio = audio[..., : - ((length - seg_len) % step_size)]
+        elif length < seg_len:
             raise ValueError('audio is too short to be segmented')
     
-    # split the audio
-    num_segments = (len(audio) - seg_len) // step_size + 1
-    audio_segments = np.asarray([audio[i * step_size:seg_len + i * step_size] for i in range(num_segments)])
-    
-    if (window is not None) and (len(audio_segments) > 0):
-        win = get_window(window, seg_len)
-        audio_segments = audio_segments * win
-    
-    return np.asarray(audio_segments)
+    # split the audio: a strided view, every sample is shared by the overlapping segments
+    audio_segments = rolling_window(audio, window=seg_len, step=step_size)
+    if return_view:
+        assert window is None, 'apply the window in the consumer of the view'
+        assert out is None
+        return audio_segments
+    
+    win = get_window(window, seg_len) if ((window is not None) and (audio_segments.shape[-2] > 0)) else None
+    if out is None:
+        return audio_segments * win if (win is not None) else audio_segments.copy()
+    if win is not None:
+        np.multiply(audio_segments, win, out=out)
+    else:
+        np.copyto(out, audio_segments)
+    return out
 
 
 def rolling_window(a, window, step=1):
     # http://ellisvalentiner.com/post/2017-03-21-np-strides-trick
+    # read-only: the windows overlap, writing into one of them would change the others
     shape = a.shape[:-1] + (a.shape[-1] - window + 1, window)
     strides = a.strides + (a.strides[-1],)
-    return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides)[::step]
+    return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides, writeable=False)[..., ::step, :]
 
 
 def framesig(sig, frame_len, frame_step, winfunc=lambda x: np.ones((x,)), stride_trick=True):
@@ -0,0 +1,247 @@
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+
+SEGMENT_PATH_PATTERN = {
+    'src'   : re.compile(r'src_(-?[\d.]+)_(-?[\d.]+)$'),
+    'walker': re.compile(r'walker_(-?[\d.]+)_(-?[\d.]+)_(-?[\d.]+)$'),
+    'doa'   : re.compile(r'(-?\d+)$'),
+    'seg'   : re.compile(r'seg_(\d+)$'),
+}
+LABEL_COLUMNS = ['src_x', 'src_y', 'walker_x', 'walker_y', 'walker_z', 'doa', 'seg', ]
+# version of the labels decoded into the catalog: a catalog of another version (or without one, the first catalogs
+# decoded walker_{x}_{y}_{z}) has the labels of all its files decoded again when it is opened
+CATALOG_VERSION = 2
+
+
+def decode_segment_path(path):
+    '''
+    decode the labels from the directories of a path in the layout of the dataset
+    (.../src_{x}_{y}/walker_{x}_{z}_{y}/{doa}[/seg_{i}]/record_mic{j}.wav, see encode_dir in collect_data.py)
+    :return: dict of LABEL_COLUMNS, None for the labels that are not in path
+    '''
+    labels = dict.fromkeys(LABEL_COLUMNS)
+    parts = os.path.normpath(path).split(os.sep)
+    for i, part in enumerate(parts):
+        match = SEGMENT_PATH_PATTERN['src'].match(part)
+        if match:
+            labels['src_x'], labels['src_y'] = map(float, match.groups())
+            continue
+        match = SEGMENT_PATH_PATTERN['walker'].match(part)
+        if match:
+            # the height is in the middle, as decode_file_basename: [wk_x, wk_z, wk_y, doa, seg]
+            labels['walker_x'], labels['walker_z'], labels['walker_y'] = map(float, match.groups())
+            # the doa is the directory right below the walker
+            if (i + 1 < len(parts)) and SEGMENT_PATH_PATTERN['doa'].match(parts[i + 1]):
+                labels['doa'] = int(parts[i + 1])
+            continue
+        match = SEGMENT_PATH_PATTERN['seg'].match(part)
+        if match:
+            labels['seg'] = int(match.group(1))
+    return labels
+
+
+class DatasetCatalog(object):
+    def __init__(self, root, db_path=None):
+        '''
+        persistent catalog (SQLite) of the directories and files of a dataset tree, with the size, mtime and labels
+        (decode_segment_path) of every file, so that listing the files of a stage does not walk the tree again
+        refresh() only re-lists the directories whose mtime changed since the last refresh (a directory's mtime
+        changes when an entry is added, removed or renamed in it), the others are only stat-ed. A file rewritten in
+        place keeps its old size / mtime in the catalog until refresh(full=True)
+        usage:
+            catalog = DatasetCatalog('./dataset/4F_CYC')
+            catalog.refresh()
+            files = get_files_by_suffix(src_dspath, '.wav', catalog=catalog)
+        :param root: root directory of the dataset, every path queried must be in it
+        :param db_path: the SQLite file, root + '.catalog.sqlite' by default (next to root, not in it: writing the
+                database would change the mtime of root)
+        '''
+        super(DatasetCatalog, self).__init__()
+        self.root = os.path.abspath(root)
+        self.db_path = (self.root + '.catalog.sqlite') if db_path is None else db_path
+        self._local = threading.local()  # one connection per thread
+    
+    def __getstate__(self):
+        # the connections are not picklable, a spawned process opens its own (see conn)
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+    
+    @property
+    def conn(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():  # a forked process inherits the local of its thread
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            local.conn = sqlite3.connect(self.db_path, timeout=600)
+            local.pid = os.getpid()
+            local.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, name TEXT, mtime_ns INTEGER);
+                CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+                CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT, size INTEGER,
+                    mtime_ns INTEGER, src_x REAL, src_y REAL, walker_x REAL, walker_y REAL, walker_z REAL,
+                    doa INTEGER, seg INTEGER);
+                CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+            self._check_version(local.conn)
+        return local.conn
+    
+    @staticmethod
+    def _check_version(conn):
+        '''
+        decode the labels of every file again if the catalog was written with another CATALOG_VERSION (refresh()
+        does not decode the files of the directories that did not change)
+        '''
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if (row is not None) and (row[0] == str(CATALOG_VERSION)):
+            return
+        with conn:
+            rows = conn.execute('SELECT path FROM files').fetchall()
+            conn.executemany('UPDATE files SET ' + ', '.join(i + ' = ?' for i in LABEL_COLUMNS) + ' WHERE path = ?',
+                             [tuple(decode_segment_path(i.replace('/', os.sep)).values()) + (i,) for (i,) in rows])
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(CATALOG_VERSION),))
+    
+    def _rel(self, path):
+        rel = os.path.relpath(os.path.abspath(path), start=self.root)
+        assert not rel.startswith(os.pardir), f'{path} is not in the catalog of {self.root}'
+        return '' if rel == os.curdir else rel.replace(os.sep, '/')
+    
+    @staticmethod
+    def _under(column, rel):
+        '''
+        SQL condition of the paths strictly under rel (LIKE would not do: '_' is a wildcard and it ignores the case)
+        '''
+        if not rel:
+            return column + " != ''", ()
+        return 'substr(' + column + ', 1, ?) = ?', (len(rel) + 1, rel + '/')
+    
+    def _delete_tree(self, rel):
+        for table, column in [('dirs', 'path'), ('files', 'dir')]:
+            where, args = self._under(column, rel)
+            self.conn.execute('DELETE FROM ' + table + ' WHERE ' + column + ' = ? OR ' + where, (rel,) + args)
+    
+    def refresh(self, path=None, full=False):
+        '''
+        update the catalog of the tree under path (root by default)
+        :param full: re-list every directory and stat every file, whatever the mtime of the directories
+        :return: number of directories re-listed
+        '''
+        rel = self._rel(self.root if path is None else path)
+        where, args = self._under('path', rel)
+        known = dict(self.conn.execute('SELECT path, mtime_ns FROM dirs WHERE path = ? OR ' + where,
+                                       (rel,) + args).fetchall())
+        num_listed = 0
+        stack = [rel]
+        with self.conn:
+            while stack:
+                d = stack.pop()
+                abs_d = os.path.join(self.root, d)
+                try:
+                    mtime_ns = os.stat(abs_d).st_mtime_ns
+                except FileNotFoundError:
+                    self._delete_tree(d)
+                    continue
+                if (not full) and (known.get(d) == mtime_ns):
+                    # unchanged: same entries, only visit the known subdirectories
+                    stack.extend(i for (i,) in self.conn.execute('SELECT path FROM dirs WHERE parent = ?', (d,)))
+                    continue
+                
+                num_listed += 1
+                sub_dirs, files = [], []
+                with os.scandir(abs_d) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.name)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                sub_paths = [(d + '/' + i) if d else i for i in sub_dirs]
+                # drop the subtrees that disappeared, then update this directory and its files
+                for (i,) in self.conn.execute('SELECT path FROM dirs WHERE parent = ?', (d,)).fetchall():
+                    if i not in sub_paths:
+                        self._delete_tree(i)
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                                  (d, os.path.dirname(d) if d else None, os.path.basename(d), mtime_ns))
+                self.conn.execute('DELETE FROM files WHERE dir = ?', (d,))
+                self.conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+                    ((d + '/' + name) if d else name, d, name, size, file_mtime_ns) +
+                    tuple(decode_segment_path((d + '/' + name).replace('/', os.sep)).values())
+                    for name, size, file_mtime_ns in files])
+                stack.extend(sub_paths)
+        return num_listed
+    
+    def _query(self, table, root, column, value, mode, recursive):
+        rel = self._rel(root)
+        if recursive:
+            where, args = self._under('path', rel)
+        else:
+            where, args = ('dir = ?' if table == 'files' else 'parent = ?'), (rel,)
+        rows = self.conn.execute('SELECT path, name FROM ' + table + ' WHERE ' + where + ' ORDER BY path',
+                                 args).fetchall()
+        values = (value,) if isinstance(value, str) else tuple(value)
+        paths = []
+        for path, name in rows:
+            key = path if column == 'path' else name
+            if (mode == 'suffix' and key.endswith(values)) or (mode == 'prefix' and key.startswith(values)):
+                # the same paths as os.walk / os.listdir would give from root
+                paths.append(os.path.normpath(os.path.join(root, os.path.relpath(path, start=rel or os.curdir))))
+        return paths
+    
+    def get_files_by_suffix(self, root, suffix=''):
+        return self._query('files', root, 'path', suffix, 'suffix', recursive=True)
+    
+    def get_files_by_prefix(self, root, prefix=''):
+        return self._query('files', root, 'name', prefix, 'prefix', recursive=True)
+    
+    def get_dirs_by_suffix(self, root, suffix=''):
+        return self._query('dirs', root, 'path', suffix, 'suffix', recursive=True)
+    
+    def get_dirs_by_prefix(self, root, prefix=''):
+        return self._query('dirs', root, 'name', prefix, 'prefix', recursive=True)
+    
+    def get_subfiles_by_suffix(self, root, suffix=''):
+        return self._query('files', root, 'name', suffix, 'suffix', recursive=False)
+    
+    def get_subfiles_by_prefix(self, root, prefix=''):
+        return self._query('files', root, 'name', prefix, 'prefix', recursive=False)
+    
+    def get_subdirs_by_suffix(self, root, suffix=''):
+        return self._query('dirs', root, 'name', suffix, 'suffix', recursive=False)
+    
+    def get_subdirs_by_prefix(self, root, prefix=''):
+        return self._query('dirs', root, 'name', prefix, 'prefix', recursive=False)
+    
+    def get_fingerprint(self, root, suffix=''):
+        '''
+        fingerprint of the files under root: sha1 of their paths, sizes and mtimes, as stored by refresh (no file is
+        stat-ed here). Adding, removing or replacing a file (audiowrite_atomically) changes the mtime of its directory
+        and so the fingerprint; a file rewritten in place is only seen after refresh(root, full=True)
+        '''
+        self.refresh(root)
+        rel = self._rel(root)
+        where, args = self._under('path', rel)
+        sha1 = hashlib.sha1()
+        for path, size, mtime_ns in self.conn.execute('SELECT path, size, mtime_ns FROM files WHERE ' + where +
+                                                      ' ORDER BY path', args):
+            if path.endswith(suffix):
+                sha1.update('{}\t{}\t{}\n'.format(os.path.relpath(path, start=rel or os.curdir), size,
+                                                  mtime_ns).encode())
+        return sha1.hexdigest()
+    
+    def get_labels(self, root, suffix='.wav'):
+        '''
+        :return: {path: dict of LABEL_COLUMNS} of the files under root, without decoding the paths again
+        '''
+        rel = self._rel(root)
+        where, args = self._under('path', rel)
+        rows = self.conn.execute('SELECT path, ' + ', '.join(LABEL_COLUMNS) + ' FROM files WHERE ' + where +
+                                 ' ORDER BY path', args).fetchall()
+        return {os.path.normpath(os.path.join(root, os.path.relpath(i[0], start=rel or os.curdir))):
+                    dict(zip(LABEL_COLUMNS, i[1:])) for i in rows if i[0].endswith(suffix)}
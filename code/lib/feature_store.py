@@ -0,0 +1,174 @@
+import os
+import numpy as np
+from .utils import savez_atomically
+from .label_table import LabelTable
+
+
+class FeatureStoreWriter(object):
+    def __init__(self, root, name, shard_size=4096, dtype=np.float32):
+        '''
+        append the features of a stage into fixed-size shards (one contiguous .npy of [shard_size, *feature_shape] per
+        shard, filled through np.memmap) instead of one .npz per segment. Every writer has its own shards and its own
+        index part (index_{name}.npz: key, shard and row of every feature), so writers in parallel processes never
+        share a file, and FeatureStore merges the index parts
+        the index part is rewritten every time a shard is full and on close, so a crashed writer only loses the rows
+        of its last shard
+        :param root: directory of the store
+        :param name: unique name of the writer, e.g. run stamp + process number (the index parts are merged in the
+                order of their names)
+        :param shard_size: number of features per shard
+        '''
+        super(FeatureStoreWriter, self).__init__()
+        self.root = root
+        self.name = name
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.shape = None
+        self.shards = []
+        self.keys, self.shard_ids, self.rows = [], [], []
+        self._shard = None
+        self._num_row = 0
+        os.makedirs(root, exist_ok=True)
+    
+    def _open_shard(self):
+        self.shards.append('shard_' + self.name + '_' + str(len(self.shards)) + '.npy')
+        self._shard = np.lib.format.open_memmap(os.path.join(self.root, self.shards[-1]), mode='w+', dtype=self.dtype,
+                                                shape=(self.shard_size,) + self.shape)
+        self._num_row = 0
+    
+    def _close_shard(self):
+        if self._shard is None:
+            return
+        path = os.path.join(self.root, self.shards[-1])
+        if self._num_row < self.shard_size:  # trim the last shard to its rows
+            data = np.array(self._shard[:self._num_row])
+            self._shard = None
+            np.save(path + '.tmp.npy', data)
+            os.replace(path + '.tmp.npy', path)
+        else:
+            self._shard.flush()
+        self._shard = None
+        self.save_index()
+    
+    def append(self, key, feature):
+        '''
+        :param key: id of the segment, its path relative to the root of the stage (as LabelTable.paths)
+        :param feature: e.g. [num_pair, num_gcc_bin] (gcc_phat) or [2 * channel, frames, freq] (stft)
+        '''
+        if self.shape is None:
+            self.shape = tuple(np.shape(feature))
+        assert tuple(np.shape(feature)) == self.shape, f'{np.shape(feature)} != {self.shape}'
+        if self._shard is None:
+            self._open_shard()
+        self._shard[self._num_row] = feature
+        self.keys.append(key)
+        self.shard_ids.append(len(self.shards) - 1)
+        self.rows.append(self._num_row)
+        self._num_row += 1
+        if self._num_row == self.shard_size:
+            self._close_shard()
+    
+    def save_index(self):
+        savez_atomically(os.path.join(self.root, 'index_' + self.name + '.npz'), keys=np.asarray(self.keys, dtype=str),
+                         shard=np.asarray(self.shard_ids, dtype=np.int32), row=np.asarray(self.rows, dtype=np.int32),
+                         shards=np.asarray(self.shards, dtype=str), )
+    
+    def close(self):
+        self._close_shard()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FeatureStore(object):
+    def __init__(self, root):
+        '''
+        read a store of FeatureStoreWriter: the index parts of all the writers are merged into one table
+        (keys, shard, row), and the shards are opened as read-only memmaps
+        usage:
+            store = FeatureStore(gcc_phat_store_path)
+            x = store[i]                                    # zero-copy view
+            labels = store.get_labels()
+            mask = labels.mask(doa=[0, 90])
+            x, y = store.get_batch(np.flatnonzero(mask)), labels['doa'][mask]
+        :param root: directory of the store
+        '''
+        super(FeatureStore, self).__init__()
+        self.root = root
+        self.shards = []
+        keys, shard, row = [], [], []
+        parts = sorted(i for i in os.listdir(root) if i.startswith('index_') and i.endswith('.npz')) \
+            if os.path.isdir(root) else []
+        for part in parts:
+            data = np.load(os.path.join(root, part))
+            keys.append(data['keys'])
+            shard.append(data['shard'] + len(self.shards))
+            row.append(data['row'])
+            self.shards.extend(data['shards'].tolist())
+        self.keys = np.concatenate(keys) if len(keys) else np.zeros(0, dtype=str)
+        self.shard = np.concatenate(shard) if len(shard) else np.zeros(0, dtype=np.int32)
+        self.row = np.concatenate(row) if len(row) else np.zeros(0, dtype=np.int32)
+        # sorted by key, so that the order does not depend on the writers, and if a key was written again (e.g. its
+        # segment changed, see StageCache) only the row of the latest index part is kept
+        _, last = np.unique(self.keys[::-1], return_index=True)
+        order = len(self.keys) - 1 - last
+        self.keys, self.shard, self.row = self.keys[order], self.shard[order], self.row[order]
+        self._memmaps = {}
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def get_shard(self, shard_id):
+        if shard_id not in self._memmaps:
+            self._memmaps[shard_id] = np.load(os.path.join(self.root, self.shards[shard_id]), mmap_mode='r')
+        return self._memmaps[shard_id]
+    
+    def __getitem__(self, i):
+        '''
+        :return: the feature i, a read-only view of its shard
+        '''
+        return self.get_shard(self.shard[i])[self.row[i]]
+    
+    def lookup(self, keys):
+        '''
+        :return: the index of every key (e.g. LabelTable.paths), -1 if it is not in the store
+        '''
+        keys = np.asarray(keys, dtype=str)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, pos, -1)
+    
+    def get(self, key):
+        i = self.lookup([key])[0]
+        if i < 0:
+            raise KeyError(key)
+        return self[i]
+    
+    def get_batch(self, indices, out=None):
+        '''
+        gather the features of indices, shard by shard (one fancy indexing per shard)
+        :param out: optional buffer of [len(indices), *feature_shape]
+        '''
+        indices = np.asarray(indices, dtype=np.intp)
+        if (len(indices) == 0) and (out is None):  # [0, *feature_shape], the shape of an empty store is unknown
+            shard = self.get_shard(self.shard[0]) if len(self) else np.zeros(0, dtype=np.float32)
+            return np.empty((0,) + shard.shape[1:], dtype=shard.dtype)
+        shards = self.shard[indices]
+        for shard_id in np.unique(shards):
+            sel = np.flatnonzero(shards == shard_id)
+            feature = self.get_shard(shard_id)[self.row[indices[sel]]]
+            if out is None:
+                out = np.empty((len(indices),) + feature.shape[1:], dtype=feature.dtype)
+            out[sel] = feature
+        return out
+    
+    def get_labels(self, stage=None):
+        '''
+        :return: the LabelTable of the keys, in the order of the store
+        '''
+        stage = os.path.basename(os.path.normpath(self.root)) if stage is None else stage
+        return LabelTable.from_paths(self.keys, stage=stage)
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+from .catalog import decode_segment_path, LABEL_COLUMNS
+from .utils import get_files_by_suffix, savez_atomically
+
+# the columns of the label table, [src_x, src_y, wk_x, wk_y, wk_z, doa, seg] as decode_audio_path, and the stage
+# (index in LabelTable.stages). seg is int32: 32ms clips with a 16ms step overflow int16 after ~9 min of recording
+LABEL_DTYPES = {
+    'src_x'   : np.float32,
+    'src_y'   : np.float32,
+    'walker_x': np.float32,
+    'walker_y': np.float32,
+    'walker_z': np.float32,
+    'doa'     : np.int16,
+    'seg'     : np.int32,
+    'stage'   : np.int16,
+}
+
+
+def _missing(dtype):
+    return np.nan if np.issubdtype(dtype, np.floating) else -1
+
+
+class LabelTable(object):
+    def __init__(self, paths, columns, stages):
+        '''
+        typed columnar table of the labels of the segments of one or more stages of the dataset, decoded only once
+        from the paths (src_{x}_{y}/walker_{x}_{z}_{y}/{doa}/seg_{i}), so that the loaders select the segments with
+        vectorized masks instead of walking and parsing the paths
+        usage:
+            labels = LabelTable.build(gcc_phat_dspath)
+            labels.save(gcc_phat_dspath + '_labels.npz')
+            labels = LabelTable.load(gcc_phat_dspath + '_labels.npz')
+            sub = labels[labels.mask(doa=[0, 90], walker_z=1) & (labels['src_x'] < 200)]
+        :param paths: [num_segment], the directory of every segment relative to the root of its stage
+        :param columns: dict of the LABEL_DTYPES columns, [num_segment] each (nan / -1 for a missing label)
+        :param stages: the name of every stage (basename of its root), the stage column indexes it
+        '''
+        super(LabelTable, self).__init__()
+        self.paths = np.asarray(paths, dtype=str)
+        self.columns = {key: np.asarray(columns[key], dtype=dtype) for key, dtype in LABEL_DTYPES.items()}
+        self.stages = list(stages)
+        for key, value in self.columns.items():
+            assert len(value) == len(self.paths), f'column {key} has {len(value)} rows instead of {len(self.paths)}'
+    
+    @classmethod
+    def build(cls, roots, suffix=('.npz', '.wav'), catalog=None):
+        '''
+        decode the labels of every segment (directory of the files with suffix) of one or more stage roots
+        :param roots: a root directory, or a list of them (one stage each, e.g. the gcc_phat and stft trees)
+        :param catalog: optional DatasetCatalog of the roots, the labels decoded by its refresh are reused
+        '''
+        roots = [roots] if isinstance(roots, str) else list(roots)
+        paths, stage, labels = [], [], []
+        for stage_id, root in enumerate(roots):
+            if catalog is not None:
+                catalog.refresh(root)
+                decoded = catalog.get_labels(root, suffix=suffix)
+            else:
+                decoded = {i: None for i in get_files_by_suffix(root, suffix)}
+            seg_dirs = {}
+            for fpath, label in decoded.items():  # one row per segment, not per mic file
+                seg_dir = os.path.dirname(fpath)
+                if seg_dir not in seg_dirs:
+                    seg_dirs[seg_dir] = decode_segment_path(seg_dir) if label is None else label
+            for seg_dir in sorted(seg_dirs.keys()):
+                paths.append(os.path.relpath(seg_dir, start=root))
+                stage.append(stage_id)
+                labels.append(seg_dirs[seg_dir])
+        columns = {key: [_missing(LABEL_DTYPES[key]) if i[key] is None else i[key] for i in labels]
+                   for key in LABEL_COLUMNS}
+        columns['stage'] = stage
+        return cls(paths, columns, [os.path.basename(os.path.normpath(i)) for i in roots])
+    
+    @classmethod
+    def from_paths(cls, paths, stage=''):
+        '''
+        the labels of the segments of paths (relative to the root of one stage), e.g. the keys of a FeatureStore
+        '''
+        labels = [decode_segment_path(i) for i in paths]
+        columns = {key: [_missing(LABEL_DTYPES[key]) if i[key] is None else i[key] for i in labels]
+                   for key in LABEL_COLUMNS}
+        columns['stage'] = np.zeros(len(labels), dtype=LABEL_DTYPES['stage'])
+        return cls(paths, columns, [stage])
+    
+    @classmethod
+    def from_index(cls, index, stage=None):
+        '''
+        the labels of the segments of a SegmentIndex (see lib.segment_index), in the order of its rows
+        '''
+        rec_labels = [decode_segment_path(i) for i in index.recordings]  # once per recording
+        columns = {key: [_missing(LABEL_DTYPES[key]) if i[key] is None else i[key] for i in rec_labels]
+                   for key in LABEL_COLUMNS}
+        columns = {key: np.asarray(value, dtype=LABEL_DTYPES[key])[index.rec_id] for key, value in columns.items()}
+        columns['seg'] = index.seg_no
+        columns['stage'] = np.zeros(len(index), dtype=LABEL_DTYPES['stage'])
+        stage = os.path.basename(os.path.normpath(index.root)) if stage is None else stage
+        return cls([index.rel_path(i) for i in range(len(index))], columns, [stage])
+    
+    def save(self, path):
+        savez_atomically(path, paths=self.paths, stages=np.asarray(self.stages, dtype=str), **self.columns)
+    
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['paths'], {key: data[key] for key in LABEL_DTYPES.keys()}, list(data['stages']))
+    
+    def __len__(self):
+        return len(self.paths)
+    
+    def __getitem__(self, item):
+        '''
+        :param item: a column name, or a bool mask / indices of the rows to keep (-> a new LabelTable)
+        '''
+        if isinstance(item, str):
+            return self.columns[item]
+        return LabelTable(self.paths[item], {key: value[item] for key, value in self.columns.items()}, self.stages)
+    
+    def mask(self, **conditions):
+        '''
+        :param conditions: column=value, or column=list of accepted values; stage may be given by name
+        :return: [num_segment] bool mask of the rows matching all the conditions
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in conditions.items():
+            values = np.atleast_1d(value)
+            if key == 'stage' and values.dtype.kind in 'US':
+                values = [self.stages.index(i) for i in values]
+            mask &= np.isin(self.columns[key], values)
+        return mask
+    
+    def get_array(self, columns=LABEL_COLUMNS):
+        '''
+        :return: [num_segment * len(columns)] float32, as the labels [src_x, src_y, wk_x, wk_y, wk_z, doa, seg] of
+                pack_data_into_array
+        '''
+        return np.stack([self.columns[key].astype(np.float32) for key in columns], axis=-1)
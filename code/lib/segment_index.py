@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from scipy.signal import get_window
+from .audiolib import audioread_channels, pcm_to_float, normalize_single_channel_audio, next_greater_power_of_2
+from .utils import get_files_by_suffix, savez_atomically
+
+MIC_NAMES = ['record_mic0.wav', 'record_mic1.wav', 'record_mic2.wav', 'record_mic3.wav', ]
+
+
+class SegmentIndex(object):
+    def __init__(self, root, recordings, rec_id, seg_no, start, length, window='hann', fs=16000, norm=False,
+                 mic_names=MIC_NAMES):
+        '''
+        virtual segmentation of a dataset of recordings: instead of a seg_{i} directory of wav copies per segment,
+        one row (rec_id, seg_no, start, length) per segment, and the segments are materialized on demand from the
+        memory-mapped recordings (see audio_memmap)
+        :param root: root directory of the recordings (e.g. 'initial', or its denoised cache 'initial_norm_denoise')
+        :param recordings: recording table, directory of every recording relative to root (with the mic files in it)
+        :param rec_id: [num_segment], row of the recording table of every segment
+        :param seg_no: [num_segment], number of the segment in its recording (the i of seg_{i} in clip_audio)
+        :param start: [num_segment], first sample of every segment
+        :param length: [num_segment], number of samples of every segment
+        :param window: window applied to every segment when it is materialized (None: no window)
+        :param norm: if True, every channel of a materialized segment is normalized (as audiowrite(norm=True))
+        :param mic_names: the files of a recording, ['record_mics.wav'] for the interleaved layout
+        '''
+        super(SegmentIndex, self).__init__()
+        self.root = root
+        self.recordings = np.asarray(recordings, dtype=str)
+        self.rec_id = np.asarray(rec_id, dtype=np.int32)
+        self.seg_no = np.asarray(seg_no, dtype=np.int32)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.length = np.asarray(length, dtype=np.int32)
+        self.window = window
+        self.fs = fs
+        self.norm = norm
+        self.mic_names = list(mic_names)
+        self._memmaps = {}
+        self._windows = {}
+    
+    @classmethod
+    def build(cls, root, segment_len, stepsize, fs=16000, window='hann', pow_2=False, mic_names=MIC_NAMES):
+        '''
+        index all the recordings of root (the directories with the mic files), the segments are those of
+        audio_segmenter_4_numpy(padding=False) and clip_audio
+        :param segment_len: 声音片段的长度(单位 s)
+        :param stepsize: 声音片段每次向前移动的时间长度(单位 s)
+        '''
+        seg_len = next_greater_power_of_2(segment_len * fs) if pow_2 else int(segment_len * fs)
+        step_size = int(stepsize * fs)
+        rec_dirs = sorted(set(os.path.dirname(i) for i in get_files_by_suffix(root, mic_names[0])))
+        recordings, rec_id, seg_no, start = [], [], [], []
+        for rec_dir in rec_dirs:
+            num_sample = []
+            for mic_name in mic_names:
+                audio, rec_fs = audioread_channels(os.path.join(rec_dir, mic_name), memmap=True)
+                assert rec_fs == fs
+                num_sample.append(audio.shape[-1])
+            num_sample = min(num_sample)
+            if num_sample < seg_len:
+                continue
+            num_segment = (num_sample - seg_len) // step_size + 1
+            rec_id.append(np.full(num_segment, len(recordings)))
+            seg_no.append(np.arange(num_segment))
+            start.append(np.arange(num_segment) * step_size)
+            recordings.append(os.path.relpath(rec_dir, start=root))
+        rec_id, seg_no, start = [np.concatenate(i) if len(i) else np.zeros(0) for i in (rec_id, seg_no, start)]
+        return cls(root, recordings, rec_id, seg_no, start, np.full(len(start), seg_len), window=window, fs=fs,
+                   mic_names=mic_names)
+    
+    def save(self, path):
+        savez_atomically(path, root=self.root, recordings=self.recordings, rec_id=self.rec_id, seg_no=self.seg_no,
+                         start=self.start, length=self.length, window=str(self.window), fs=self.fs, norm=self.norm,
+                         mic_names=np.asarray(self.mic_names))
+    
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        window = str(data['window'])
+        return cls(str(data['root']), data['recordings'], data['rec_id'], data['seg_no'], data['start'],
+                   data['length'], window=None if window == 'None' else window, fs=int(data['fs']),
+                   norm=bool(data['norm']), mic_names=list(data['mic_names']))
+    
+    def copy(self, mask=None, **kwargs):
+        '''
+        :param mask: optional bool / index array, the segments to keep (e.g. those that are not dropped)
+        :param kwargs: attributes to change (root, window, norm)
+        '''
+        mask = slice(None) if mask is None else mask
+        attrs = {'root': self.root, 'window': self.window, 'fs': self.fs, 'norm': self.norm,
+                 'mic_names': self.mic_names, }
+        attrs.update(kwargs)
+        return SegmentIndex(recordings=self.recordings, rec_id=self.rec_id[mask], seg_no=self.seg_no[mask],
+                            start=self.start[mask], length=self.length[mask], **attrs)
+    
+    def __len__(self):
+        return len(self.rec_id)
+    
+    def rel_path(self, i):
+        '''
+        the path of segment i relative to the dataset root, in the layout of clip_audio (recording/seg_{i})
+        '''
+        return os.path.join(self.recordings[self.rec_id[i]], 'seg_' + str(self.seg_no[i]))
+    
+    def groups(self):
+        '''
+        :return: {rec_id: rows of its segments}, to process the segments recording by recording
+        '''
+        order = np.argsort(self.rec_id, kind='stable')
+        rec_ids, first = np.unique(self.rec_id[order], return_index=True)
+        return dict(zip(rec_ids.tolist(), np.split(order, first[1:])))
+    
+    def get_recording(self, rec_id, root=None):
+        '''
+        :return: [channel] memmaps of the mic files of a recording (raw samples, see audio_memmap)
+        '''
+        root = self.root if root is None else root
+        key = (root, int(rec_id))
+        if key not in self._memmaps:
+            if len(self._memmaps) >= 8:  # every memmap holds a file descriptor, keep only a few recordings open
+                self._memmaps.pop(next(iter(self._memmaps)))
+            recording = []
+            for mic_name in self.mic_names:  # 1 channel per record_mic{i}.wav, all of them for record_mics.wav
+                audio, _ = audioread_channels(os.path.join(root, self.recordings[rec_id], mic_name), memmap=True)
+                recording.extend(audio)
+            self._memmaps[key] = recording
+        return self._memmaps[key]
+    
+    def get_segment(self, i, root=None, window=True):
+        '''
+        materialize segment i
+        :param root: read the segment from another root with the same recordings (e.g. the denoised cache)
+        :param window: apply the window of the index
+        :return: [channel * length], float64 in [-1, 1] as audioread
+        '''
+        start, length = self.start[i], self.length[i]
+        audio = np.asarray([pcm_to_float(mic[start:start + length])
+                            for mic in self.get_recording(self.rec_id[i], root)])
+        if window and (self.window is not None):
+            if length not in self._windows:
+                self._windows[length] = get_window(self.window, length)
+            audio = audio * self._windows[length]
+        if self.norm:
+            audio = np.asarray([normalize_single_channel_audio(channel) for channel in audio])
+        return audio
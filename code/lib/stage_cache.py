@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+
+
+class StageCache(object):
+    def __init__(self, db_path):
+        '''
+        content-addressed cache of the outputs of the preprocessing stages: the output of every work unit is recorded
+        with a key = hash(stage, parameters, content hashes of its inputs), and a unit is recomputed only if its key
+        changed (an input was modified, or a parameter of the stage changed), instead of only checking that the output
+        exists. The content hash of a file is memoized by (path, size, mtime), so that it is computed only once
+        usage (in a stage):
+            key = cache.get_key('extract_features', [seg_file, ...], {'num_gcc_bin': 128, ...})
+            if not cache.is_fresh(dst_fpath, key):
+                ... compute and save dst_fpath ...
+                cache.record(dst_fpath, key, outputs=[dst_fpath])
+        the outputs recorded with a unit must still exist for it to be fresh, so that a deleted output is computed
+        again (a unit recorded without its outputs, by an older cache, is computed again)
+        :param db_path: the SQLite file, shared by the processes of the stages
+        '''
+        super(StageCache, self).__init__()
+        self.db_path = db_path
+        self._local = threading.local()  # one connection per thread
+    
+    def __getstate__(self):
+        # the connections are not picklable, a spawned process opens its own (see conn)
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+    
+    @property
+    def conn(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():  # a forked process inherits the local of its thread
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            local.conn = sqlite3.connect(self.db_path, timeout=600, isolation_level=None)
+            local.pid = os.getpid()
+            # WAL: the worker processes write concurrently, without a fsync per record
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT);
+                CREATE TABLE IF NOT EXISTS units (unit TEXT PRIMARY KEY, key TEXT, outputs TEXT);
+            ''')
+            if 'outputs' not in [i[1] for i in local.conn.execute('PRAGMA table_info(units)')]:  # older caches
+                local.conn.execute('ALTER TABLE units ADD COLUMN outputs TEXT')
+        return local.conn
+    
+    def file_hash(self, path):
+        '''
+        :return: sha1 of the content of path, memoized by (path, size, mtime)
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.conn.execute('SELECT size, mtime_ns, digest FROM hashes WHERE path = ?', (path,)).fetchone()
+        if (row is not None) and (row[0] == stat.st_size) and (row[1] == stat.st_mtime_ns):
+            return row[2]
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        self.conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                          (path, stat.st_size, stat.st_mtime_ns, sha1.hexdigest()))
+        return sha1.hexdigest()
+    
+    def get_key(self, stage, inputs, params=None):
+        '''
+        :param stage: name of the stage
+        :param inputs: the input files of the unit (their content is hashed, not their path)
+        :param params: dict of the parameters of the stage that change the output (json-serializable)
+        '''
+        sha1 = hashlib.sha1(json.dumps([stage, params], sort_keys=True, default=str).encode())
+        for path in inputs:
+            sha1.update(self.file_hash(path).encode())
+        return sha1.hexdigest()
+    
+    def is_fresh(self, unit, key, outputs=()):
+        '''
+        :param unit: id of the work unit, its output path
+        :param outputs: output files that must exist, in addition to the outputs recorded with the unit
+        :return: True if the unit was recorded with key, and its outputs exist
+        '''
+        row = self.conn.execute('SELECT key, outputs FROM units WHERE unit = ?', (os.path.abspath(unit),)).fetchone()
+        if (row is None) or (row[0] != key):
+            return False
+        return (row[1] is not None) and all(os.path.exists(i) for i in list(outputs) + json.loads(row[1]))
+    
+    def record(self, unit, key, outputs=()):
+        '''
+        :param outputs: the files or directories written by the unit (none for e.g. a dropped clip)
+        '''
+        self.conn.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?)',
+                          (os.path.abspath(unit), key, json.dumps([os.path.abspath(i) for i in outputs])))
+    
+    def remove_outputs(self, unit):
+        '''
+        the outputs of unit were removed on purpose by a later stage (e.g. clean_audio_clips), the unit stays fresh
+        without them
+        '''
+        self.conn.execute("UPDATE units SET outputs = '[]' WHERE unit = ?", (os.path.abspath(unit),))
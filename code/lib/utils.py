@@ -239,7 +239,24 @@ def extract_nb_from_str(str):
     return list(map(int, res))
 
 
-def get_files_by_suffix(root, suffix=''):
+def savez_atomically(file, **kwds):
+    '''
+    np.savez into a temp file in the same folder, then rename it to file, so that readers never see a half-written file
+    '''
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp_file = file + '.%d.tmp' % os.getpid()
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **kwds)
+        os.replace(tmp_file, file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def get_files_by_suffix(root, suffix='', catalog=None):
+    if catalog is not None:  # query the DatasetCatalog (lib.catalog) instead of walking the tree
+        return catalog.get_files_by_suffix(root, suffix)
     if isinstance(suffix, str):
         suffix = (suffix,)
     else:
@@ -254,7 +271,9 @@ def get_files_by_suffix(root, suffix=''):
     return file_list
 
 
-def get_files_by_prefix(root, prefix=''):
+def get_files_by_prefix(root, prefix='', catalog=None):
+    if catalog is not None:
+        return catalog.get_files_by_prefix(root, prefix)
     if isinstance(prefix, str):
         prefix = (prefix,)
     else:
@@ -269,7 +288,9 @@ def get_files_by_prefix(root, prefix=''):
     return file_list
 
 
-def get_dirs_by_suffix(root, suffix=''):
+def get_dirs_by_suffix(root, suffix='', catalog=None):
+    if catalog is not None:
+        return catalog.get_dirs_by_suffix(root, suffix)
     if isinstance(suffix, str):
         suffix = (suffix,)
     else:
@@ -284,7 +305,9 @@ def get_dirs_by_suffix(root, suffix=''):
     return dir_list
 
 
-def get_dirs_by_prefix(root, prefix=''):
+def get_dirs_by_prefix(root, prefix='', catalog=None):
+    if catalog is not None:
+        return catalog.get_dirs_by_prefix(root, prefix)
     if isinstance(prefix, str):
         prefix = (prefix,)
     else:
@@ -299,7 +322,9 @@ def get_dirs_by_prefix(root, prefix=''):
     return dir_list
 
 
-def get_subfiles_by_suffix(root, suffix=''):
+def get_subfiles_by_suffix(root, suffix='', catalog=None):
+    if catalog is not None:
+        return catalog.get_subfiles_by_suffix(root, suffix)
     if isinstance(suffix, str):
         suffix = (suffix,)
     else:
@@ -315,7 +340,9 @@ def get_subfiles_by_suffix(root, suffix=''):
     return file_list
 
 
-def get_subfiles_by_prefix(root, prefix=''):
+def get_subfiles_by_prefix(root, prefix='', catalog=None):
+    if catalog is not None:
+        return catalog.get_subfiles_by_prefix(root, prefix)
     if isinstance(prefix, str):
         prefix = (prefix,)
     else:
@@ -330,7 +357,9 @@ def get_subfiles_by_prefix(root, prefix=''):
     return file_list
 
 
-def get_subdirs_by_suffix(root, suffix=''):
+def get_subdirs_by_suffix(root, suffix='', catalog=None):
+    if catalog is not None:
+        return catalog.get_subdirs_by_suffix(root, suffix)
     if isinstance(suffix, str):
         suffix = (suffix,)
     else:
@@ -345,7 +374,9 @@ def get_subdirs_by_suffix(root, suffix=''):
     return dir_list
 
 
-def get_subdirs_by_prefix(root, prefix=''):
+def get_subdirs_by_prefix(root, prefix='', catalog=None):
+    if catalog is not None:
+        return catalog.get_subdirs_by_prefix(root, prefix)
     if isinstance(prefix, str):
         prefix = (prefix,)
     else:
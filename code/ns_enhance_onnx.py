@@ -8,9 +8,35 @@ import onnxruntime as ort
 import ns_featurelib
 
 
+GRAPH_OPTIMIZATION_LEVEL = {
+    'disable' : ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic'   : ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all'     : ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def get_session_options(intra_op_num_threads=0, inter_op_num_threads=0, graph_optimization_level='all',
+                        enable_cpu_mem_arena=True, ):
+    '''
+    explicitly sized options of an onnxruntime session
+    :param intra_op_num_threads: threads used inside an operator (0: onnxruntime default, i.e. all physical cores)
+    :param inter_op_num_threads: threads used across operators (0: onnxruntime default)
+    :param graph_optimization_level: 'disable', 'basic', 'extended' or 'all'
+    :param enable_cpu_mem_arena: whether to use the memory arena of the CPU allocator
+    :return:
+    '''
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_num_threads
+    sess_options.inter_op_num_threads = inter_op_num_threads
+    sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVEL[graph_optimization_level]
+    sess_options.enable_cpu_mem_arena = enable_cpu_mem_arena
+    return sess_options
+
+
 class NSnet2Enhancer(object):
-    def __init__(self, modelfile, cfg=None):
-        """Instantiate NSnet2 given a trained model path."""
+    def __init__(self, modelfile, cfg=None, sess_options=None):
+        """Instantiate NSnet2 given a trained model path (and optionally the SessionOptions of onnxruntime)."""
         self.cfg = {
             'winlen'  : 0.02,
             'hopfrac' : 0.5,
@@ -23,8 +49,10 @@ class NSnet2Enhancer(object):
         self.Nfft = int(float(self.cfg['winlen']) * self.fs)  # 320
         self.mingain = 10 ** (self.cfg['mingain'] / 20)  # 0.0001
         """load onnx model"""
-        self.ort = ort.InferenceSession(modelfile)
+        self.ort = ort.InferenceSession(modelfile, sess_options=sess_options)
         self.dtype = np.float32
+        # a model exported with a fixed batch dimension can only take one signal per run
+        self.fixed_batch = isinstance(self.ort.get_inputs()[0].shape[0], int)
     
     def enhance(self, x):
         """Obtain the estimated filter"""
@@ -34,6 +62,16 @@ class NSnet2Enhancer(object):
         out = self.ort.run(None, onnx_inputs)[0][0]
         return out
     
+    def enhance_batch(self, x):
+        """Obtain the estimated filters of a batch, x: [batch x time x freq]"""
+        if self.fixed_batch:
+            return np.asarray([self.enhance(i[np.newaxis]) for i in x])
+        onnx_inputs = {
+            self.ort.get_inputs()[0].name: x.astype(self.dtype)
+        }
+        out = self.ort.run(None, onnx_inputs)[0]
+        return out
+    
     def __call__(self, sigIn, inFs):
         """Enhance a single Audio signal."""
         assert inFs == self.fs, "Inconsistent sampling rate!"
@@ -55,30 +93,166 @@ class NSnet2Enhancer(object):
         sigOut = ns_featurelib.spec2sig(outSpec, self.cfg)
         
         return sigOut
+    
+    def batch_call(self, sigIn, inFs):
+        """Enhance a batch of equal-length audio signals ([batch x samples]) with a single run of the model."""
+        assert inFs == self.fs, "Inconsistent sampling rate!"
+        sigIn = np.asarray(sigIn)
+        num_sig = len(sigIn)
+        
+        # the batch is put on the channel axis of the stft: [freq x time x batch]
+        inputSpec = ns_featurelib.calcSpec(sigIn.T, self.cfg)
+        inputSpec = inputSpec.reshape(inputSpec.shape[:2] + (num_sig,))
+        inputFeature = ns_featurelib.calcFeat(inputSpec, self.cfg)
+        # shape: [batch x time x freq]
+        inputFeature = np.transpose(inputFeature, (2, 1, 0))
+        
+        # Obtain network output
+        out = self.enhance_batch(inputFeature)
+        
+        # limit suppression gain
+        Gain = np.transpose(out, (2, 1, 0))
+        Gain = np.clip(Gain, a_min=self.mingain, a_max=1.0)
+        outSpec = inputSpec * Gain
+        
+        # go back to time domain
+        sigOut = ns_featurelib.spec2sig(outSpec, self.cfg)
+        
+        return sigOut.reshape((-1, num_sig)).T
+    
+    def multi_channel_call(self, sigIn, inFs, gain_ref='mean'):
+        """
+        Enhance a multi-channel audio signal ([channel x samples]) with one gain mask shared by all the channels, so
+        that the phase differences between channels are kept.
+        gain_ref: how the shared gain is estimated
+            'mean'  one run of the model on the mean power spectrum of all the channels
+            'batch' one batched run of the model on every channel, then the mean of their gains
+            int     one run of the model on the given reference channel
+        """
+        assert inFs == self.fs, "Inconsistent sampling rate!"
+        sigIn = np.asarray(sigIn)
+        num_channel = len(sigIn)
+        
+        inputSpec = ns_featurelib.calcSpec(sigIn.T, self.cfg)  # [freq x time x channel]
+        inputSpec = inputSpec.reshape(inputSpec.shape[:2] + (num_channel,))
+        if gain_ref == 'mean':
+            refSpec = np.sqrt(np.mean(np.abs(inputSpec) ** 2, axis=-1))
+        elif gain_ref == 'batch':
+            refSpec = inputSpec
+        else:
+            refSpec = inputSpec[:, :, int(gain_ref)]
+        inputFeature = ns_featurelib.calcFeat(refSpec, self.cfg)
+        
+        # Obtain network output
+        if gain_ref == 'batch':
+            out = self.enhance_batch(np.transpose(inputFeature, (2, 1, 0))).mean(axis=0)
+        else:
+            out = self.enhance(np.expand_dims(np.transpose(inputFeature), axis=0))
+        
+        # limit suppression gain, and apply it to every channel
+        Gain = np.transpose(out)
+        Gain = np.clip(Gain, a_min=self.mingain, a_max=1.0)
+        outSpec = inputSpec * Gain[:, :, np.newaxis]
+        
+        # go back to time domain
+        sigOut = ns_featurelib.spec2sig(outSpec, self.cfg)
+        
+        return sigOut.reshape((-1, num_channel)).T
 
 
-def load_onnx_model(model_path='./ns_nsnet2-20ms-baseline.onnx'):
+class NSnet2StreamEnhancer(object):
+    def __init__(self, enhancer, context_frames=100):
+        """
+        Streaming NSNet2: enhance audio chunk by chunk (of any size), keeping the STFT analysis buffer and the
+        overlap-add tail between calls.
+        The algorithmic latency is fixed to one hop (N_win - N_hop = 160 samples, 10 ms at 16 kHz): a chunk ending
+        at input sample t completes the output up to sample t - N_hop, i.e. the output stream equals the output of
+        NSnet2Enhancer.__call__ on the whole signal, which is also delayed by one hop (apart from its last hop, which
+        the offline version leaves without the overlapping next frame).
+        The exported model does not expose the GRU state, so the model is run on the new frames plus up to
+        context_frames past frames (None: the whole history, identical to the offline result).
+        """
+        self.enhancer = enhancer
+        self.cfg = enhancer.cfg
+        self.N_win = int(float(self.cfg['winlen']) * enhancer.fs)
+        self.N_fft = int(self.cfg['nfft']) if 'nfft' in self.cfg else self.N_win
+        self.N_hop = int(self.N_win * float(self.cfg['hopfrac']))
+        self.win = np.sqrt(np.hanning(self.N_win))
+        self.context_frames = context_frames
+        self.latency = self.N_win - self.N_hop  # in samples
+        self.reset()
+    
+    def reset(self):
+        """Forget the stream."""
+        self.in_buffer = np.zeros((0,))  # input samples that do not form a whole hop yet
+        self.frame_buffer = np.zeros((self.N_win - self.N_hop,))  # analysis history, empty at the beginning
+        self.feature_history = np.zeros((0, self.N_fft // 2 + 1), dtype=self.enhancer.dtype)  # [time x freq]
+        self.ola_tail = np.zeros((self.N_win - self.N_hop,))  # overlap-add tail of the last frames
+    
+    def __call__(self, chunk):
+        """Enhance the next chunk of a single-channel stream. Returns the newly completed output samples."""
+        x = np.concatenate((self.in_buffer, np.asarray(chunk, dtype=float).reshape(-1)))
+        num_frame = len(x) // self.N_hop
+        self.in_buffer = x[num_frame * self.N_hop:]
+        if num_frame == 0:
+            return np.zeros((0,))
+        
+        # analysis: only the frames completed by the new samples
+        x = np.concatenate((self.frame_buffer, x[:num_frame * self.N_hop]))
+        self.frame_buffer = x[len(x) - (self.N_win - self.N_hop):]
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.N_win)[::self.N_hop][:num_frame]
+        inputSpec = np.fft.rfft(frames * self.win, self.N_fft, axis=-1)  # [time x freq]
+        inputFeature = ns_featurelib.calcFeat(inputSpec, self.cfg)
+        
+        # Obtain network output of the new frames (with the past frames as context)
+        self.feature_history = np.concatenate((self.feature_history, inputFeature))
+        if self.context_frames is not None:
+            self.feature_history = self.feature_history[-(self.context_frames + num_frame):]
+        out = self.enhancer.enhance(self.feature_history[np.newaxis])[-num_frame:]
+        
+        # limit suppression gain
+        Gain = np.clip(out, a_min=self.enhancer.mingain, a_max=1.0)
+        outSpec = inputSpec * Gain
+        
+        # synthesis and overlap-add with the tail of the previous call
+        x_win = np.fft.irfft(outSpec, self.N_fft, axis=-1)[:, np.newaxis, 0:self.N_win] * self.win
+        sigOut = ns_featurelib.overlap_add(x_win, self.N_hop)[0]
+        sigOut[:len(self.ola_tail)] += self.ola_tail
+        self.ola_tail = sigOut[num_frame * self.N_hop:]
+        return sigOut[:num_frame * self.N_hop]
+
+
+def load_onnx_model(model_path='./ns_nsnet2-20ms-baseline.onnx', **session_kwargs):
+    '''
+    :param session_kwargs: keyword arguments of get_session_options (e.g. intra_op_num_threads=4)
+    '''
     # check model path
     assert os.path.exists(model_path)
     
     # Create the enhancer
-    enhancer = NSnet2Enhancer(modelfile=model_path)
+    sess_options = get_session_options(**session_kwargs) if session_kwargs else None
+    enhancer = NSnet2Enhancer(modelfile=model_path, sess_options=sess_options)
     # get modelname
     model_name = os.path.split(os.path.basename(model_path))
     
     return enhancer, model_name
 
 
-def denoise_nsnet2(audio=None, fs=None, audio_ipath=None, audio_opath=None, model=None, model_name=None, ):
+def denoise_nsnet2(audio=None, fs=None, audio_ipath=None, audio_opath=None, model=None, model_name=None,
+                   multi_channel=False, gain_ref='mean', ):
     '''
     denoise audio with model
     And audio_ipath enjoys higher priority than (audio, fs)
-    :param audio:
+    :param audio: [sample_point] or [sample_point * channel] (as read by soundfile)
     :param fs:
     :param audio_ipath:
     :param audio_opath:
     :param model:
     :param model_name:
+    :param multi_channel: if True, denoise all the channels with one shared gain mask (see
+            NSnet2Enhancer.multi_channel_call) and return [channel * sample_point]; otherwise only the first channel
+            is denoised
+    :param gain_ref: how the shared gain is estimated, 'mean', 'batch' or the index of a reference channel
     :return:
     '''
     if audio_ipath is not None:
@@ -86,6 +260,13 @@ def denoise_nsnet2(audio=None, fs=None, audio_ipath=None, audio_opath=None, mode
         if audio is not None:
             print('Warning: audio and fs will be ignored due to the existence of audio_ipath')
     
+    if multi_channel and len(audio.shape) > 1:
+        de_audio = model.multi_channel_call(audio.T, fs, gain_ref=gain_ref)
+        if audio_opath is not None:
+            os.makedirs(os.path.dirname(audio_opath), exist_ok=True)
+            sf.write(audio_opath, de_audio.T, fs)
+        return de_audio
+    
     if len(audio.shape) > 1:  # if >= one channel, only select the first channel
         audio = audio[:, 0]
     # audio_len = len(audio)
@@ -98,6 +279,19 @@ def denoise_nsnet2(audio=None, fs=None, audio_ipath=None, audio_opath=None, mode
     return de_audio
 
 
+def denoise_nsnet2_batch(audio_ls, fs, model, ):
+    '''
+    denoise a batch of equal-length single-channel audio with one run of the model
+    :param audio_ls: list or array of audio, [batch * sample_point]
+    :param fs:
+    :param model:
+    :return: [batch * sample_point]
+    '''
+    audio_ls = np.asarray(audio_ls)
+    assert audio_ls.ndim == 2, 'audio of a batch should be single-channel and of the same length'
+    return model.batch_call(audio_ls, fs)
+
+
 if __name__ == '__main__':
     model, _ = load_onnx_model()
     audio = np.zeros((16000,))
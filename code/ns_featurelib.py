@@ -1,7 +1,7 @@
 import numpy as np
 import soundfile as sf
 from pathlib import Path
-from scipy.signal import blackman, blackmanharris
+from scipy.signal.windows import blackman, blackmanharris
 
 
 def calcFeat(Spec, cfg):
@@ -82,18 +82,12 @@ def stft(x, N_fft, win, N_hop, nodelay=False):
     N_frames = int(np.ceil((Nx - N_win + N_hop) / N_hop))
     # print('N_frames:', N_frames, )
     Nx = N_frames * N_hop + N_win - N_hop  # padded length
-    x = np.vstack([x, np.zeros((Nx - len(x), M))])
-    
-    # init
-    X_spec = np.zeros((specsize, N_frames, M), dtype=complex)
-    win_M = np.outer(win, np.ones((1, M)))
-    x_frame = np.zeros((N_win, M))
-    for nn in range(0, N_frames):
-        idx = int(nn * N_hop)
-        x_frame = np.vstack((x_frame[N_hop:, :], x[idx:idx + N_hop, :]))
-        x_win = win_M * x_frame
-        X = np.fft.rfft(x_win, N_fft, axis=0)
-        X_spec[:, nn, :] = X
+    # the first frame is preceded by N_win - N_hop zeros, as if the analysis buffer started empty
+    x = np.vstack([np.zeros((N_win - N_hop, M)), x, np.zeros((Nx - len(x), M))])
+    
+    # frames: [N_frames x M x N_win] strided view, then one batched rfft over all frames
+    frames = np.lib.stride_tricks.sliding_window_view(x, N_win, axis=0)[::N_hop][:N_frames]
+    X_spec = np.fft.rfft(frames * win, N_fft, axis=-1).transpose((2, 0, 1))
     
     if nodelay:
         delay = int(N_win / N_hop - 1)
@@ -105,6 +99,28 @@ def stft(x, N_fft, win, N_hop, nodelay=False):
     return X_spec
 
 
+def overlap_add(frames, N_hop):
+    """
+    overlap-add of frames
+        frames 		[frames x channels x N_win]
+        N_hop 		hop size (samples)
+    returns [channels x (N_hop * (frames - 1) + N_win)]
+    """
+    N_frames, M, N_win = frames.shape
+    Nx = N_hop * (N_frames - 1) + N_win
+    x = np.zeros((M, Nx))
+    if N_win % N_hop == 0:
+        # split every frame into N_win / N_hop blocks of N_hop samples, and add each block column in one go
+        blocks = frames.reshape((N_frames, M, N_win // N_hop, N_hop))
+        for rr in range(N_win // N_hop):
+            idx = rr * N_hop
+            x[:, idx:idx + N_frames * N_hop] += blocks[:, :, rr, :].transpose((1, 0, 2)).reshape((M, -1))
+    else:
+        for nn in range(N_frames):
+            x[:, nn * N_hop:nn * N_hop + N_win] += frames[nn]
+    return x
+
+
 def istft(X, N_fft, win, N_hop):
     """
     inverse short-time Fourier transform
@@ -121,19 +137,9 @@ def istft(X, N_fft, win, N_hop):
     M = X.shape[2]
     N_win = len(win)
     
-    # init
-    Nx = N_hop * (N_frames - 1) + N_win
-    win_M = np.outer(win, np.ones((1, M)))
-    x = np.zeros((Nx, M))
-    
-    for nn in range(0, N_frames):
-        X_frame = np.squeeze(X[:, nn, :])
-        x_win = np.fft.irfft(X_frame, N_fft, axis=0)
-        x_win = x_win.reshape(N_fft, M)
-        x_win = win_M * x_win[0:N_win, :]
-        idx1 = int(nn * N_hop);
-        idx2 = int(idx1 + N_win)
-        x[idx1:idx2, :] = x_win + x[idx1:idx2, :]
+    # one batched irfft over all frames: [N_frames x M x N_win]
+    x_win = np.fft.irfft(X.transpose((1, 2, 0)), N_fft, axis=-1)[:, :, 0:N_win] * win
+    x = overlap_add(x_win, N_hop).T
     
     if M == 1:
         x = np.squeeze(x)
@@ -0,0 +1,256 @@
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from lib.audiolib import audioread, audio_segmenter_4_numpy
+from lib.utils import wise_standard_normalizaion
+from lib.audio_capture import paContinue, paInputOverflow, PyAudioSource, SimulatedAudioSource
+from ssl_feature_extractor import audioFeatureExtractor
+
+DIRECTION_MAPPING = [0, 45, 90, 135, 180, 225, 270, 315, ]
+
+
+class DOAClassifier(object):
+    def __init__(self, model_path):
+        '''
+        a trained DOA classifier on gcc_phat features: an ONNX model (*.onnx, run with onnxruntime) or a Keras model
+        (saved with model.save, as loaded in cal_confusion_matrix.py). Both backends are imported only when needed
+        :param model_path:
+        '''
+        super(DOAClassifier, self).__init__()
+        self.model_path = model_path
+        if model_path.endswith('.onnx'):
+            import onnxruntime as ort
+            self.backend = 'onnx'
+            self.model = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+            self.input_name = self.model.get_inputs()[0].name
+            input_rank = len(self.model.get_inputs()[0].shape)
+        else:
+            from tensorflow import keras
+            keras.backend.set_image_data_format('channels_first')
+            self.backend = 'keras'
+            self.model = keras.models.load_model(model_path)
+            input_rank = len(self.model.input_shape)
+        self.add_channel_axis = (input_rank == 4)  # [batch, 1, num_pair, num_gcc_bin] as the EEGNet of models_tf
+    
+    def predict(self, x):
+        '''
+        :param x: [batch * num_pair * num_gcc_bin]
+        :return: [batch * num_class], the predicted probabilities
+        '''
+        x = np.asarray(x, dtype=np.float32)
+        if self.add_channel_axis:
+            x = x[:, np.newaxis]
+        if self.backend == 'onnx':
+            return self.model.run(None, {self.input_name: x})[0]
+        return self.model.predict_on_batch(x)
+
+
+class RealtimeDOAEngine(object):
+    def __init__(self, source, classifier, segment_len=1., stepsize=0.1, window='hann', num_gcc_bin=128,
+                 normalization='sample-wise', mapping=None, chunk_queue_size=64, window_queue_size=8, max_batch=8,
+                 direction_mapping=DIRECTION_MAPPING, on_estimate=None):
+        '''
+        live DOA estimation in 3 threads connected by bounded queues:
+            capture (callback of source) -> chunk_queue -> framing -> window_queue -> gcc_phat + classifier
+        the capture callback only copies the chunk and calls put_nowait, so it never blocks: if chunk_queue is full the
+        chunk is dropped (and counted). The framing follows audio_segmenter_4_numpy (a window of segment_len every
+        stepsize), and if window_queue is full the oldest window is dropped to keep the latency bounded
+        :param source: an AudioSource (see lib.audio_capture)
+        :param classifier: a DOAClassifier, or any object with predict([batch * num_pair * num_gcc_bin])
+        :param segment_len: length of the analysis window (in s)
+        :param stepsize: hop between two estimates (in s)
+        :param normalization: normalization of the features, as used to train the model (see wise_standard_normalizaion)
+        :param mapping: physical channel of every logical mic (see init_micro_mapping in collect_data.py)
+        :param max_batch: maximum number of pending windows classified in one batch
+        :param on_estimate: optional function(estimate) called for every estimate (from the inference thread)
+        '''
+        super(RealtimeDOAEngine, self).__init__()
+        self.source = source
+        self.classifier = classifier
+        self.fs = source.sample_rate
+        self.num_channel = source.num_channel
+        self.segment_len = segment_len
+        self.stepsize = stepsize
+        self.window = window
+        self.seg_len = int(segment_len * self.fs)
+        self.step_size = int(stepsize * self.fs)
+        self.normalization = normalization
+        self.mapping = np.arange(self.num_channel) if (mapping is None) else np.asarray(mapping)
+        self.max_batch = max_batch
+        self.direction_mapping = direction_mapping
+        self.on_estimate = on_estimate
+        self.fe = audioFeatureExtractor(num_channel=self.num_channel, fs=self.fs, num_gcc_bin=num_gcc_bin, )
+        self.gcc_buffer = np.empty((max_batch, self.fe.num_pair, num_gcc_bin), dtype=np.float32)
+        self.chunk_queue = queue.Queue(maxsize=chunk_queue_size)
+        self.window_queue = queue.Queue(maxsize=window_queue_size)
+        self.running = threading.Event()
+        self.threads = []
+        self.reset_stats()
+    
+    def reset_stats(self):
+        self.num_chunk = 0
+        self.num_dropped_chunk = 0
+        self.num_input_overflow = 0
+        self.num_window = 0
+        self.num_dropped_window = 0
+        self.latency = []
+        self.estimates = []
+    
+    def _callback(self, in_data, frame_count, time_info, status_flags):
+        arrival_time = time.perf_counter()
+        if status_flags & paInputOverflow:
+            self.num_input_overflow += 1
+        self.num_chunk += 1
+        try:
+            self.chunk_queue.put_nowait((in_data, arrival_time))
+        except queue.Full:
+            self.num_dropped_chunk += 1
+        return None, paContinue
+    
+    def _framing(self):
+        pending = np.zeros((self.num_channel, 0), dtype=np.float32)
+        while self.running.is_set():
+            try:
+                in_data, arrival_time = self.chunk_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            chunk = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.num_channel)[:, self.mapping].T / 32768.
+            pending = np.concatenate((pending, chunk.astype(np.float32)), axis=1)
+            if pending.shape[1] < self.seg_len:
+                continue
+            # all the complete windows of the pending audio, as audio_segmenter_4_numpy would cut the recording
+            # (a view, the window is applied by get_gcc_phat_batch)
+            windows = audio_segmenter_4_numpy(pending, segment_len=self.segment_len, stepsize=self.stepsize,
+                                              fs=self.fs, window=None, padding=False, pow_2=False, return_view=True)
+            windows = windows.transpose((1, 0, 2))  # [num_window * channel * seg_len]
+            pending = pending[:, len(windows) * self.step_size:]
+            for window in windows:
+                self.num_window += 1
+                try:
+                    self.window_queue.put_nowait((window, arrival_time))
+                except queue.Full:  # drop the oldest window, the newest one is the most useful
+                    try:
+                        self.window_queue.get_nowait()
+                        self.num_dropped_window += 1
+                    except queue.Empty:
+                        pass
+                    self.window_queue.put_nowait((window, arrival_time))
+    
+    def _inference(self):
+        while self.running.is_set():
+            try:
+                batch = [self.window_queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.window_queue.get_nowait())
+                except queue.Empty:
+                    break
+            audio = np.asarray([window for window, _ in batch])
+            gcc_phat = self.fe.get_gcc_phat_batch(audio, out=self.gcc_buffer[:len(batch)], window=self.window)
+            gcc_phat = wise_standard_normalizaion(gcc_phat, normalization=self.normalization)
+            prob = self.classifier.predict(gcc_phat)
+            done_time = time.perf_counter()
+            for (_, arrival_time), window_prob in zip(batch, prob):
+                label = int(np.argmax(window_prob))
+                estimate = {
+                    'doa'    : self.direction_mapping[label] if (self.direction_mapping is not None) else label,
+                    'prob'   : float(window_prob[label]),
+                    'latency': done_time - arrival_time,
+                }
+                self.latency.append(estimate['latency'])
+                self.estimates.append(estimate)
+                if self.on_estimate is not None:
+                    self.on_estimate(estimate)
+    
+    def start(self):
+        self.reset_stats()
+        self.running.set()
+        self.threads = [threading.Thread(target=self._framing, daemon=True),
+                        threading.Thread(target=self._inference, daemon=True), ]
+        for thread in self.threads:
+            thread.start()
+        self.source.start(self._callback)
+        return self
+    
+    def stop(self):
+        self.source.stop()
+        self.running.clear()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+    
+    def run(self, duration):
+        '''
+        estimate for duration seconds, and return the report
+        '''
+        with self:
+            time.sleep(duration)
+        return self.report()
+    
+    def report(self):
+        '''
+        :return: statistics of the session, latency (in ms) from the arrival of the last chunk of a window to its estimate
+        '''
+        latency = np.asarray(self.latency) * 1000 if len(self.latency) else np.full(1, np.nan)
+        stats = {
+            'num_chunk'         : self.num_chunk,
+            'num_dropped_chunk' : self.num_dropped_chunk,
+            'num_input_overflow': self.num_input_overflow,
+            'num_window'        : self.num_window,
+            'num_dropped_window': self.num_dropped_window,
+            'num_estimate'      : len(self.estimates),
+        }
+        stats.update(dict(zip(['latency_p50', 'latency_p95', 'latency_p99', 'latency_max'],
+                              np.percentile(latency, [50, 95, 99, 100]))))
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='real-time DOA estimation: capture -> gcc_phat -> classifier')
+    parser.add_argument('--model_path', type=str, required=True, help='*.onnx, or a Keras model directory')
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--segment_len', type=float, default=1.)
+    parser.add_argument('--stepsize', type=float, default=0.1)
+    parser.add_argument('--num_gcc_bin', type=int, default=128)
+    parser.add_argument('--normalization', type=str, default='sample-wise')
+    parser.add_argument('--mapping', type=int, nargs='+', default=None)
+    parser.add_argument('--chunk', type=int, default=1024)
+    parser.add_argument('--simulate_doa', type=float, default=None,
+                        help='replace the device by reference_wav.wav synthesized at this DOA')
+    parser.add_argument('--ref_path', type=str, default='../reference_wav.wav')
+    parser.add_argument('--wav_path', type=str, nargs='+', default=None,
+                        help='replace the device by a multi-channel wav, or one wav per mic')
+    parser.add_argument('--speed', type=float, default=1.)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    
+    if args.wav_path is not None:
+        wav_path = args.wav_path[0] if (len(args.wav_path) == 1) else args.wav_path
+        source = SimulatedAudioSource.from_wav(wav_path, chunk=args.chunk, speed=args.speed)
+    elif args.simulate_doa is not None:
+        ref_audio, fs = audioread(args.ref_path)
+        source = SimulatedAudioSource.from_doa(ref_audio, args.simulate_doa, sample_rate=fs, chunk=args.chunk,
+                                               speed=args.speed)
+    else:
+        from collect_data import get_device_index, CHANNELS, SAMPLE_RATE, RECORD_WIDTH
+        source = PyAudioSource(device_index=get_device_index(), num_channel=CHANNELS, sample_rate=SAMPLE_RATE,
+                               sample_width=RECORD_WIDTH, chunk=args.chunk, )
+    
+    engine = RealtimeDOAEngine(source, DOAClassifier(args.model_path), segment_len=args.segment_len,
+                               stepsize=args.stepsize, num_gcc_bin=args.num_gcc_bin,
+                               normalization=args.normalization, mapping=args.mapping,
+                               on_estimate=(lambda estimate: print(estimate)) if args.verbose else None, )
+    stats = engine.run(args.duration)
+    print('-' * 20, 'report', '-' * 20, )
+    for key, value in stats.items():
+        print('{:<20s}: {}'.format(key, round(value, 2) if isinstance(value, float) else value))
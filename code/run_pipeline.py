@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from lib.catalog import DatasetCatalog
+from lib.stage_cache import StageCache
+from lib.utils import add_prefix_and_suffix_4_basename
+from dataset_prepro_1 import segment_para_set, get_segment_para, print_info_of_walker_and_sound_source, clip_audio, \
+    preprocessing_audio_with_norm_denoise_drop, clean_audio_clips, preprocessing_audio_with_norm_denoise_drop_norm, \
+    extract_features
+
+STAGES = ['clip', 'norm_denoise_drop', 'clean', 'norm', 'features', 'features_norm', ]
+
+
+class StageJournal(object):
+    def __init__(self, path):
+        '''
+        journal of the completed stages of a dataset (stage -> key of its parameters and source tree, see
+        get_stage_key), so that a restarted run skips them. The work units of an interrupted stage are journaled by
+        the StageCache (one record per completed unit), so the stage resumes where it stopped
+        :param path: json file of the journal
+        '''
+        super(StageJournal, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.stages = json.load(f)
+    
+    def is_done(self, stage, key):
+        return self.stages.get(stage, {}).get('key') == key
+    
+    def mark_done(self, stage, key, elapsed):
+        with self.lock:
+            self.stages[stage] = {'key': key, 'elapsed': elapsed, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.stages, f, indent=4)
+            os.replace(self.path + '.tmp', self.path)
+
+
+def build_stage_graph(args, clip_len, catalog, cache):
+    '''
+    the stages of one parameter set of segment_para_set, as in dataset_prepro_1.__main__:
+        clip -> norm_denoise_drop -> clean -> features (gcc_phat, stft)
+                                           -> norm -> features_norm (gcc_phat, stft)
+    every features stage extracts all the feature types in a single read pass of the segments (see extract_features)
+    :return: dataset directory of the parameter set,
+            {stage: {'deps': stages, 'src': its source tree, 'params': the parameters that change its outputs,
+                     'func': top-level function of dataset_prepro_1, 'kwargs': its arguments, 'key': hash of params}}
+            func and kwargs are picklable, so that every stage runs in its own spawned process (see run_stage_graph)
+    '''
+    seg_para, seg_ds_name = get_segment_para(clip_len, fs=args.fs, threshold=args.threshold)
+    initial_dspath = os.path.join(args.dataset_root, 'initial')
+    ini_seg_dspath = os.path.join(args.dataset_root, seg_ds_name, 'ini_' + args.window)
+    norm_denoise_drop_dspath = add_prefix_and_suffix_4_basename(ini_seg_dspath, suffix='_norm_denoise_drop')
+    norm_denoise_drop_norm_dspath = add_prefix_and_suffix_4_basename(ini_seg_dspath, suffix='_norm_denoise_drop_norm')
+    gcc_suffix = '_gcc_phat' + '_bin_' + str(args.num_gcc_bin)
+    fft_suffix = '_stft' + '_seglen_' + str(int(args.fft_seg_len * 1000)) + 'ms' \
+                 + '_stepsize_ratio_' + str(round(args.fft_stepsize_ratio, 2))
+    feature_kwargs = {'fs': args.fs, 'num_gcc_bin': args.num_gcc_bin, 'fft_seg_len': args.fft_seg_len,
+                      'fft_stepsize_ratio': args.fft_stepsize_ratio, 'store': args.store, 'catalog': catalog,
+                      'cache': cache, }
+    
+    def features(src_dspath):
+        dst_dspath = [add_prefix_and_suffix_4_basename(src_dspath, suffix=i) for i in [gcc_suffix, fft_suffix]]
+        return dict(src_dspath=src_dspath, dst_dspath=dst_dspath, feature_type=['gcc_phat', 'stft'], **feature_kwargs)
+    
+    graph = {
+        'clip'             : {
+            'deps'  : [],
+            'src'   : initial_dspath,
+            'params': [seg_para, args.window, args.pow_2, args.layout],
+            'func'  : clip_audio,
+            'kwargs': dict(src_dspath=initial_dspath, des_dspath=ini_seg_dspath, seg_len=seg_para['time_len'],
+                           stepsize=seg_para['stepsize'], fs=args.fs, window=args.window, pow_2=args.pow_2,
+                           layout=args.layout, catalog=catalog, cache=cache, ),
+        },
+        'norm_denoise_drop': {
+            'deps'  : ['clip'],
+            'src'   : ini_seg_dspath,
+            'params': [seg_para['threshold'], args.multi_channel, args.model_path],
+            'func'  : preprocessing_audio_with_norm_denoise_drop,
+            'kwargs': dict(src_dspath=ini_seg_dspath, fs=args.fs, threshold=float(seg_para['threshold']),
+                           num_process=args.num_process, num_thread=args.num_thread, multi_channel=args.multi_channel,
+                           model_path=args.model_path, catalog=catalog, cache=cache, ),
+        },
+        'clean'            : {
+            'deps'  : ['norm_denoise_drop'],
+            'src'   : norm_denoise_drop_dspath,
+            'params': [],
+            'func'  : clean_audio_clips,
+            'kwargs': dict(ds_path=norm_denoise_drop_dspath, catalog=catalog, cache=cache, ),
+        },
+        'norm'             : {
+            'deps'  : ['clean'],
+            'src'   : norm_denoise_drop_dspath,
+            'params': [],
+            'func'  : preprocessing_audio_with_norm_denoise_drop_norm,
+            'kwargs': dict(src_dspath=norm_denoise_drop_dspath, fs=args.fs, catalog=catalog, cache=cache, ),
+        },
+        'features'         : {
+            'deps'  : ['clean'],
+            'src'   : norm_denoise_drop_dspath,
+            'params': [args.num_gcc_bin, args.fft_seg_len, args.fft_stepsize_ratio, args.store],
+            'func'  : extract_features,
+            'kwargs': features(norm_denoise_drop_dspath),
+        },
+        'features_norm'    : {
+            'deps'  : ['norm'],
+            'src'   : norm_denoise_drop_norm_dspath,
+            'params': [args.num_gcc_bin, args.fft_seg_len, args.fft_stepsize_ratio, args.store],
+            'func'  : extract_features,
+            'kwargs': features(norm_denoise_drop_norm_dspath),
+        },
+    }
+    for stage in graph.values():
+        stage['key'] = hashlib.sha1(json.dumps(stage['params'], sort_keys=True, default=str).encode()).hexdigest()
+    return os.path.join(args.dataset_root, seg_ds_name), graph
+
+
+def get_stage_key(stage, catalog):
+    '''
+    key of a stage in the journal: hash of its parameters and of the fingerprint of its source tree (see
+    DatasetCatalog.get_fingerprint), so that a stage runs again when a file of its source tree was added, removed or
+    modified, e.g. a new recording or the outputs of a dependency that ran again
+    '''
+    return hashlib.sha1((stage['key'] + catalog.get_fingerprint(stage['src'], suffix='.wav')).encode()).hexdigest()
+
+
+def run_stage(func, kwargs):
+    '''
+    target of the process of a stage: a spawned process starts its own processes with spawn too, the stage forks its
+    workers (single_Process closures) instead, which is safe here since the process of the stage has a single thread
+    '''
+    multiprocessing.set_start_method('fork', force=True)
+    func(**kwargs)
+
+
+def run_stage_graph(graph, journal, catalog, stages=STAGES, max_workers=2, rerun=False):
+    '''
+    run the selected stages of graph in the order of their dependencies; the stages whose dependencies are done run
+    concurrently, e.g. the un-normalized features and norm. Every stage runs in its own process started with spawn
+    (not in a thread of this process): the stages fork their own worker processes, and a process forked from a
+    multithreaded one inherits the locks (SQLite, tqdm) held by its other threads and can deadlock on them
+    a stage is skipped if the journal has it done with the same key (see get_stage_key); the key is journaled when
+    the stage finishes (clean modifies its own source tree). The stages that are not selected are considered done
+    '''
+    context = multiprocessing.get_context('spawn')
+    done = {i for i in graph.keys() if i not in stages}
+    pending = [i for i in graph.keys() if i in stages]
+    running = {}
+    while pending or running:
+        for name in list(pending):
+            stage = graph[name]
+            if (len(running) >= max_workers) or not all(i in done for i in stage['deps']):
+                continue
+            pending.remove(name)
+            if (not rerun) and journal.is_done(name, get_stage_key(stage, catalog)):
+                print('-' * 20, 'skip', name, '(done)', '-' * 20, )
+                done.add(name)
+                continue
+            print('-' * 20, 'start', name, '-' * 20, )
+            process = context.Process(target=run_stage, args=(stage['func'], stage['kwargs'],), name=name)
+            process.start()
+            running[process.sentinel] = (name, process, time.time())
+        if not running:
+            continue
+        for sentinel in wait(list(running.keys())):
+            name, process, start_time = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                # a failed stage stops the run, its completed units are journaled by the cache
+                for _, other, _ in running.values():
+                    other.join()
+                raise RuntimeError('stage {} failed (exit code {})'.format(name, process.exitcode))
+            elapsed = time.time() - start_time
+            journal.mark_done(name, get_stage_key(graph[name], catalog), elapsed)
+            print('-' * 20, 'finish', name, '({:.1f} s)'.format(elapsed), '-' * 20, )
+            done.add(name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='resumable preprocessing pipeline of dataset_prepro_1')
+    parser.add_argument('--dataset_root', type=str, default='../dataset/4F_CYC')
+    parser.add_argument('--clip_len', type=str, nargs='+', default=['1s'], choices=list(segment_para_set.keys()),
+                        help='parameter sets of segment_para_set')
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--threshold', type=int, default=None, help='replaces the drop threshold of segment_para_set')
+    parser.add_argument('--fs', type=int, default=16000)
+    parser.add_argument('--window', type=str, default='hann')
+    parser.add_argument('--pow_2', action='store_true')
+    parser.add_argument('--layout', type=str, default='per_mic', choices=['per_mic', 'interleaved'])
+    parser.add_argument('--multi_channel', action='store_true', help='see preprocessing_audio_with_norm_denoise_drop')
+    parser.add_argument('--model_path', type=str, default='./ns_nsnet2-20ms-baseline.onnx')
+    parser.add_argument('--num_process', type=int, default=8, help='denoise worker processes')
+    parser.add_argument('--num_thread', type=int, default=4, help='intra-op threads of every denoise worker')
+    parser.add_argument('--num_gcc_bin', type=int, default=128)
+    parser.add_argument('--fft_seg_len', type=float, default=0.064)
+    parser.add_argument('--fft_stepsize_ratio', type=float, default=0.5)
+    parser.add_argument('--store', action='store_true', help='save the features into FeatureStores')
+    parser.add_argument('--max_workers', type=int, default=2, help='number of stages running concurrently')
+    parser.add_argument('--rerun', action='store_true', help='ignore the journal of the stages (the work units of '
+                                                             'the stage cache are still skipped if unchanged)')
+    parser.add_argument('--info', action='store_true', help='print the info of the walker and the sound sources')
+    args = parser.parse_args()
+    assert args.window == 'hann'  # the stages replace 'ini_hann' in the paths
+    
+    catalog = DatasetCatalog(args.dataset_root)
+    cache = StageCache(os.path.normpath(args.dataset_root) + '.stage_cache.sqlite')
+    if args.info:
+        print_info_of_walker_and_sound_source(os.path.join(args.dataset_root, 'initial'), catalog=catalog)
+    
+    for clip_len in args.clip_len:
+        seg_dspath, graph = build_stage_graph(args, clip_len, catalog, cache)
+        print('-' * 20, 'pipeline of', seg_dspath, '-' * 20, )
+        run_stage_graph(graph, StageJournal(os.path.join(seg_dspath, 'pipeline_journal.json')), catalog,
+                        stages=args.stages, max_workers=args.max_workers, rerun=args.rerun)
@@ -1,10 +1,17 @@
 import os, sys
 import librosa
 import numpy as np
+from scipy import fft as sp_fft
+from scipy.signal import get_window
 from lib.audiolib import audio_segmenter_4_numpy
 
 EPS = np.finfo(np.float32).eps
 REF_POWER = 1e-12
+# up to this number of bins, the gcc_phat is evaluated by a partial inverse DFT of only the kept lags (O(freq * bins)
+# per pair) instead of the full irfft (O(n log n)): get_gcc_phat_batch is 1.2-1.4x faster with <= 32 bins up to 4096
+# samples and break-even at 1 s, but slower with the default 128 bins (see benchmark_gcc_phat_lag_limited in
+# benchmark_features.py)
+MAX_LAG_LIMITED_BIN = 32
 
 
 class audioFeatureExtractor(object):
@@ -34,6 +41,11 @@ class audioFeatureExtractor(object):
         
         self.datatype = datatype
         assert self.datatype == 'mic', f'{self.datatype} is not supported yet'
+        
+        # indices of mic pairs (i < j), in the same order as the double loop of get_gcc_phat
+        self.pair_i, self.pair_j = np.triu_indices(self.num_channel, k=1)
+        self.num_pair = len(self.pair_i)
+        self.lag_basis = {}  # (num_sample, dtype) -> phase basis of the lag-limited gcc_phat
     
     def get_rfft_spectrogram(self, audio, ):
         '''
@@ -90,6 +102,85 @@ class audioFeatureExtractor(object):
                 gcc_ls.append(cc)
         return np.asarray(gcc_ls)
     
+    def get_lag_basis(self, num_sample, dtype=np.float32):
+        '''
+        phase basis of a partial inverse real DFT that only evaluates the num_gcc_bin lags kept by get_gcc_phat
+        :param num_sample: length of the audio clips (in samples)
+        :return: [(num_sample // 2 + 1) * 2, num_gcc_bin] of dtype. Rows are interleaved as (real, imag) per frequency
+                bin, so that it matches a complex spectrum viewed as real
+        '''
+        dtype = np.dtype(dtype)
+        if (num_sample, dtype) not in self.lag_basis:
+            neg = self.num_gcc_bin - self.num_gcc_bin // 2
+            lags = np.arange(-neg, self.num_gcc_bin // 2)
+            freqs = np.arange(num_sample // 2 + 1)
+            # weights of irfft: the bins other than DC and Nyquist stand for two conjugate bins
+            weights = np.full(len(freqs), 2. / num_sample)
+            weights[0] = 1. / num_sample
+            if num_sample % 2 == 0:
+                weights[-1] = 1. / num_sample
+            phase = 2 * np.pi * (np.outer(freqs, lags) % num_sample) / num_sample
+            basis = np.empty((len(freqs) * 2, len(lags)), dtype=dtype)
+            basis[0::2] = weights[:, np.newaxis] * np.cos(phase)
+            basis[1::2] = -weights[:, np.newaxis] * np.sin(phase)
+            self.lag_basis[(num_sample, dtype)] = basis
+        return self.lag_basis[(num_sample, dtype)]
+    
+    def get_gcc_phat_batch(self, audio, out=None, rfft_spectra=None, window=None, dtype=np.float32,
+                           lag_limited=None):
+        '''
+        calculate gcc_phat feature of a batch of audio clips in one pass (float32 by default)
+        one batched rfft, one broadcast cross-spectrum over all mic pairs and one batched irfft
+        :param audio: [batch * channel * sample_point], e.g. a read-only view of audio_segmenter_4_numpy(return_view=True)
+        :param out: optional buffer of shape [batch * num_pair * num_gcc_bin] to write the features into
+        :param rfft_spectra: optional spectra of audio, [batch * channel * (sample_point // 2 + 1)]
+        :param window: optional window (e.g. 'hann') applied to every clip, fused with the conversion to dtype
+        :param dtype: float32, or float64 for the precision of get_gcc_phat (e.g. the features saved to disk)
+        :param lag_limited: evaluate only the kept lags by a partial inverse DFT (see get_lag_basis) instead of the
+                full irfft; None: if num_gcc_bin <= MAX_LAG_LIMITED_BIN
+        :return: [batch * num_pair * num_gcc_bin]
+        '''
+        audio = np.asarray(audio)
+        assert audio.ndim == 3 and audio.shape[1] == self.num_channel
+        num_sample = audio.shape[-1]
+        if window is not None:
+            audio = np.multiply(audio, get_window(window, num_sample), dtype=dtype)
+        else:
+            audio = audio.astype(dtype, copy=False)
+        if out is None:
+            out = np.empty((audio.shape[0], self.num_pair, self.num_gcc_bin), dtype=dtype)
+        assert out.shape == (audio.shape[0], self.num_pair, self.num_gcc_bin)
+        
+        spectra = sp_fft.rfft(audio, axis=-1) if (rfft_spectra is None) else \
+            rfft_spectra.astype(np.result_type(dtype, np.complex64))
+        R = np.conj(spectra[:, self.pair_i]) * spectra[:, self.pair_j]
+        return self.cross_power_to_gcc_phat(R, num_sample, out=out, lag_limited=lag_limited)
+    
+    def cross_power_to_gcc_phat(self, R, num_sample, out, lag_limited=None):
+        '''
+        PHAT weighting of cross-power spectra (in place) and inverse DFT to the num_gcc_bin lags around 0
+        :param R: [... * num_pair * (num_sample // 2 + 1)], complex64 (complex128 for float64), contiguous
+        :param out: [... * num_pair * num_gcc_bin], float32 (float64)
+        :param lag_limited: see get_gcc_phat_batch
+        '''
+        # PHAT weighting, equivalent to np.exp(1.j * np.angle(R)) (angle(0) = 0 -> 1)
+        mag = np.abs(R)
+        nonzero = mag > 0
+        np.divide(R, mag, out=R, where=nonzero)
+        R[~nonzero] = 1.
+        if lag_limited is None:
+            lag_limited = self.num_gcc_bin <= MAX_LAG_LIMITED_BIN
+        if lag_limited:
+            np.matmul(R.view(out.dtype), self.get_lag_basis(num_sample, dtype=out.dtype), out=out)
+            return out
+        cc = sp_fft.irfft(R, n=num_sample, axis=-1)
+        
+        # same lags as get_gcc_phat: cc[-n // 2:] keeps ceil(n / 2) negative lags (n // 2 + 1 if n is odd)
+        neg = self.num_gcc_bin - self.num_gcc_bin // 2
+        out[..., :neg] = cc[..., num_sample - neg:]
+        out[..., neg:] = cc[..., :self.num_gcc_bin // 2]
+        return out
+    
     def get_log_mel(self, audio, rfft_spectra=None):  # TODO don't support log_mel anymore
         raise AssertionError('TODO don\'t support log_mel anymore')
         audio = np.array(audio)
@@ -107,6 +198,8 @@ class audioFeatureExtractor(object):
     def get_stft(self, audio, ):
         '''
         calculate STFT of audio
+        the frames of all the channels are a strided view of audio (no copy), and the window is applied in the same
+        multiply that feeds the batched rfft
         :param audio: [channel * sample_point]
         :param seg_len: length of an audio clip (in seconds)
         :param stepsize_ratio: length ratio of each forward movement between two adjacent segments (in seconds)
@@ -114,15 +207,106 @@ class audioFeatureExtractor(object):
                 for the first dimension: real imag; real imag; real imag; real imag;
         '''
         assert (self.fft_seg_len is not None) and (self.fft_stepsize is not None)
-        audio = np.array(audio)
-        feature_ls = []
-        for channel in audio:
-            audio_seg = audio_segmenter_4_numpy(channel, fs=self.fs, segment_len=self.fft_seg_len,
-                                                stepsize=self.fft_stepsize, window='hann', padding=False, pow_2=False)
-            feature = self.get_rfft_spectrogram(audio_seg, )
-            feature = np.asarray(feature)
-            feature_ls.extend([feature.real, feature.imag, ])
-        return np.asarray(feature_ls)  # .transpose((1, 0, 2))
+        audio = np.asarray(audio)
+        frames = audio_segmenter_4_numpy(audio, fs=self.fs, segment_len=self.fft_seg_len, stepsize=self.fft_stepsize,
+                                         window=None, padding=False, pow_2=False, return_view=True)
+        spectra = np.fft.rfft(frames * get_window('hann', frames.shape[-1]), axis=-1)  # [channel * clip * freq]
+        feature = np.stack((spectra.real, spectra.imag), axis=1)
+        return feature.reshape((-1,) + feature.shape[2:])  # .transpose((1, 0, 2))
+
+
+class audioStreamFeatureExtractor(audioFeatureExtractor):
+    def __init__(self, num_channel=4, fs=16000, num_gcc_bin=128, fft_seg_len=0.064, fft_stepsize_ratio=0.5,
+                 window_len=1., window='hann', ):
+        '''
+        stateful STFT / gcc_phat over the last window_len seconds of a stream, updated chunk by chunk: only the frames
+        completed by a new chunk are windowed and rfft-ed, and the cross-power spectra of every mic pair are kept per
+        frame with their running sum over the window, so an update costs O(new samples) instead of O(window)
+        the frames are those of get_stft (fft_seg_len long, every fft_seg_len * fft_stepsize_ratio), and gcc_phat is
+        computed from the cross-power spectra averaged over the frames of the window (num_gcc_bin <= frame length)
+        usage:
+            fe = audioStreamFeatureExtractor()
+            for chunk in stream:  # [channel * sample_point]
+                if fe.update(chunk) and fe.is_ready():
+                    stft, gcc_phat = fe.get_stft(), fe.get_gcc_phat()
+        :param window_len: length of the window the features are computed over (in s)
+        :param window: window of every frame
+        '''
+        super(audioStreamFeatureExtractor, self).__init__(num_channel=num_channel, fs=fs, num_gcc_bin=num_gcc_bin,
+                                                          fft_seg_len=fft_seg_len,
+                                                          fft_stepsize_ratio=fft_stepsize_ratio, )
+        self.frame_len = int(fft_seg_len * fs)
+        self.hop = int(self.fft_stepsize * fs)
+        assert self.num_gcc_bin <= self.frame_len
+        self.num_frame = (int(window_len * fs) - self.frame_len) // self.hop + 1  # frames in a window, as get_stft
+        self.num_freq = self.frame_len // 2 + 1
+        self.win = get_window(window, self.frame_len).astype(np.float32)
+        self.reset()
+    
+    def reset(self):
+        self.tail = np.zeros((self.num_channel, 0), dtype=np.float32)  # samples of the frames not completed yet
+        # ring buffers of the last num_frame frames, frame k is in slot k % num_frame
+        self.spectra = np.zeros((self.num_frame, self.num_channel, self.num_freq), dtype=np.complex64)
+        self.cross_power = np.zeros((self.num_frame, self.num_pair, self.num_freq), dtype=np.complex64)
+        self.cross_power_sum = np.zeros((self.num_pair, self.num_freq), dtype=np.complex128)
+        self.num_computed_frame = 0
+    
+    def is_ready(self):
+        return self.num_computed_frame >= self.num_frame
+    
+    def update(self, chunk):
+        '''
+        :param chunk: new samples, [channel * sample_point]
+        :return: number of new frames
+        '''
+        audio = np.concatenate((self.tail, np.asarray(chunk, dtype=np.float32)), axis=1)
+        num_new = (audio.shape[1] - self.frame_len) // self.hop + 1 if audio.shape[1] >= self.frame_len else 0
+        if num_new == 0:
+            self.tail = audio
+            return 0
+        # the frames older than the window would be overwritten at once, skip them
+        num_skip = max(0, num_new - self.num_frame)
+        frames = np.lib.stride_tricks.sliding_window_view(audio, self.frame_len, axis=-1)[:, num_skip * self.hop::self.hop]
+        frames = frames[:, :num_new - num_skip]
+        spectra = sp_fft.rfft(frames * self.win, axis=-1).transpose((1, 0, 2))  # [frame * channel * freq]
+        cross_power = np.conj(spectra[:, self.pair_i]) * spectra[:, self.pair_j]
+        
+        first = self.num_computed_frame + num_skip
+        slots = np.arange(first, first + len(spectra)) % self.num_frame
+        self.cross_power_sum -= self.cross_power[slots].sum(axis=0)
+        self.cross_power_sum += cross_power.sum(axis=0)
+        self.spectra[slots] = spectra
+        self.cross_power[slots] = cross_power
+        if (first + len(spectra)) // self.num_frame != self.num_computed_frame // self.num_frame:
+            # once per window, sum again to stop the rounding errors of the running sum from accumulating
+            self.cross_power_sum = self.cross_power.sum(axis=0, dtype=np.complex128)
+        self.num_computed_frame += num_new
+        self.tail = audio[:, num_new * self.hop:]
+        return num_new
+    
+    def _window_order(self):
+        return np.arange(self.num_computed_frame, self.num_computed_frame + self.num_frame) % self.num_frame
+    
+    def get_stft(self, audio=None):
+        '''
+        STFT of the current window, laid out as audioFeatureExtractor.get_stft
+        :param audio: must be None, the audio is the one of the updates
+        :return: (num_channel * 2) * num_frame * frequency_bins
+                for the first dimension: real imag; real imag; real imag; real imag;
+        '''
+        assert audio is None, 'update the stream instead'
+        spectra = self.spectra[self._window_order()].transpose((1, 0, 2))
+        return np.stack((spectra.real, spectra.imag), axis=1).reshape(self.num_channel * 2, self.num_frame, -1)
+    
+    def get_gcc_phat(self, audio=None, rfft_spectra=None):
+        '''
+        gcc_phat of the current window, from the cross-power spectra averaged over its frames
+        :return: [num_pair * num_gcc_bin]
+        '''
+        assert (audio is None) and (rfft_spectra is None), 'update the stream instead'
+        R = (self.cross_power_sum / self.num_frame).astype(np.complex64)
+        out = np.empty((self.num_pair, self.num_gcc_bin), dtype=np.float32)
+        return self.cross_power_to_gcc_phat(R, self.frame_len, out=out)
 
 
 if __name__ == '__main__':